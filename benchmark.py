@@ -0,0 +1,470 @@
+"""
+handler.py のオフラインベンチマーク（GPU・Hubのモデルなしで実行できる）
+
+ランダム初期化した小さなSDXL構成のパイプライン（UNet / VAE / CLIPテキストエンコーダー / トークナイザー）を
+その場で組み立て、handler.setup_pipelines() で本番と同じグローバル（pipe / img2img_pipe / 各キャッシュ）に
+差し込む。JSONLのジョブを handler() に流し、設定ごとにレイテンシのパーセンタイル・スループット・
+最大RSSを報告する。モデルの重みは意味を持たないため、測れるのはリクエスト処理の経路
+（LoRA切り替え、ステージ構成、バッチング、エンコードなど）のコストと、その回帰である。
+
+使い方:
+    python benchmark.py --jobs benchmark_jobs.jsonl
+    python benchmark.py --jobs benchmark_jobs.jsonl \\
+        --config serial:MAX_CONCURRENCY=1 \\
+        --config batched:MAX_CONCURRENCY=4,MAX_BATCH_SIZE=4,BATCH_WINDOW_MS=20 \\
+        --repeat 3 --output bench.json --fail-on-error
+
+設定ごとに環境変数を変えて子プロセスで実行する（handler.py は環境変数をimport時に読むため。
+最大RSSも設定ごとに独立して測れる）。
+
+ジョブの形式は client.py --batch と同じ（{"name": ..., "input": {...}} または input のみ）。
+- 解像度は --max-side、ステップ数は --max-steps に収まるよう縮小する（アスペクト比とステージ構成は維持）
+- "reference_image_path" のファイルがなければ、小さなノイズ画像を参照画像として使う
+  （IP-Adapterはオフラインでロードできないため、参照画像なしの生成にフォールバックする経路を測ることになる）
+- "loras" はランダムなLoRA（--synthetic-loras 個、peftが必要）に置き換える。同じパスは同じアダプターになる
+  （quality: "fast" の蒸留LoRAも1個目のランダムLoRAで代用する）
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+RESULT_MARKER = "BENCHMARK_RESULT "
+
+# 小さなSDXL構成（diffusers のテストで使われるダミー構成と同程度）
+TEXT_ENCODER_CONFIG = {
+    "hidden_size": 32,
+    "intermediate_size": 37,
+    "layer_norm_eps": 1e-05,
+    "num_attention_heads": 4,
+    "num_hidden_layers": 5,
+    "hidden_act": "gelu",
+    "projection_dim": 32,
+    "max_position_embeddings": 77,
+}
+UNET_CONFIG = {
+    "block_out_channels": (32, 64),
+    "layers_per_block": 2,
+    "sample_size": 32,
+    "in_channels": 4,
+    "out_channels": 4,
+    "down_block_types": ("DownBlock2D", "CrossAttnDownBlock2D"),
+    "up_block_types": ("CrossAttnUpBlock2D", "UpBlock2D"),
+    "attention_head_dim": (2, 4),
+    "use_linear_projection": True,
+    "addition_embed_type": "text_time",
+    "addition_time_embed_dim": 8,
+    "transformer_layers_per_block": (1, 2),
+    "projection_class_embeddings_input_dim": 6 * 8 + 32,  # add_time_ids 6個 x 8 + text_encoder_2 の projection_dim
+    "cross_attention_dim": 64,  # text_encoder + text_encoder_2 の hidden_size
+}
+VAE_CONFIG = {
+    "block_out_channels": [32, 64],
+    "in_channels": 3,
+    "out_channels": 3,
+    "down_block_types": ["DownEncoderBlock2D", "DownEncoderBlock2D"],
+    "up_block_types": ["UpDecoderBlock2D", "UpDecoderBlock2D"],
+    "latent_channels": 4,
+    "sample_size": 128,
+}
+SCHEDULER_CONFIG = {
+    "beta_start": 0.00085,
+    "beta_end": 0.012,
+    "beta_schedule": "scaled_linear",
+    "steps_offset": 1,
+    "timestep_spacing": "leading",
+}
+LORA_WEIGHT_NAME = "pytorch_lora_weights.safetensors"
+
+
+def _bytes_to_unicode():
+    """CLIPのバイトレベルBPEと同じ、バイト値 -> 表示可能な1文字の対応表"""
+    printable = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + list(range(ord("®"), ord("ÿ") + 1))
+    chars = printable[:]
+    extra = 0
+    for byte in range(256):
+        if byte not in printable:
+            printable.append(byte)
+            chars.append(256 + extra)
+            extra += 1
+    return dict(zip(printable, map(chr, chars)))
+
+
+def write_tiny_clip_tokenizer(directory):
+    """
+    ネットワークなしで使えるCLIPトークナイザーのファイル（vocab.json / merges.txt）を書き出す
+
+    語彙は256バイト分の文字（語末の "</w>" 付きを含む）と特殊トークンだけで、マージ規則はない。
+    どんなテキストも1文字ずつのトークンになる。Returns: (語彙数, bos_id, eos_id)
+    """
+    symbols = list(_bytes_to_unicode().values())
+    vocab = {symbol: index for index, symbol in enumerate(symbols + [symbol + "</w>" for symbol in symbols])}
+    vocab["<|startoftext|>"] = len(vocab)
+    vocab["<|endoftext|>"] = len(vocab)
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "vocab.json"), "w", encoding="utf-8") as f:
+        json.dump(vocab, f, ensure_ascii=False)
+    with open(os.path.join(directory, "merges.txt"), "w", encoding="utf-8") as f:
+        f.write("#version: 0.2\n")
+    return len(vocab), vocab["<|startoftext|>"], vocab["<|endoftext|>"]
+
+
+def build_tiny_pipeline(work_dir, device, seed=0):
+    """ランダム初期化した小さな StableDiffusionXLPipeline を組み立てる（ダウンロードなし）"""
+    import torch
+    from diffusers import AutoencoderKL, EulerDiscreteScheduler, StableDiffusionXLPipeline, UNet2DConditionModel
+    from transformers import CLIPTextConfig, CLIPTextModel, CLIPTextModelWithProjection, CLIPTokenizer
+
+    tokenizer_dir = os.path.join(work_dir, "tokenizer")
+    vocab_size, bos_id, eos_id = write_tiny_clip_tokenizer(tokenizer_dir)
+    tokenizer = CLIPTokenizer(
+        os.path.join(tokenizer_dir, "vocab.json"),
+        os.path.join(tokenizer_dir, "merges.txt"),
+        model_max_length=TEXT_ENCODER_CONFIG["max_position_embeddings"],
+    )
+    text_encoder_config = CLIPTextConfig(
+        vocab_size=vocab_size, bos_token_id=bos_id, eos_token_id=eos_id, pad_token_id=eos_id, **TEXT_ENCODER_CONFIG
+    )
+
+    torch.manual_seed(seed)
+    pipeline = StableDiffusionXLPipeline(
+        vae=AutoencoderKL(**VAE_CONFIG),
+        text_encoder=CLIPTextModel(text_encoder_config),
+        text_encoder_2=CLIPTextModelWithProjection(text_encoder_config),
+        tokenizer=tokenizer,
+        tokenizer_2=tokenizer,
+        unet=UNet2DConditionModel(**UNET_CONFIG),
+        scheduler=EulerDiscreteScheduler(**SCHEDULER_CONFIG),
+        add_watermarker=False,
+    )
+    return pipeline.to(device)
+
+
+def build_synthetic_loras(work_dir, count, seed=0):
+    """
+    小さなUNet用のランダムなLoRAを count 個作り、保存先ディレクトリのリストを返す
+
+    peft がなければ空リストを返す（LoRA付きのジョブはLoRAなしで実行される）。
+    """
+    if count <= 0:
+        return []
+    try:
+        import torch
+        from peft import LoraConfig
+        from peft.utils import get_peft_model_state_dict
+        from diffusers import StableDiffusionXLPipeline, UNet2DConditionModel
+        from diffusers.utils import convert_state_dict_to_diffusers
+    except ImportError as e:
+        print(f"⚠️  Synthetic LoRAs disabled ({e}); LoRA entries will be dropped from jobs")
+        return []
+
+    paths = []
+    for index in range(count):
+        torch.manual_seed(seed + index)
+        unet = UNet2DConditionModel(**UNET_CONFIG)
+        unet.add_adapter(LoraConfig(r=4, lora_alpha=4, init_lora_weights="gaussian",
+                                    target_modules=["to_k", "to_q", "to_v", "to_out.0"]))
+        # 初期化直後は lora_B がゼロでLoRAの効果がないため、ランダムな値にして出力が変わるようにする
+        with torch.no_grad():
+            for name, param in unet.named_parameters():
+                if "lora_B" in name:
+                    torch.nn.init.normal_(param, std=0.5)
+        path = os.path.join(work_dir, f"lora{index}")
+        StableDiffusionXLPipeline.save_lora_weights(
+            path,
+            unet_lora_layers=convert_state_dict_to_diffusers(get_peft_model_state_dict(unet)),
+            weight_name=LORA_WEIGHT_NAME,
+        )
+        paths.append(path)
+    return paths
+
+
+def load_jobs(path):
+    """JSONLからジョブを読み込み [(名前, input)] を返す（空行と # で始まる行は無視）"""
+    jobs = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            spec = json.loads(line)
+            job_input = dict(spec["input"]) if "input" in spec else dict(spec)
+            jobs.append((spec.get("name") or f"job{line_no:04d}", job_input))
+    return jobs
+
+
+def _round8(value):
+    return max(8, int(round(value / 8)) * 8)
+
+
+def scale_job(job_input, handler, max_side, max_steps):
+    """
+    ジョブの解像度とステップ数を小さなモデル向けに縮小する
+
+    目標サイズとベース解像度（省略時は handler と同じバケット）を同じ倍率で縮め、8の倍数に丸める。
+    丸めでベース解像度がバケットのアスペクト比から外れる場合は、倍率を少し大きくして合わせる。
+    """
+    job_input = dict(job_input)
+    plan = dict(job_input.get("plan") or {})
+    width = job_input.get("width", 1024)
+    height = job_input.get("height", 1024)
+    steps = job_input.get("steps", 30)
+    bucket = handler.nearest_bucket(width, height)
+    base_width = plan.get("base_width", bucket[0])
+    base_height = plan.get("base_height", bucket[1])
+
+    side = max_side
+    while True:
+        factor = min(1.0, side / max(width, height, base_width, base_height))
+        scaled_base = (_round8(base_width * factor), _round8(base_height * factor))
+        aspect_error = abs((scaled_base[0] / scaled_base[1]) / (base_width / base_height) - 1)
+        if aspect_error <= handler.BUCKET_ASPECT_TOLERANCE / 2 or factor == 1.0:
+            break
+        side += 8
+
+    job_input["width"], job_input["height"] = _round8(width * factor), _round8(height * factor)
+    plan["base_width"], plan["base_height"] = scaled_base
+    job_input["steps"] = min(steps, max_steps)
+    strength = plan.get("refine_strength", handler.DEFAULT_REFINE_STRENGTH)
+    refine_steps = min(plan.get("refine_steps", steps), max_steps)
+    plan["refine_steps"] = max(refine_steps, math.ceil(1 / strength)) if strength > 0 else refine_steps
+    job_input["plan"] = plan
+    return job_input
+
+
+def _noise_png(size=64, seed=0):
+    from PIL import Image
+
+    image = Image.frombytes("RGB", (size, size), hashlib.shake_256(str(seed).encode()).digest(size * size * 3))
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def prepare_job(job_input, handler, args, lora_paths):
+    """ベンチマーク用にジョブを変換する（縮小、参照画像、LoRAの置き換え）"""
+    job_input = scale_job(job_input, handler, args.max_side, args.max_steps)
+
+    reference_image_path = job_input.pop("reference_image_path", None)
+    if reference_image_path:
+        if os.path.exists(reference_image_path):
+            with open(reference_image_path, "rb") as f:
+                reference_image = f.read()
+        else:
+            reference_image = _noise_png(seed=reference_image_path)
+        job_input["reference_image"] = base64.b64encode(reference_image).decode("utf-8")
+
+    loras = job_input.get("loras") or []
+    if loras:
+        if lora_paths:
+            job_input["loras"] = [
+                {
+                    **lora,
+                    "path": lora_paths[int(hashlib.sha1(str(lora.get("path")).encode()).hexdigest(), 16) % len(lora_paths)],
+                    "weight_name": LORA_WEIGHT_NAME,
+                }
+                for lora in loras
+            ]
+        else:
+            job_input.pop("loras")
+    return job_input
+
+
+def percentile(values, q):
+    """values の q パーセンタイル（線形補間）"""
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def latency_stats(values):
+    if not values:
+        return None
+    return {
+        "mean": round(sum(values) / len(values), 1),
+        "p50": round(percentile(values, 50), 1),
+        "p90": round(percentile(values, 90), 1),
+        "p99": round(percentile(values, 99), 1),
+        "max": round(max(values), 1),
+    }
+
+
+async def replay(handler, jobs, concurrency):
+    """ジョブを最大 concurrency 件ずつ handler() に流し、ジョブごとの (名前, レイテンシms, 出力) を返す"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(index, name, job_input):
+        async with semaphore:
+            start = time.perf_counter()
+            output = await handler.handler({"id": f"bench-{index:05d}", "input": job_input})
+            return name, (time.perf_counter() - start) * 1000, output
+
+    return await asyncio.gather(*(run(index, name, job_input) for index, (name, job_input) in enumerate(jobs)))
+
+
+def run_worker(args):
+    """子プロセス側：小さなパイプラインを差し込んでジョブを再生し、結果を1行のJSONで出力する"""
+    # ネットワークに出ないようにしてから handler を読み込む
+    os.environ.setdefault("HF_HUB_OFFLINE", "1")
+    import handler
+
+    with tempfile.TemporaryDirectory(prefix="sdxl-bench-") as work_dir:
+        start = time.perf_counter()
+        handler.setup_pipelines(build_tiny_pipeline(work_dir, handler.device, seed=args.seed))
+        lora_paths = build_synthetic_loras(work_dir, args.synthetic_loras, seed=args.seed)
+        if lora_paths:
+            # quality: "fast" の蒸留LoRAもランダムLoRAで代用する（経路とLoRA切り替えのコストを測る）
+            handler.FAST_LORA_PATH = lora_paths[0]
+            handler.FAST_LORA_WEIGHT_NAME = LORA_WEIGHT_NAME
+        setup_ms = (time.perf_counter() - start) * 1000
+
+        jobs = [(name, prepare_job(job_input, handler, args, lora_paths)) for name, job_input in load_jobs(args.jobs)]
+        concurrency = args.concurrency or handler.MAX_CONCURRENCY
+
+        # 初回のカーネル選択などを計測から外すため、最初のジョブを1回流しておく
+        if args.warmup and jobs:
+            asyncio.run(replay(handler, jobs[:1], 1))
+
+        start = time.perf_counter()
+        results = asyncio.run(replay(handler, jobs * args.repeat, concurrency))
+        elapsed = time.perf_counter() - start
+
+    # IP-Adapterがロードできなければ、参照画像付きのジョブは参照画像なしの生成にフォールバックしている
+    reference_jobs = sum(1 for _, job_input in jobs if job_input.get("reference_image")) * args.repeat
+    reference_fallback_jobs = reference_jobs if reference_jobs and not handler.ip_adapter.loaded else 0
+
+    latencies = []
+    errors = []
+    num_images = 0
+    stage_samples = {}
+    for name, latency, output in results:
+        if "error" in output:
+            errors.append({"name": name, "error": output["error"]})
+            continue
+        latencies.append(latency)
+        for entry in output.get("images", [output]):
+            num_images += 1
+            for stage, value in entry.get("timings", {}).items():
+                if isinstance(value, (int, float)):
+                    stage_samples.setdefault(stage, []).append(value)
+
+    return {
+        "jobs": len(results),
+        "errors": errors,
+        "concurrency": concurrency,
+        "setup_ms": round(setup_ms, 1),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_jobs_per_s": round(len(latencies) / elapsed, 3) if elapsed > 0 else None,
+        "throughput_images_per_s": round(num_images / elapsed, 3) if elapsed > 0 else None,
+        "latency_ms": latency_stats(latencies),
+        "stages_p50_ms": {stage: round(percentile(values, 50), 1) for stage, values in stage_samples.items()},
+        "peak_rss_mb": handler.peak_rss_mb(),
+        "reference_fallback_jobs": reference_fallback_jobs,
+    }
+
+
+def parse_config(spec):
+    """"名前:ENV=値,ENV=値" を (名前, {ENV: 値}) に変換する"""
+    name, _, assignments = spec.partition(":")
+    env = {}
+    for assignment in filter(None, assignments.split(",")):
+        key, sep, value = assignment.partition("=")
+        if not sep:
+            raise ValueError(f"Invalid config '{spec}' (expected name:ENV=value,...)")
+        env[key.strip()] = value.strip()
+    return name, env
+
+
+def run_config(name, env, args):
+    """1つの設定を子プロセスで実行し、結果の辞書を返す"""
+    command = [
+        sys.executable, os.path.abspath(__file__), "--worker",
+        "--jobs", args.jobs,
+        "--repeat", str(args.repeat),
+        "--max-side", str(args.max_side),
+        "--max-steps", str(args.max_steps),
+        "--synthetic-loras", str(args.synthetic_loras),
+        "--seed", str(args.seed),
+    ]
+    if args.concurrency:
+        command += ["--concurrency", str(args.concurrency)]
+    if not args.warmup:
+        command.append("--no-warmup")
+
+    print(f"\n▶ {name} {env or ''}")
+    process = subprocess.run(command, env={**os.environ, **env}, capture_output=True, text=True)
+    for line in reversed(process.stdout.splitlines()):
+        if line.startswith(RESULT_MARKER):
+            return {"config": name, "env": env, **json.loads(line[len(RESULT_MARKER):])}
+    sys.stderr.write(process.stdout[-4000:] + process.stderr[-4000:])
+    return {"config": name, "env": env, "failed": f"worker exited with code {process.returncode}"}
+
+
+def print_report(reports):
+    print(f"\n{'config':<16}{'jobs':>6}{'err':>5}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'jobs/s':>9}{'img/s':>9}{'RSS MB':>9}")
+    for report in reports:
+        if "failed" in report:
+            print(f"{report['config']:<16}  {report['failed']}")
+            continue
+        latency = report["latency_ms"] or {"p50": float("nan"), "p90": float("nan"), "p99": float("nan")}
+        print(
+            f"{report['config']:<16}{report['jobs']:>6}{len(report['errors']):>5}"
+            f"{latency['p50']:>10.1f}{latency['p90']:>10.1f}{latency['p99']:>10.1f}"
+            f"{report['throughput_jobs_per_s'] or 0:>9.2f}{report['throughput_images_per_s'] or 0:>9.2f}"
+            f"{report['peak_rss_mb'] or float('nan'):>9.1f}"
+        )
+    for report in reports:
+        if report.get("reference_fallback_jobs"):
+            print(
+                f"⚠️  [{report['config']}] {report['reference_fallback_jobs']} reference-image job(s) ran without "
+                "IP-Adapter (not loadable offline): they measure only the txt2img fallback"
+            )
+        for error in report.get("errors", [])[:5]:
+            print(f"❌ [{report['config']}] {error['name']}: {error['error']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="小さなランダムSDXLパイプラインで handler.py をベンチマークする")
+    parser.add_argument("--jobs", default="benchmark_jobs.jsonl", help="再生するジョブのJSONL")
+    parser.add_argument("--config", action="append", default=[], metavar="NAME:ENV=V,...",
+                        help="ベンチマークする設定（複数指定可。省略時は現在の環境変数のみ）")
+    parser.add_argument("--repeat", type=int, default=1, help="ジョブ一覧を繰り返す回数")
+    parser.add_argument("--concurrency", type=int, default=0, help="同時に流すジョブ数（0 = MAX_CONCURRENCY）")
+    parser.add_argument("--max-side", type=int, default=128, help="縮小後の最大辺（ピクセル）")
+    parser.add_argument("--max-steps", type=int, default=4, help="縮小後の最大ステップ数")
+    parser.add_argument("--synthetic-loras", type=int, default=4, help="LoRAの置き換えに使うランダムLoRAの数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-warmup", dest="warmup", action="store_false", help="計測前のウォームアップを行わない")
+    parser.add_argument("--output", help="結果をJSONで保存するパス")
+    parser.add_argument("--fail-on-error", action="store_true", help="エラーになったジョブがあれば終了コード1（CI用）")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(RESULT_MARKER + json.dumps(run_worker(args)))
+        return
+
+    configs = [parse_config(spec) for spec in args.config] or [("default", {})]
+    reports = [run_config(name, env, args) for name, env in configs]
+    print_report(reports)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(reports, f, indent=2, ensure_ascii=False)
+        print(f"\n結果を保存: {args.output}")
+    if args.fail_on_error and any("failed" in report or report["errors"] for report in reports):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,10 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import argparse
 import base64
+import hashlib
+import json
 from PIL import Image
 from io import BytesIO
 import time
@@ -7,6 +12,10 @@ import os
 import sys
 from pathlib import Path
 import re
+import importlib
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
 # 日本語→英語翻訳（オプション）
@@ -32,35 +41,717 @@ API_KEY = os.getenv("RUNPOD_API_KEY")
 if not ENDPOINT_ID or not API_KEY:
     raise ValueError("環境変数 RUNPOD_ENDPOINT_ID と RUNPOD_API_KEY を設定してください。")
 
+# APIのベースURL（ローカルの疑似エンドポイントで試す場合に変更）
+API_BASE = os.getenv("RUNPOD_API_BASE", "https://api.runpod.ai/v2").rstrip("/")
+
 def contains_japanese(text):
     """テキストに日本語が含まれているかチェック"""
     return bool(re.search(r'[\u3040-\u309F\u30A0-\u30FF\u4E00-\u9FFF]', text))
 
+# ==========================================
+# プロンプト翻訳：バックエンドは差し替え可能、結果はディスクにキャッシュ
+# ==========================================
+
+# "google"（deep_translator）/ "none"（翻訳しない）/ "module:callable"（list[str] -> list[str] の関数）
+TRANSLATION_BACKEND = os.getenv("TRANSLATION_BACKEND", "google")
+TRANSLATION_CACHE_PATH = os.getenv("TRANSLATION_CACHE_PATH", str(Path(__file__).parent / ".cache" / "translations.json"))
+
+# deep_translator の GoogleTranslator は1リクエスト5000文字まで
+GOOGLE_TRANSLATE_MAX_CHARS = 4500
+
+def _google_translate_joined(translator, texts):
+    """
+    複数の原文を改行でつないで1リクエストで翻訳し、行数で元の単位に分け直す
+
+    translate() は入力の前後の空白と改行を取り除くため、各行も前後を取り除いてからつなぐ
+    （先頭や末尾の改行で行数がずれないようにする）。
+    """
+    texts = [text.strip() for text in texts]
+    lines = [line.strip() for text in texts for line in text.split("\n")]
+    translated_lines = (translator.translate("\n".join(lines)) or "").split("\n")
+    if len(translated_lines) != len(lines):
+        # 改行が保たれなかった場合は分け直せないため、1件ずつ翻訳する
+        return [translator.translate(text) for text in texts]
+    results = []
+    for text in texts:
+        count = text.count("\n") + 1
+        results.append("\n".join(translated_lines[:count]))
+        translated_lines = translated_lines[count:]
+    return results
+
+def _google_translate_batch(texts):
+    """
+    原文をまとめて翻訳する（translate_batch は1件ごとにHTTPリクエストを送るため使わない）
+
+    文字数の上限ごとに改行でつないだリクエストにまとめるので、通常は1回の呼び出しで済む。
+    1件で上限を超える原文は上限で切り詰める（そのまま送ると例外になり、全件が未翻訳になるため）。
+    """
+    translator = GoogleTranslator(source='ja', target='en')
+    results = []
+    chunk = []
+    chunk_chars = 0
+    for text in texts:
+        if len(text) >= GOOGLE_TRANSLATE_MAX_CHARS:
+            print(f"⚠️  {len(text)}文字のプロンプトを{GOOGLE_TRANSLATE_MAX_CHARS - 1}文字に切り詰めて翻訳します")
+            text = text[:GOOGLE_TRANSLATE_MAX_CHARS - 1]
+        if chunk and chunk_chars + len(text) + 1 > GOOGLE_TRANSLATE_MAX_CHARS:
+            results.extend(_google_translate_joined(translator, chunk))
+            chunk = []
+            chunk_chars = 0
+        chunk.append(text)
+        chunk_chars += len(text) + 1
+    if chunk:
+        results.extend(_google_translate_joined(translator, chunk))
+    return results
+
+def load_translation_backend(spec):
+    """バックエンド指定から (名前, list[str] -> list[str] の関数) を返す。使えなければ関数は None"""
+    if spec == "none":
+        return spec, None
+    if spec == "google":
+        return spec, _google_translate_batch if TRANSLATOR_AVAILABLE else None
+    module_name, sep, attr = spec.partition(":")
+    if not sep:
+        raise ValueError(f"Unknown translation backend '{spec}' (use google / none / module:callable)")
+    return spec, getattr(importlib.import_module(module_name), attr)
+
+class TranslationCache:
+    """
+    翻訳結果の永続キャッシュ（JSONファイル）
+
+    キーはバックエンド名と原文のSHA-256。同じプロンプトは2回目以降ネットワークを使わない。
+    """
+
+    def __init__(self, path=TRANSLATION_CACHE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                self._entries = json.load(f)
+        except (OSError, ValueError):
+            self._entries = {}
+
+    @staticmethod
+    def key(backend, text):
+        return hashlib.sha256(f"{backend}\0{text}".encode("utf-8")).hexdigest()
+
+    def get(self, backend, text):
+        with self._lock:
+            return self._entries.get(self.key(backend, text))
+
+    def update(self, backend, translations):
+        """{原文: 訳文} を追加してファイルへ書き出す"""
+        with self._lock:
+            for text, translated in translations.items():
+                self._entries[self.key(backend, text)] = translated
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp_path = f"{self.path}.tmp{threading.get_ident()}"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._entries, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+
+translation_backend_name, translation_backend = load_translation_backend(TRANSLATION_BACKEND)
+translation_cache = TranslationCache()
+
+def set_translation_backend(spec):
+    """翻訳バックエンドを切り替える（--translator 用）"""
+    global translation_backend_name, translation_backend
+    translation_backend_name, translation_backend = load_translation_backend(spec)
+
+def translate_many(texts):
+    """
+    複数のテキストをまとめて英語に翻訳する（日本語を含まないものはそのまま）
+
+    キャッシュにない原文だけを重複を除いて1回のバッチでバックエンドへ送る。
+    原文は前後の空白を取り除いてから送り、キャッシュのキーにもする。翻訳に失敗した場合は原文を返す。
+    """
+    if translation_backend is None:
+        return list(texts)
+
+    pending = []
+    for text in texts:
+        text = text.strip()
+        if contains_japanese(text) and text not in pending and translation_cache.get(translation_backend_name, text) is None:
+            pending.append(text)
+    if pending:
+        print(f"📝 日本語プロンプトを翻訳: {len(pending)}件 ({translation_backend_name})")
+        try:
+            translated = translation_backend(pending)
+            translation_cache.update(translation_backend_name, dict(zip(pending, translated)))
+        except Exception as e:
+            print(f"⚠️  翻訳エラー: {e}")
+
+    results = []
+    for text in texts:
+        cached = translation_cache.get(translation_backend_name, text.strip()) if contains_japanese(text) else None
+        results.append(cached if cached is not None else text)
+    return results
+
 def translate_to_english(text):
     """日本語を英語に翻訳"""
-    if not TRANSLATOR_AVAILABLE or not contains_japanese(text):
-        return text
-    
-    try:
-        print(f"📝 日本語プロンプトを検出: {text}")
-        translated = GoogleTranslator(source='ja', target='en').translate(text)
+    translated = translate_many([text])[0]
+    if translated != text:
         print(f"✓ 英語に翻訳: {translated}")
-        return translated
-    except Exception as e:
-        print(f"⚠️  翻訳エラー: {e}")
-        return text
+    return translated
+
+# サーバーの output_format -> 保存時の拡張子
+OUTPUT_EXTENSIONS = {"png": ".png", "jpeg": ".jpg", "webp": ".webp"}
+
+def download_image(url, output_filename, chunk_size=1024 * 1024, session=None):
+    """署名付きURLから画像をストリーミングでダウンロードし、そのままファイルに書き出す"""
+    # 署名付きURLにAuthorizationヘッダーを付けると拒否されるため、APIとは別のセッションを使う
+    http = session or requests
+    with http.get(url, stream=True, timeout=300) as response:
+        response.raise_for_status()
+        with open(output_filename, "wb") as f:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                f.write(chunk)
+
+def save_output_image(entry, output_basename, session=None):
+    """
+    出力の1枚分（image または image_url を含む辞書）をファイルに保存し、保存先パスを返す
+
+    エンコード済みのバイト列をそのまま書き出し、再エンコードしない。
+    拡張子はサーバーの出力形式に合わせる。
+    """
+    extension = OUTPUT_EXTENSIONS.get(entry.get('format', 'png'), ".png")
+    output_filename = f"{output_basename}{extension}"
+    if 'image_url' in entry:
+        download_image(entry['image_url'], output_filename, session=session)
+    else:
+        with open(output_filename, "wb") as f:
+            f.write(base64.b64decode(entry['image']))
+    return output_filename
 
 def encode_image_to_base64(image_path):
     """画像をBase64エンコード"""
     with open(image_path, "rb") as image_file:
         return base64.b64encode(image_file.read()).decode('utf-8')
 
+# 参照画像の送信前縮小：IP-Adapterの画像エンコーダーは短辺224pxに縮小して使うため、それ以上は無駄な転送になる
+REFERENCE_IMAGE_SIZE = int(os.getenv("REFERENCE_IMAGE_SIZE", "224"))  # 短辺のピクセル数（0 = 縮小せずそのまま送る）
+REFERENCE_IMAGE_FORMAT = os.getenv("REFERENCE_IMAGE_FORMAT", "jpeg")  # "jpeg" / "webp"
+REFERENCE_IMAGE_QUALITY = int(os.getenv("REFERENCE_IMAGE_QUALITY", "90"))
+REFERENCE_CACHE_DIR = os.getenv("REFERENCE_CACHE_DIR", str(Path(__file__).parent / ".cache" / "references"))
+REFERENCE_EXTENSIONS = {"jpeg": ".jpg", "webp": ".webp"}
+
+def compact_reference_image(image_path, size=REFERENCE_IMAGE_SIZE, image_format=REFERENCE_IMAGE_FORMAT, quality=REFERENCE_IMAGE_QUALITY):
+    """
+    参照画像を短辺 size px に縮小して JPEG / WebP で再エンコードし、そのバイト列を返す
+
+    結果は元ファイルのハッシュと設定をキーに REFERENCE_CACHE_DIR へ保存し、2回目以降は再利用する。
+    元画像が十分小さい場合は拡大しない。
+    """
+    if image_format not in REFERENCE_EXTENSIONS:
+        raise ValueError(f"Unknown reference image format '{image_format}'. Available: {', '.join(REFERENCE_EXTENSIONS)}")
+    with open(image_path, "rb") as f:
+        source = f.read()
+    key = hashlib.sha256(source).hexdigest()
+    cache_path = os.path.join(REFERENCE_CACHE_DIR, f"{key}_{size}_q{quality}{REFERENCE_EXTENSIONS[image_format]}")
+    if os.path.exists(cache_path):
+        with open(cache_path, "rb") as f:
+            return f.read()
+
+    image = Image.open(BytesIO(source)).convert("RGB")
+    scale = size / min(image.size)
+    if scale < 1:
+        image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.LANCZOS)
+    buffer = BytesIO()
+    image.save(buffer, format=image_format.upper(), quality=quality)
+    compact = buffer.getvalue()
+
+    os.makedirs(REFERENCE_CACHE_DIR, exist_ok=True)
+    tmp_path = f"{cache_path}.tmp{threading.get_ident()}"
+    with open(tmp_path, "wb") as f:
+        f.write(compact)
+    os.replace(tmp_path, cache_path)
+    return compact
+
+def encode_reference_image(image_path):
+    """参照画像をBase64エンコード（REFERENCE_IMAGE_SIZE > 0 なら縮小・再エンコードしてから）"""
+    if REFERENCE_IMAGE_SIZE <= 0:
+        return encode_image_to_base64(image_path)
+    compact = compact_reference_image(image_path)
+    print(f"✓ 参照画像を縮小: {os.path.getsize(image_path) / 1024:.1f} KB → {len(compact) / 1024:.1f} KB")
+    return base64.b64encode(compact).decode('utf-8')
+
+# ==========================================
+# 結果キャッシュ：同じリクエスト（シード固定）の結果をディスクから返す
+# ==========================================
+
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", str(Path(__file__).parent / ".cache" / "results"))
+RESULT_CACHE_MAX_MB = float(os.getenv("RESULT_CACHE_MAX_MB", "2048"))
+# 正規化のルールやサーバーの既定値を変えたら上げる（古いキャッシュを無効にする）
+RESULT_CACHE_VERSION = 3
+
+# サーバー（handler.parse_request / parse_output_options）の既定値。省略と明示を同じキーにする
+REQUEST_DEFAULTS = {
+    "negative_prompt": "negativeXL_D, low quality, blurry",
+    "steps": 30,
+    "guidance_scale": 7.5,
+    "width": 1024,
+    "height": 1024,
+    "plan": None,
+    "ip_adapter_scale": 0.6,
+    "scheduler": "default",
+    "upscale_mode": "pixel",
+    "loras": [],
+    "lora_scale": 1.0,
+    "quality": "standard",
+    "output_format": "png",
+    "output_quality": 90,
+    "compress_level": 6,
+}
+# quality ごとに上書きされるサーバーの既定値（handler の FAST_* 既定値と合わせる）
+QUALITY_REQUEST_DEFAULTS = {
+    "fast": {"steps": 6, "guidance_scale": 1.5, "scheduler": "LCM"},
+}
+# quality ごとに plan へ補われる既定値（fast は既定でImg2Imgの仕上げを省略する）
+QUALITY_PLAN_DEFAULTS = {
+    "fast": {"refine": False},
+}
+# 生成結果の画像に影響しないキー
+NON_RESULT_KEYS = {"delivery", "step_timings", "preview_every"}
+
+def _normalize_numbers(value):
+    """整数値の float を int にそろえる（6 と 6.0 を同じキーにする）。dict / list は再帰的に処理する"""
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, dict):
+        return {key: _normalize_numbers(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_normalize_numbers(item) for item in value]
+    return value
+
+def request_cache_key(job_input):
+    """
+    リクエストを正規化してキャッシュキー（SHA-256）を返す。結果が決まらない場合は None
+
+    シード未指定のリクエストはサーバー側で乱数シードになるためキャッシュしない。
+    参照画像はbase64文字列ではなく、デコードしたバイト列のハッシュでキーに含める。
+    空の plan は省略と同じ、整数値の数値は 6 と 6.0 を同じに扱い、LoRAの name（表示用）は含めない。
+    """
+    normalized = {key: value for key, value in job_input.items() if key not in NON_RESULT_KEYS}
+    quality = normalized.get("quality", REQUEST_DEFAULTS["quality"])
+    for key, value in {**REQUEST_DEFAULTS, **QUALITY_REQUEST_DEFAULTS.get(quality, {})}.items():
+        normalized.setdefault(key, value)
+    plan = normalized["plan"]
+    if quality in QUALITY_PLAN_DEFAULTS and (plan is None or isinstance(plan, dict)):
+        normalized["plan"] = {**QUALITY_PLAN_DEFAULTS[quality], **(plan or {})}
+    elif plan == {}:
+        normalized["plan"] = None
+
+    seed = normalized.pop("seed", None)
+    seeds = normalized.pop("seeds", None)
+    num_images = normalized.pop("num_images", len(seeds) if seeds else 1)
+    if seeds is None:
+        if seed is None:
+            return None
+        seeds = [seed + i for i in range(num_images)]
+    normalized["seeds"] = list(seeds)
+
+    if isinstance(normalized.get("prompt"), str):
+        normalized["prompt"] = normalized["prompt"].strip()
+    if isinstance(normalized.get("negative_prompt"), str):
+        normalized["negative_prompt"] = normalized["negative_prompt"].strip()
+    normalized["output_format"] = str(normalized["output_format"]).lower()
+    normalized["loras"] = [
+        {"weight": 1.0, **{key: value for key, value in lora.items() if key != "name"}} for lora in normalized["loras"]
+    ]
+
+    reference_image = normalized.pop("reference_image", None)
+    if reference_image:
+        normalized["reference_image_sha256"] = hashlib.sha256(base64.b64decode(reference_image)).hexdigest()
+
+    canonical = json.dumps(
+        {"version": RESULT_CACHE_VERSION, "endpoint": ENDPOINT_ID, "input": _normalize_numbers(normalized)},
+        sort_keys=True, separators=(",", ":"), ensure_ascii=False,
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+class ResultCache:
+    """
+    生成結果のディスクキャッシュ
+
+    <root>/<key[:2]>/<key>/ に画像ファイルと meta.json（出力のメタデータ）を保存する。
+    合計サイズが max_bytes を超えたら、最後に使われた時刻が古いエントリーから削除する。
+    """
+
+    def __init__(self, root=RESULT_CACHE_DIR, max_bytes=int(RESULT_CACHE_MAX_MB * 1024 * 1024)):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, key, output_basename):
+        """キャッシュにあれば画像を output_basename へコピーし (ファイル一覧, 出力メタデータ) を返す。なければ None"""
+        entry_dir = self._entry_dir(key)
+        meta_path = os.path.join(entry_dir, "meta.json")
+        with self._lock:
+            try:
+                with open(meta_path, "r", encoding="utf-8") as f:
+                    meta = json.load(f)
+                files = []
+                for i, cached_name in enumerate(meta["files"]):
+                    suffix = f"_{i}" if len(meta["files"]) > 1 else ""
+                    output_filename = f"{output_basename}{suffix}{os.path.splitext(cached_name)[1]}"
+                    shutil.copyfile(os.path.join(entry_dir, cached_name), output_filename)
+                    files.append(output_filename)
+            except (OSError, ValueError, KeyError):
+                return None
+            os.utime(meta_path)  # LRU用に最終使用時刻を更新
+        return files, meta["output"]
+
+    def put(self, key, files, output):
+        """保存済みの画像ファイルと出力メタデータ（base64 / URLは除く）をキャッシュに登録する"""
+        entry_dir = self._entry_dir(key)
+        tmp_dir = f"{entry_dir}.tmp{threading.get_ident()}"
+        meta = {
+            "files": [f"{i}{os.path.splitext(path)[1]}" for i, path in enumerate(files)],
+            "output": _strip_image_payload(output),
+        }
+        with self._lock:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            os.makedirs(tmp_dir)
+            for path, cached_name in zip(files, meta["files"]):
+                shutil.copyfile(path, os.path.join(tmp_dir, cached_name))
+            with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+                json.dump(meta, f, ensure_ascii=False)
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            os.replace(tmp_dir, entry_dir)
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for prefix in os.listdir(self.root):
+            prefix_dir = os.path.join(self.root, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for key in os.listdir(prefix_dir):
+                entry_dir = os.path.join(prefix_dir, key)
+                meta_path = os.path.join(entry_dir, "meta.json")
+                if not os.path.exists(meta_path):
+                    continue
+                size = sum(entry.stat().st_size for entry in os.scandir(entry_dir) if entry.is_file())
+                entries.append((os.path.getmtime(meta_path), size, entry_dir))
+                total += size
+        for _, size, entry_dir in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+
+def _strip_image_payload(output):
+    """キャッシュに保存する出力から画像本体（base64）と期限付きURLを取り除く"""
+    def strip(entry):
+        return {key: value for key, value in entry.items() if key not in ("image", "image_url")}
+
+    stripped = strip(output)
+    if "images" in stripped:
+        stripped["images"] = [strip(entry) for entry in stripped["images"]]
+    return stripped
+
+# ==========================================
+# バッチモード：多数のジョブを /run へ並列投入し、共有セッションでポーリング
+# ==========================================
+
+def create_session(pool_size, api=True):
+    """コネクションプール付きのセッションを作成（api=True ならRunPodの認証ヘッダーを付ける）"""
+    session = requests.Session()
+    if api:
+        session.headers.update({
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {API_KEY}"
+        })
+    # GETのみ自動リトライ（/run のPOSTは重複投入を避けるためリトライしない）
+    retry = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["GET"])
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def load_job_specs(jobs_path):
+    """
+    JSONLファイルからジョブ定義を読み込む
+
+    1行1ジョブ。{"name": "...", "input": {...}} 形式、または input の中身だけでもよい。
+    input には "reference_image_path" でローカルの参照画像を指定できる。
+    """
+    specs = []
+    with open(jobs_path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            spec = json.loads(line)
+            job_input = dict(spec["input"]) if "input" in spec else dict(spec)
+            name = spec.get("name") or spec.get("request_id") or f"job{line_no:04d}"
+            specs.append((re.sub(r'[^\w.-]', '_', str(name)), job_input))
+    return specs
+
+def prepare_job_input(job_input):
+    """プロンプトの翻訳と参照画像のエンコードを行い、送信用の input を返す"""
+    job_input = dict(job_input)
+    if "prompt" in job_input:
+        job_input["prompt"] = translate_to_english(job_input["prompt"]).strip()
+    reference_image_path = job_input.pop("reference_image_path", None)
+    if reference_image_path:
+        job_input["reference_image"] = encode_reference_image(reference_image_path)
+    return job_input
+
+def poll_job(session, job_id, timeout, min_interval=0.5, max_interval=10.0):
+    """
+    ジョブが終わるまで /status をポーリングする
+
+    間隔は min_interval から始めて1.5倍ずつ max_interval まで伸ばす（短いジョブは早く拾い、
+    長いジョブではリクエスト数を抑える）。
+    """
+    status_url = f"{API_BASE}/{ENDPOINT_ID}/status/{job_id}"
+    deadline = time.time() + timeout
+    interval = min_interval
+    while True:
+        response = session.get(status_url, timeout=60)
+        response.raise_for_status()
+        status_data = response.json()
+        status = status_data.get('status')
+        if status == 'COMPLETED':
+            return status_data
+        if status not in ['IN_PROGRESS', 'IN_QUEUE']:
+            raise RuntimeError(f"ジョブ{status}: {status_data.get('error', status_data)}")
+        if time.time() + interval > deadline:
+            raise TimeoutError(f"{timeout:.0f}秒以内に完了しませんでした (ID: {job_id})")
+        time.sleep(interval)
+        interval = min(interval * 1.5, max_interval)
+
+# ストリーミングワーカー（STREAMING=1）が yield する途中経過イベントの種類
+STREAM_EVENT_TYPES = ("status", "progress", "preview")
+
+def final_output(output):
+    """
+    ジョブの出力から最終結果（dict）を取り出す
+
+    出力がリストの場合（yield された項目を集約するストリーミングワーカー）は、
+    途中経過イベントを除いた最後の項目を結果とする。見つからなければ None。
+    """
+    if isinstance(output, list):
+        results = [item for item in output if isinstance(item, dict) and item.get("type") not in STREAM_EVENT_TYPES]
+        return results[-1] if results else None
+    return output
+
+def fetch_stream_output(session, job_id):
+    """
+    完了したジョブの最終結果を /stream から取り出す
+
+    ストリーミングワーカーは途中経過とプレビューを /status に集約しない（return_aggregate_stream=False）ため、
+    /status の出力が空のジョブは、まだ読み出していないストリームから結果を探す。
+    """
+    response = session.get(f"{API_BASE}/{ENDPOINT_ID}/stream/{job_id}", timeout=60)
+    response.raise_for_status()
+    items = [item.get('output', item) if isinstance(item, dict) else item for item in response.json().get('stream', [])]
+    return final_output(items)
+
+def stream_job(session, job_input, output_basename, timeout=1800, poll_interval=0.5):
+    """
+    ジョブを /run へ投入し、/stream で進捗とプレビューを受け取りながら完了を待つ
+
+    プレビューは <output_basename>_preview.jpg に上書き保存する（複数枚なら _preview_<番号>.jpg）。
+    Ctrl+C で /cancel を送ってワーカーの生成を打ち切り、KeyboardInterrupt を送出する。
+
+    Returns:
+        (job_id, 最終結果の出力)
+    """
+    response = session.post(f"{API_BASE}/{ENDPOINT_ID}/run", json={"input": job_input}, timeout=120)
+    response.raise_for_status()
+    job_id = response.json()['id']
+    print(f"⏳ ジョブ投入 (ID: {job_id}) — Ctrl+C でキャンセル")
+
+    stream_url = f"{API_BASE}/{ENDPOINT_ID}/stream/{job_id}"
+    deadline = time.time() + timeout
+    output = None
+    try:
+        while True:
+            response = session.get(stream_url, timeout=60)
+            response.raise_for_status()
+            stream_data = response.json()
+            for item in stream_data.get('stream', []):
+                event = item.get('output', item) if isinstance(item, dict) else item
+                if not isinstance(event, dict):
+                    continue
+                event_type = event.get('type')
+                if event_type == 'progress':
+                    print(f"\r   [{event['stage']} {event['stage_index']}/{event['num_stages']}] "
+                          f"{event['step']}/{event['total_steps']} ステップ, 残り約 {event['eta_s']:.0f}秒   ", end="", flush=True)
+                elif event_type == 'preview':
+                    suffix = f"_{event['index']}" if event.get('index') else ""
+                    with open(f"{output_basename}_preview{suffix}.jpg", "wb") as f:
+                        f.write(base64.b64decode(event['image']))
+                elif event_type == 'status':
+                    print(f"   {event.get('message', '')}")
+                else:
+                    output = event
+
+            status = stream_data.get('status')
+            if status == 'COMPLETED':
+                break
+            if status not in ['IN_PROGRESS', 'IN_QUEUE', None]:
+                raise RuntimeError(f"ジョブ{status}: {stream_data.get('error', stream_data)}")
+            if time.time() > deadline:
+                raise TimeoutError(f"{timeout:.0f}秒以内に完了しませんでした (ID: {job_id})")
+            time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        print("\n🛑 キャンセルを送信中...")
+        session.post(f"{API_BASE}/{ENDPOINT_ID}/cancel/{job_id}", timeout=30)
+        print(f"✓ ジョブをキャンセルしました (ID: {job_id})")
+        raise
+    print()
+
+    if output is None:
+        # ストリームで結果を取りこぼした場合は /status の出力（集約するワーカーの場合）から取り出す
+        output = final_output(poll_job(session, job_id, timeout).get('output'))
+    return job_id, output
+
+def run_job(session, download_session, name, job_input, output_dir, timeout, cache=None, use_cache=True):
+    """1ジョブを /run へ投入し、完了を待って画像を保存する（キャッシュにあればネットワークを使わない）"""
+    start_time = time.time()
+    cache_key = request_cache_key(job_input) if cache is not None else None
+    if cache_key and use_cache:
+        hit = cache.get(cache_key, os.path.join(output_dir, name))
+        if hit is not None:
+            files, output = hit
+            return {"name": name, "job_id": None, "files": files, "elapsed": time.time() - start_time, "output": output, "cached": True}
+
+    response = session.post(f"{API_BASE}/{ENDPOINT_ID}/run", json={"input": job_input}, timeout=120)
+    response.raise_for_status()
+    job_id = response.json()['id']
+
+    status_data = poll_job(session, job_id, timeout)
+    output = final_output(status_data.get('output'))
+    if output is None:
+        # ストリーミングワーカーの結果は /status には含まれない
+        output = fetch_stream_output(session, job_id)
+    if not isinstance(output, dict):
+        raise RuntimeError(f"予期しない出力形式: {type(output)}")
+    if 'error' in output:
+        raise RuntimeError(f"サーバーエラー: {output['error']}")
+
+    entries = output.get('images', [output])
+    files = []
+    for i, entry in enumerate(entries):
+        suffix = f"_{i}" if len(entries) > 1 else ""
+        files.append(save_output_image(entry, os.path.join(output_dir, f"{name}{suffix}"), session=download_session))
+    if cache_key:
+        cache.put(cache_key, files, output)
+    return {"name": name, "job_id": job_id, "files": files, "elapsed": time.time() - start_time, "output": output, "cached": False}
+
+def percentile(values, q):
+    """values の q パーセンタイル（線形補間）"""
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+def summarize_timings(results):
+    """
+    バッチ結果のサーバー計測値（ステージ別 ms）とクライアントの所要時間をパーセンタイルで集計する
+
+    キャッシュから返したジョブは除く。Returns: {ステージ名: {"count", "mean", "p50", "p90", "p99", "max"}}
+    """
+    samples = {}
+    for result in results:
+        if result["cached"]:
+            continue
+        samples.setdefault("client_total", []).append(result["elapsed"] * 1000)
+        output = result["output"]
+        for entry in output.get("images", [output]):
+            for name, value in entry.get("timings", {}).items():
+                if isinstance(value, (int, float)):
+                    samples.setdefault(name, []).append(value)
+        for name, value in output.get("memory", {}).items():
+            if isinstance(value, (int, float)):
+                samples.setdefault(f"memory.{name}", []).append(value)
+
+    return {
+        name: {
+            "count": len(values),
+            "mean": round(sum(values) / len(values), 1),
+            "p50": round(percentile(values, 50), 1),
+            "p90": round(percentile(values, 90), 1),
+            "p99": round(percentile(values, 99), 1),
+            "max": round(max(values), 1),
+        }
+        for name, values in samples.items()
+    }
+
+def print_timing_report(report):
+    print(f"\n{'stage':<24}{'count':>7}{'mean':>10}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}")
+    for name, stats in report.items():
+        print(f"{name:<24}{stats['count']:>7}{stats['mean']:>10.1f}{stats['p50']:>10.1f}"
+              f"{stats['p90']:>10.1f}{stats['p99']:>10.1f}{stats['max']:>10.1f}")
+
+def run_batch(jobs_path, output_dir="outputs", concurrency=8, timeout=1800, use_cache=True):
+    """
+    JSONLのジョブを最大 concurrency 件ずつ並列に処理し、完了したものから画像を保存する
+
+    use_cache=False の場合はキャッシュを参照せずに再生成する（結果はキャッシュに上書きする）。
+
+    Returns:
+        成功したジョブの結果リスト
+    """
+    specs = load_job_specs(jobs_path)
+    os.makedirs(output_dir, exist_ok=True)
+    # 翻訳は投入前にまとめて行う（各ジョブの prepare_job_input はキャッシュから引くだけになる）
+    translate_many([job_input["prompt"] for _, job_input in specs if "prompt" in job_input])
+    print(f"\nバッチ実行: {len(specs)}件 (同時実行: {concurrency}, 出力先: {output_dir})")
+
+    session = create_session(concurrency)
+    download_session = create_session(concurrency, api=False)
+    cache = ResultCache()
+    start_time = time.time()
+    results = []
+    failures = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {
+            executor.submit(
+                run_job, session, download_session, name, prepare_job_input(job_input), output_dir, timeout, cache, use_cache
+            ): name
+            for name, job_input in specs
+        }
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                result = future.result()
+                results.append(result)
+                source = "キャッシュ" if result["cached"] else f"{result['elapsed']:.1f}秒"
+                print(f"✅ [{len(results) + len(failures)}/{len(specs)}] {name}: {', '.join(result['files'])} ({source})")
+            except Exception as e:
+                failures.append((name, e))
+                print(f"❌ [{len(results) + len(failures)}/{len(specs)}] {name}: {type(e).__name__}: {e}")
+
+    elapsed = time.time() - start_time
+    throughput = len(specs) / elapsed if elapsed > 0 else 0.0
+    cached = sum(1 for result in results if result["cached"])
+    print(f"\nバッチ完了: 成功 {len(results)}件 (キャッシュ {cached}件) / 失敗 {len(failures)}件, 合計 {elapsed:.1f}秒 ({throughput:.2f} jobs/秒)")
+
+    # ステージ別の時間（ms）とメモリ（MB）をパーセンタイルで集計
+    report = summarize_timings(results)
+    if report:
+        print_timing_report(report)
+        report_path = os.path.join(output_dir, "timings_report.json")
+        with open(report_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"\n計測レポート: {report_path}")
+    return results
+
 # ==========================================
 # IP-Adapter使用例：参照画像から人物の特徴を抽出
 # ==========================================
 
-def main():
-    url = f"https://api.runpod.ai/v2/{ENDPOINT_ID}/runsync"
+def main(use_cache=True, stream=False):
+    url = f"{API_BASE}/{ENDPOINT_ID}/runsync"
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {API_KEY}"
@@ -97,10 +788,17 @@ worst quality, low quality
             "steps": 28,
             "guidance_scale": 6.0,
             "seed": 42,
+            # "quality": "fast",  # プレビュー向け：LCM-LoRA + 少ステップ（steps / guidance_scale を省略すると高速用の既定値）
+            # "num_images": 4,  # 複数枚生成（シードは seed, seed+1, ... / "seeds": [..] で明示も可）
             "width": 1536,
             "height": 1536,
             "ip_adapter_scale": 0.6,
             "scheduler": "Euler a",
+            "output_format": "png",  # "png" / "jpeg" / "webp"
+            # "output_quality": 90,  # jpeg / webp の品質
+            # "compress_level": 6,  # png の圧縮レベル（0 = 最速）
+            # "delivery": "url",  # ワーカーにRESULT_BUCKETがあれば、base64の代わりにURLで受け取る
+            # "step_timings": True,  # UNetの1ステップごとの時間も timings に含める
             # LoRAの設定（例）
             # "loras": [
             #     {"path": "username/repo-name", "name": "skin", "weight": 0.6},
@@ -113,13 +811,49 @@ worst quality, low quality
     # 参照画像が存在する場合は追加
     if os.path.exists(reference_image_path):
         print(f"📸 参照画像を読み込み: {reference_image_path}")
-        payload["input"]["reference_image"] = encode_image_to_base64(reference_image_path)
+        payload["input"]["reference_image"] = encode_reference_image(reference_image_path)
         print("✓ 参照画像をエンコード完了")
         print(f"   IP-Adapter影響度: {payload['input']['ip_adapter_scale']}")
     else:
         print("⚠️  参照画像が見つかりません。通常のtext-to-imageで生成します。")
         print(f"   参照画像を使う場合: {reference_image_path} に画像を配置してください。")
 
+    # 同じリクエスト（シード固定）の結果がキャッシュにあれば、ネットワークを使わずに返す
+    cache = ResultCache()
+    cache_key = request_cache_key(payload["input"])
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    prefix = "animagine_ip" if "reference_image" in payload["input"] else "animagine"
+    if cache_key and use_cache:
+        hit = cache.get(cache_key, f"output_{prefix}_{timestamp}")
+        if hit is not None:
+            files, output = hit
+            for filename, entry in zip(files, output.get('images', [output])):
+                print(f"\n✅ キャッシュから画像を保存: {filename}")
+                print(f"   シード: {entry.get('seed', 'N/A')}")
+            print("   （再生成する場合は --no-cache を指定）")
+            return
+
+    if stream:
+        # /stream で進捗とプレビューを受け取る（ワーカー側は STREAMING=1 が必要）
+        payload["input"].setdefault("preview_every", 5)
+        print("\nリクエスト送信中（ストリーミング）...")
+        start_time = time.time()
+        session = create_session(1)
+        _, output = stream_job(session, payload["input"], f"output_{prefix}_{timestamp}")
+        if not isinstance(output, dict) or 'error' in output:
+            print(f"❌ サーバーエラー: {output.get('error') if isinstance(output, dict) else output}")
+            return
+        entries = output.get('images', [output])
+        saved_files = []
+        for i, entry in enumerate(entries):
+            suffix = f"_{i}" if len(entries) > 1 else ""
+            saved_files.append(save_output_image(entry, f"output_{prefix}_{timestamp}{suffix}", session=create_session(1, api=False)))
+            print(f"✅ 画像保存完了: {saved_files[-1]} (シード: {entry.get('seed', 'N/A')})")
+        print(f"   合計時間: {time.time() - start_time:.2f}秒")
+        if cache_key:
+            cache.put(cache_key, saved_files, output)
+        return
+
     print("\nリクエスト送信中...")
     start_time = time.time()
 
@@ -152,7 +886,7 @@ worst quality, low quality
                 print(f"⏳ ジョブ{current_status}... (ID: {job_id})")
                 print(f"   ステータスを確認しています...")
                 
-                status_url = f"https://api.runpod.ai/v2/{ENDPOINT_ID}/status/{job_id}"
+                status_url = f"{API_BASE}/{ENDPOINT_ID}/status/{job_id}"
                 max_retries = 60  # 最大60回（約10分）
                 retry_interval = 10  # 10秒ごと
                 
@@ -181,7 +915,10 @@ worst quality, low quality
             
             # 結果を処理
             if 'output' in response_data:
-                output = response_data['output']
+                output = final_output(response_data['output'])
+                if output is None and response_data.get('id'):
+                    # ストリーミングワーカーの結果は /stream から取り出す
+                    output = fetch_stream_output(create_session(1), response_data['id'])
                 
                 # outputが辞書であることを確認
                 if not isinstance(output, dict):
@@ -192,25 +929,32 @@ worst quality, low quality
                     print(json.dumps(response_data, indent=2, ensure_ascii=False))
                 elif 'error' in output:
                     print(f"❌ サーバーエラー: {output['error']}")
-                elif 'image' in output:
-                    img_base64 = output['image']
-                    
-                    # タイムスタンプ付きファイル名を生成
-                    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                    prefix = "animagine_ip" if "reference_image" in payload["input"] else "animagine"
-                    output_filename = f"output_{prefix}_{timestamp}.png"
-                    
-                    # 画像保存
-                    image = Image.open(BytesIO(base64.b64decode(img_base64)))
-                    image.save(output_filename)
+                elif 'image' in output or 'image_url' in output or 'images' in output:
+                    # タイムスタンプ付きファイル名（拡張子はサーバーの出力形式に合わせる）
+                    # 複数枚の場合は images 配列、1枚の場合はトップレベルに画像が入っている
+                    entries = output.get('images', [output])
+                    saved_files = []
+                    for i, entry in enumerate(entries):
+                        suffix = f"_{i}" if len(entries) > 1 else ""
+                        output_filename = f"output_{prefix}_{timestamp}{suffix}"
+                        output_filename = save_output_image(entry, output_filename)
+                        saved_files.append(output_filename)
+                        print(f"\n✅ 画像保存完了: {output_filename}")
+                        print(f"   シード: {entry.get('seed', 'N/A')}")
+                        print(f"   形式: {entry.get('format', 'png')} ({entry.get('encoded_bytes', 0) / 1024 / 1024:.2f} MB)")
                     
-                    print(f"\n✅ 画像保存完了: {output_filename}")
                     print(f"   プロンプト: {output.get('prompt', 'N/A')[:80]}...")
                     print(f"   サイズ: {output.get('width', 'N/A')}x{output.get('height', 'N/A')}")
                     print(f"   ステップ数: {output.get('steps', 'N/A')}")
+                    if 'timings' in output:
+                        stages = {name: value for name, value in output['timings'].items() if name != 'steps'}
+                        print(f"   計測 (ms): {stages}")
                     
                     if "reference_image" in payload["input"]:
                         print(f"   参照画像使用: はい (影響度: {payload['input']['ip_adapter_scale']})")
+
+                    if cache_key:
+                        cache.put(cache_key, saved_files, output)
                 else:
                     print("⚠️  予期せぬレスポンス形式:")
                     print(f"   型: {type(output)}")
@@ -230,5 +974,27 @@ worst quality, low quality
         print("\n詳細なトレースバック:")
         traceback.print_exc()
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="RunPod SDXLワーカーのクライアント")
+    parser.add_argument("--batch", metavar="JOBS_JSONL", help="JSONLのジョブ定義を /run で並列実行する")
+    parser.add_argument("--output-dir", default="outputs", help="バッチモードの画像保存先")
+    parser.add_argument("--concurrency", type=int, default=8, help="バッチモードの同時実行ジョブ数")
+    parser.add_argument("--timeout", type=float, default=1800, help="1ジョブあたりのタイムアウト（秒）")
+    parser.add_argument("--no-cache", action="store_true", help="結果キャッシュを参照せずに再生成する")
+    parser.add_argument("--stream", action="store_true",
+                        help="/stream で進捗とプレビューを受け取る（ワーカーの STREAMING=1 が必要。Ctrl+C でキャンセル）")
+    parser.add_argument("--translator", default=TRANSLATION_BACKEND,
+                        help="翻訳バックエンド: google / none / module:callable（list[str] -> list[str]）")
+    return parser.parse_args()
+
 if __name__ == "__main__":
-    main()
+    args = parse_args()
+    set_translation_backend(args.translator)
+    if args.batch:
+        run_batch(args.batch, output_dir=args.output_dir, concurrency=args.concurrency, timeout=args.timeout,
+                  use_cache=not args.no_cache)
+    else:
+        try:
+            main(use_cache=not args.no_cache, stream=args.stream)
+        except KeyboardInterrupt:
+            sys.exit(130)
@@ -1,65 +1,896 @@
+import os
 import torch
+import diffusers
 from diffusers import StableDiffusionXLPipeline, StableDiffusionXLImg2ImgPipeline, AutoencoderKL, DPMSolverMultistepScheduler
+from diffusers.models.attention_processor import AttnProcessor, AttnProcessor2_0
+from diffusers import (
+    DDIMScheduler,
+    EulerAncestralDiscreteScheduler,
+    EulerDiscreteScheduler,
+    LCMScheduler,
+    UniPCMultistepScheduler,
+    UNet2DConditionModel,
+)
 from diffusers.utils import load_image
+from huggingface_hub import hf_hub_download, snapshot_download
+from transformers import CLIPTextModel, CLIPTextModelWithProjection, CLIPTokenizer
 import runpod
 import io
+import json
 import base64
+import hashlib
 import sys
+import math
+import time
+import queue
+import random
+import asyncio
+import threading
 import traceback
+import concurrent.futures
+from collections import OrderedDict
+from contextlib import contextmanager
 from PIL import Image
+from model_store import ModelStore, ModelStoreError, load_manifest
 
-print("=" * 60)
-print("RunPod Serverless Worker - Initialization Started")
-print("=" * 60)
-
+# 結果のアップロード用（オプション）
 try:
-    # デバイスの自動検出
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    print(f"✓ Device: {device}")
-    
-    if device == "cuda":
-        print(f"  GPU: {torch.cuda.get_device_name(0)}")
-        print(f"  CUDA Version: {torch.version.cuda}")
-        print(f"  Memory: {torch.cuda.get_device_properties(0).total_memory / 1024**3:.1f} GB")
-    
-    # モデルの初期化（グローバルスコープで1回だけ実行）
-    print("\n[1/3] Loading VAE...")
-    vae = AutoencoderKL.from_pretrained(
-        "madebyollin/sdxl-vae-fp16-fix", 
-        torch_dtype=torch.float16
-    )
-    print("✓ VAE loaded")
-    
-    print("\n[2/3] Loading SDXL pipeline (this may take a few minutes)...")
-    pipe = StableDiffusionXLPipeline.from_pretrained(
-        "SG161222/RealVisXL_V5.0",
-        vae=vae,
-        torch_dtype=torch.float16,
-        variant="fp16",
-        use_safetensors=True
-    )
-    print("✓ Pipeline loaded (RealVisXL V5.0)")
-    
-    # NegativeXL Embeddingのロード
-    print("\n[2.5/3] Loading NegativeXL Embedding...")
-    try:
-        pipe.load_textual_inversion(
-            "gsdf/Counterfeit-XL",
-            weight_name="negativeXL_D.safetensors",
-            token="negativeXL_D"
+    import boto3
+    BOTO3_AVAILABLE = True
+except ImportError:
+    BOTO3_AVAILABLE = False
+
+
+# ==========================================
+# LoRAアダプターのキャッシュ（ジョブ間で常駐させる）
+# ==========================================
+LORA_CACHE_MAX_ADAPTERS = int(os.getenv("LORA_CACHE_MAX_ADAPTERS", "8"))  # 0 = 無制限
+LORA_CACHE_MAX_MB = float(os.getenv("LORA_CACHE_MAX_MB", "0"))  # 0 = 無制限
+
+
+class LoraRegistry:
+    """
+    ロード済みLoRAアダプターのLRUレジストリ
+
+    (path, weight_name) をキーにアダプターをUNet / テキストエンコーダーへ常駐させ、
+    ジョブ間の切り替えは set_adapters だけで行う。個数またはMBの上限を超えた場合は
+    最も長く使われていないアダプターから delete_adapters で解放する。
+    LoRA指定のないジョブでは disable_lora で無効化し、前のジョブの効果が残らないようにする。
+    """
+
+    def __init__(self, pipeline, max_adapters=8, max_bytes=0):
+        self.pipeline = pipeline
+        self.max_adapters = max_adapters
+        self.max_bytes = max_bytes
+        self._adapters = OrderedDict()  # (path, weight_name) -> {"adapter_name", "bytes", "label", "text_encoder"}
+        self._active = None  # 直近で set_adapters した (names, weights)。None = 無効化中
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(lora):
+        return (lora.get("path", ""), lora.get("weight_name"))
+
+    @staticmethod
+    def _adapter_name(key):
+        # ユーザー指定のnameはジョブ間で衝突し得るため、内部名はキーから導出する
+        digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()[:12]
+        return f"lora_{digest}"
+
+    def _components(self):
+        for attr in ("unet", "text_encoder", "text_encoder_2"):
+            component = getattr(self.pipeline, attr, None)
+            if component is not None:
+                yield component
+
+    def _adapter_footprint(self, adapter_name):
+        """アダプターのパラメーター総バイト数と、テキストエンコーダーにも載っているかを返す"""
+        marker = f".{adapter_name}."
+        total = 0
+        affects_text_encoder = False
+        for component in self._components():
+            for name, param in component.named_parameters():
+                if marker in name:
+                    total += param.numel() * param.element_size()
+                    if component is not self.pipeline.unet:
+                        affects_text_encoder = True
+        return total, affects_text_encoder
+
+    def _resident_bytes(self):
+        return sum(entry["bytes"] for entry in self._adapters.values())
+
+    def _over_budget(self):
+        if self.max_adapters and len(self._adapters) > self.max_adapters:
+            return True
+        if self.max_bytes and self._resident_bytes() > self.max_bytes:
+            return True
+        return False
+
+    def _ensure_loaded(self, key, label):
+        entry = self._adapters.get(key)
+        if entry is not None:
+            self._adapters.move_to_end(key)
+            self.hits += 1
+            print(f"  ✓ {label} (cached)")
+            return entry["adapter_name"]
+
+        self.misses += 1
+        path, weight_name = key
+        adapter_name = self._adapter_name(key)
+        load_kwargs = {"adapter_name": adapter_name}
+        if weight_name:
+            load_kwargs["weight_name"] = weight_name
+
+        print(f"  Loading {label} from {path}...")
+        try:
+            self.pipeline.load_lora_weights(local_model_path(path), **load_kwargs)
+        except Exception:
+            # 途中まで注入されたレイヤーが残らないように片付ける
+            try:
+                self.pipeline.delete_adapters(adapter_name)
+            except Exception:
+                pass
+            raise
+
+        size, affects_text_encoder = self._adapter_footprint(adapter_name)
+        self._adapters[key] = {
+            "adapter_name": adapter_name,
+            "bytes": size,
+            "label": label,
+            "text_encoder": affects_text_encoder,
+        }
+        print(f"  ✓ {label} loaded ({size / 1024**2:.1f} MB)")
+        return adapter_name
+
+    def _evict(self, keep):
+        while self._over_budget():
+            victim = next(
+                (key for key, entry in self._adapters.items() if entry["adapter_name"] not in keep),
+                None,
+            )
+            if victim is None:
+                break
+            entry = self._adapters.pop(victim)
+            self.pipeline.delete_adapters(entry["adapter_name"])
+            if self._active is not None and entry["adapter_name"] in self._active[0]:
+                self._active = None
+            print(f"  ✓ Evicted LoRA {entry['label']} ({entry['bytes'] / 1024**2:.1f} MB)")
+
+    def activate(self, loras):
+        """
+        ジョブのLoRA指定を有効化する
+
+        読み込みに失敗したLoRAは警告して飛ばす。ただし "required" が真のもの（fast モードの蒸留LoRAなど、
+        無いと設定が成り立たないもの）は例外を送出し、ジョブを失敗させる。
+
+        Returns:
+            (adapter_names, adapter_weights): 有効化したアダプターの内部名と重み
+        """
+        adapter_names = []
+        adapter_weights = []
+        for i, lora in enumerate(loras):
+            label = lora.get("name", f"lora_{i}")
+            key = self.make_key(lora)
+            try:
+                adapter_name = self._ensure_loaded(key, label)
+            except Exception as e:
+                if lora.get("required"):
+                    raise RuntimeError(f"Failed to load required LoRA {label}: {e}") from e
+                print(f"  ⚠️  Failed to load LoRA {label}: {e}")
+                continue
+            if adapter_name in adapter_names:
+                print(f"  ⚠️  LoRA {label} is specified more than once, using the first weight")
+                continue
+            adapter_names.append(adapter_name)
+            adapter_weights.append(lora.get("weight", 1.0))
+
+        self._evict(keep=set(adapter_names))
+
+        if adapter_names:
+            requested = (tuple(adapter_names), tuple(adapter_weights))
+            if requested != self._active:
+                if self._active is None:
+                    self.pipeline.enable_lora()
+                self.pipeline.set_adapters(adapter_names, adapter_weights=adapter_weights)
+                self._active = requested
+        elif self._adapters and self._active is not None:
+            # 前のジョブのLoRAが効いたままにならないよう無効化
+            self.pipeline.disable_lora()
+            self._active = None
+
+        return adapter_names, adapter_weights
+
+    def text_encoder_state(self):
+        """有効なLoRAのうちテキストエンコーダーに作用するもの（プロンプト埋め込みキャッシュのキー用）"""
+        if self._active is None:
+            return ()
+        text_encoder_adapters = {
+            entry["adapter_name"] for entry in self._adapters.values() if entry["text_encoder"]
+        }
+        names, weights = self._active
+        return tuple(
+            (name, weight) for name, weight in zip(names, weights) if name in text_encoder_adapters
         )
-        print("✓ NegativeXL Embedding loaded (trigger: negativeXL_D)")
-    except Exception as e:
-        print(f"⚠️  NegativeXL Embedding could not be loaded: {e}")
-        print("   Continuing without NegativeXL...")
-    
-    # GPUへ転送
-    print("\n[3/3] Moving model to device...")
-    pipe.to(device)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "resident": len(self._adapters),
+            "resident_mb": round(self._resident_bytes() / 1024**2, 1),
+        }
+
+# ==========================================
+# IP-Adapterの常駐管理（ジョブごとのロード/アンロードを避ける）
+# ==========================================
+IP_ADAPTER_PRELOAD = os.getenv("IP_ADAPTER_PRELOAD", "0") == "1"  # 1 = 起動時にロード
+IP_ADAPTER_EMBED_CACHE_SIZE = int(os.getenv("IP_ADAPTER_EMBED_CACHE_SIZE", "32"))
+
+
+class IPAdapterManager:
+    """
+    IP-Adapterと画像エンコーダーを一度だけロードし、ジョブごとに有効/無効を切り替える
+
+    無効化中はUNetのアテンションプロセッサーを通常のものに戻し、encoder_hid_proj を外すことで
+    IP-Adapterを完全にバイパスする（参照画像なしのジョブやImg2Imgステージ用）。
+    参照画像の埋め込みは画像バイト列のハッシュでLRUキャッシュし、同じ参照画像なら
+    画像エンコーダーを実行しない。
+    """
+
+    def __init__(
+        self,
+        pipeline,
+        repo_id="h94/IP-Adapter",
+        subfolder="sdxl_models",
+        weight_name="ip-adapter_sdxl.bin",
+        embed_cache_size=32,
+    ):
+        self.pipeline = pipeline
+        self.repo_id = repo_id
+        self.subfolder = subfolder
+        self.weight_name = weight_name
+        self.embed_cache_size = embed_cache_size
+        self.loaded = False
+        self.active = False
+        self._default_processors = None
+        self._ip_processors = None
+        self._encoder_hid_proj = None
+        self._encoder_hid_dim_type = None
+        self._embeds = OrderedDict()  # (image_sha256, do_cfg) -> [tensor]
+        self.hits = 0
+        self.misses = 0
+
+    def load(self):
+        if self.loaded:
+            return
+        unet = self.pipeline.unet
+        print("Loading IP-Adapter (resident)...")
+        self._default_processors = dict(unet.attn_processors)
+        self.pipeline.load_ip_adapter(self.repo_id, subfolder=self.subfolder, weight_name=self.weight_name)
+        self._ip_processors = dict(unet.attn_processors)
+        self._encoder_hid_proj = unet.encoder_hid_proj
+        self._encoder_hid_dim_type = unet.config.encoder_hid_dim_type
+        self.loaded = True
+        self.active = True
+        # ロード直後はバイパス状態にしておき、必要なジョブでだけ有効化する
+        self.disable()
+        print("✓ IP-Adapter loaded")
+
+    def enable(self, scale):
+        self.load()
+        if not self.active:
+            unet = self.pipeline.unet
+            # set_attn_processor は渡した辞書から要素を取り出して空にするため、毎回コピーを渡す
+            unet.set_attn_processor(dict(self._ip_processors))
+            unet.encoder_hid_proj = self._encoder_hid_proj
+            unet.config.encoder_hid_dim_type = self._encoder_hid_dim_type
+            self.active = True
+        self.pipeline.set_ip_adapter_scale(scale)
+
+    def disable(self):
+        if not self.active:
+            return
+        unet = self.pipeline.unet
+        unet.set_attn_processor(dict(self._default_processors))
+        unet.encoder_hid_proj = None
+        unet.config.encoder_hid_dim_type = None
+        self.active = False
+
+    def image_embeds(self, image_bytes, do_classifier_free_guidance):
+        """参照画像のバイト列から ip_adapter_image_embeds を返す（キャッシュ付き）"""
+        key = (hashlib.sha256(image_bytes).hexdigest(), do_classifier_free_guidance)
+        cached = self._embeds.get(key)
+        if cached is not None:
+            self._embeds.move_to_end(key)
+            self.hits += 1
+            print("✓ Reference image embeddings (cached)")
+            return cached
+
+        self.misses += 1
+        reference_image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+        with torch.inference_mode():
+            embeds = self.pipeline.prepare_ip_adapter_image_embeds(
+                reference_image,
+                None,
+                self.pipeline.device,
+                1,
+                do_classifier_free_guidance,
+            )
+        self._embeds[key] = embeds
+        while len(self._embeds) > self.embed_cache_size:
+            self._embeds.popitem(last=False)
+        print("✓ Reference image encoded")
+        return embeds
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "cached": len(self._embeds)}
+
+
+# ==========================================
+# スケジューラーのレジストリ（ジョブごとに作り直さない）
+# ==========================================
+# スケジューラー名 -> (クラス, from_config に渡す追加設定)
+SCHEDULER_PRESETS = {
+    "Euler": (EulerDiscreteScheduler, {}),
+    "Euler a": (EulerAncestralDiscreteScheduler, {}),
+    "DPM++ 2M": (DPMSolverMultistepScheduler, {"algorithm_type": "dpmsolver++"}),
+    "DPM++ 2M Karras": (DPMSolverMultistepScheduler, {"algorithm_type": "dpmsolver++", "use_karras_sigmas": True}),
+    "DPM++ 2M SDE Karras": (DPMSolverMultistepScheduler, {"algorithm_type": "sde-dpmsolver++", "use_karras_sigmas": True}),
+    "DDIM": (DDIMScheduler, {}),
+    "UniPC": (UniPCMultistepScheduler, {}),
+    "LCM": (LCMScheduler, {}),
+}
+
+
+class SchedulerRegistry:
+    """
+    名前からスケジューラーを引くレジストリ
+
+    すべてのスケジューラーはモデル本来の設定から起動時に一度だけ生成する。
+    ベース用とImg2Img用で別インスタンスを持つため、ステージ間やジョブ間で
+    スケジューラーの内部状態（step_index など）が共有されることはない。
+    "default" はモデル本来のスケジューラーを指す。
+    """
+
+    def __init__(self, default_scheduler, presets=SCHEDULER_PRESETS, num_stages=2):
+        config = default_scheduler.config
+        factories = {"default": (type(default_scheduler), {})}
+        factories.update(presets)
+        self._schedulers = {
+            name: tuple(scheduler_class.from_config(config, **overrides) for _ in range(num_stages))
+            for name, (scheduler_class, overrides) in factories.items()
+        }
+
+    @property
+    def names(self):
+        return list(self._schedulers)
+
+    def apply(self, name, *pipelines):
+        """各パイプラインに、そのステージ専用のスケジューラーを割り当てる"""
+        if name not in self._schedulers:
+            raise ValueError(f"Unknown scheduler '{name}'. Available: {', '.join(self.names)}")
+        for pipeline, scheduler in zip(pipelines, self._schedulers[name]):
+            pipeline.scheduler = scheduler
+
+
+# ==========================================
+# プロンプト埋め込みのキャッシュ（テキストエンコーダーの再計算を避ける）
+# ==========================================
+PROMPT_CACHE_SIZE = int(os.getenv("PROMPT_CACHE_SIZE", "256"))
+
+
+class PromptEmbeddingCache:
+    """
+    text_encoder / text_encoder_2 の出力をテキスト単位でLRUキャッシュする
+
+    プロンプトとネガティブプロンプトは別々のエントリーとして扱うため、
+    ほぼ全ジョブで共通のネガティブプロンプトは一度だけエンコードされる。
+    キーにはテキストエンコーダー側の状態（有効なLoRAとその重み、lora_scale、
+    Textual Inversionで追加されたトークン数）を含めるため、これらが変わると
+    古いエントリーはヒットしなくなる。
+    """
+
+    def __init__(self, pipeline, max_entries=256):
+        self.pipeline = pipeline
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # (text, state) -> (prompt_embeds, pooled_prompt_embeds)
+        self.hits = 0
+        self.misses = 0
+
+    def _text_encoder_state(self, lora_state, lora_scale):
+        tokenizer_sizes = tuple(
+            len(tokenizer)
+            for tokenizer in (self.pipeline.tokenizer, self.pipeline.tokenizer_2)
+            if tokenizer is not None
+        )
+        return (lora_state, lora_scale if lora_state else None, tokenizer_sizes)
+
+    def _get(self, text, state, lora_scale):
+        key = (text, state)
+        cached = self._entries.get(key)
+        if cached is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return cached
+
+        self.misses += 1
+        # CFGなしでエンコードすると、パイプライン内部のネガティブ側のエンコードと同じ結果になる
+        prompt_embeds, _, pooled_prompt_embeds, _ = self.pipeline.encode_prompt(
+            prompt=text,
+            device=self.pipeline.device,
+            num_images_per_prompt=1,
+            do_classifier_free_guidance=False,
+            lora_scale=lora_scale if state[0] else None,
+        )
+        self._entries[key] = (prompt_embeds, pooled_prompt_embeds)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return prompt_embeds, pooled_prompt_embeds
+
+    def encode(self, prompts, negative_prompts, do_classifier_free_guidance, lora_state=(), lora_scale=None):
+        """
+        バッチ分のプロンプトをエンコードし、パイプラインに渡す埋め込みのkwargsを返す
+        """
+        state = self._text_encoder_state(lora_state, lora_scale)
+        with torch.inference_mode():
+            positives = [self._get(text, state, lora_scale) for text in prompts]
+            embeds = {
+                "prompt_embeds": torch.cat([item[0] for item in positives]),
+                "pooled_prompt_embeds": torch.cat([item[1] for item in positives]),
+            }
+            if not do_classifier_free_guidance:
+                return embeds
+
+            negatives = []
+            for text, (prompt_embeds, pooled_prompt_embeds) in zip(negative_prompts, positives):
+                if text is None and self.pipeline.config.force_zeros_for_empty_prompt:
+                    negatives.append((torch.zeros_like(prompt_embeds), torch.zeros_like(pooled_prompt_embeds)))
+                else:
+                    negatives.append(self._get(text or "", state, lora_scale))
+            embeds["negative_prompt_embeds"] = torch.cat([item[0] for item in negatives])
+            embeds["negative_pooled_prompt_embeds"] = torch.cat([item[1] for item in negatives])
+        return embeds
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "cached": len(self._entries)}
+
+
+# ==========================================
+# メモリポリシー（出力解像度と空きメモリからVAEタイリング等を選ぶ）
+# ==========================================
+MEMORY_POLICY = os.getenv("MEMORY_POLICY", "auto")  # auto | performance | low_memory
+VAE_TILING_MIN_PIXELS = int(os.getenv("VAE_TILING_MIN_PIXELS", str(1536 * 1536)))  # これ以上は常にタイリング
+VAE_DECODE_BYTES_PER_PIXEL = int(os.getenv("VAE_DECODE_BYTES_PER_PIXEL", "3000"))  # fp16 VAEデコードの概算
+ATTENTION_SLICING_MAX_FREE_MB = int(os.getenv("ATTENTION_SLICING_MAX_FREE_MB", "2048"))  # 空きがこれ未満ならスライス（SDPAがない場合のみ）
+MEMORY_POLICIES = ("auto", "performance", "low_memory")
+
+
+def select_memory_policy(width, height, batch_size=1, free_bytes=None, mode="auto"):
+    """
+    出力解像度・バッチサイズ・空きデバイスメモリから、適用するメモリ設定を決める
+
+    free_bytes が None（CPUなど）の場合は解像度だけで判断する。
+    アテンションは省メモリが必要な場合でもSDPAを使い（メモリ効率の良いカーネルで注意行列を丸ごと確保しない）、
+    スライスするのはSDPAが使えない場合だけにする。
+
+    Returns:
+        {"vae_tiling", "vae_slicing", "attention_slicing", "attention_backend"}
+    """
+    if mode not in MEMORY_POLICIES:
+        raise ValueError(f"Unknown memory policy '{mode}'. Available: {', '.join(MEMORY_POLICIES)}")
+    has_sdpa = hasattr(torch.nn.functional, "scaled_dot_product_attention")
+    sdpa = "sdpa" if has_sdpa else "default"
+    if mode == "performance":
+        return {"vae_tiling": False, "vae_slicing": False, "attention_slicing": False, "attention_backend": sdpa}
+    if mode == "low_memory":
+        return {
+            "vae_tiling": True,
+            "vae_slicing": True,
+            "attention_slicing": not has_sdpa,
+            "attention_backend": sdpa if has_sdpa else "sliced",
+        }
+
+    pixels = width * height
+    # バッチ時はVAEを1枚ずつ処理し、ピークをバッチサイズに比例させない
+    vae_slicing = batch_size > 1
+    vae_bytes = pixels * VAE_DECODE_BYTES_PER_PIXEL * (1 if vae_slicing else batch_size)
+    vae_tiling = pixels >= VAE_TILING_MIN_PIXELS
+    attention_slicing = False
+    if free_bytes is not None:
+        vae_tiling = vae_tiling or vae_bytes > free_bytes * 0.8
+        attention_slicing = not has_sdpa and free_bytes < ATTENTION_SLICING_MAX_FREE_MB * 1024**2
+    return {
+        "vae_tiling": vae_tiling,
+        "vae_slicing": vae_slicing,
+        "attention_slicing": attention_slicing,
+        "attention_backend": "sliced" if attention_slicing else sdpa,
+    }
+
+
+class MemoryPolicyManager:
+    """
+    select_memory_policy の結果をパイプラインに適用する
+
+    VAEはベース / Img2Imgで共有しているため、一方のパイプラインへの適用で両方に効く。
+    IP-Adapter有効中はアテンションプロセッサーをIP-Adapter用のまま維持する。
+    """
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self._vae_state = {}
+
+    def apply(self, policy, ip_adapter_active=False):
+        if self._vae_state.get("vae_tiling") != policy["vae_tiling"]:
+            if policy["vae_tiling"]:
+                self.pipeline.enable_vae_tiling()
+            else:
+                self.pipeline.disable_vae_tiling()
+        if self._vae_state.get("vae_slicing") != policy["vae_slicing"]:
+            if policy["vae_slicing"]:
+                self.pipeline.enable_vae_slicing()
+            else:
+                self.pipeline.disable_vae_slicing()
+        self._vae_state = {"vae_tiling": policy["vae_tiling"], "vae_slicing": policy["vae_slicing"]}
+
+        if ip_adapter_active:
+            return
+        # IP-Adapterの無効化でプロセッサーが差し替わるため、アテンションは毎回設定し直す
+        unet = self.pipeline.unet
+        backend = policy["attention_backend"]
+        if backend == "sliced":
+            unet.set_attention_slice("auto")
+        elif backend == "sdpa":
+            unet.set_attn_processor(AttnProcessor2_0())
+        else:
+            unet.set_attn_processor(AttnProcessor())
+
+
+def free_device_memory():
+    """デバイスの空きメモリ（バイト）。CUDA以外では None"""
+    if device != "cuda":
+        return None
+    free_bytes, _ = torch.cuda.mem_get_info()
+    return free_bytes
+
+
+# ==========================================
+# マイクロバッチング（互換ジョブを1回のパイプライン呼び出しにまとめる）
+# ==========================================
+# 同時に受け付けるジョブ数。1だと前のジョブのエンコード・返却が終わるまで次のジョブが来ず、
+# encode_pool でのエンコードが次の生成と重ならないため、既定は2にする
+MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY", "2"))
+BATCH_WINDOW_MS = float(os.getenv("BATCH_WINDOW_MS", "50"))  # 後続ジョブを待ち合わせる時間
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "4"))  # 1回のパイプライン呼び出しの最大枚数
+# 別々のジョブを1回の呼び出しにまとめるのは MAX_BATCH_SIZE を明示した場合だけ（UNetのピークメモリが
+# バッチ枚数分増えるため、GPUに合わせて枚数を決めてから有効にする）。未指定時にまとめるのは1ジョブ内の複数枚のみ
+CROSS_JOB_BATCHING = "MAX_BATCH_SIZE" in os.environ
+MAX_BATCH_PIXELS = int(os.getenv("MAX_BATCH_PIXELS", str(4 * 1536 * 1536)))  # 1バッチの出力ピクセル合計の上限
+
+
+class GenerationBatcher:
+    """
+    生成リクエストを短い時間窓で集め、互換性キーが同じものを1回のパイプライン呼び出しで処理する
+
+    GPUを使う処理はすべてこのクラスのワーカースレッド1本で直列に実行されるため、
+    スケジューラーやLoRAなどパイプラインの共有状態がジョブ間で競合しない。
+    結果は submit() が返す Future を通じて各ジョブへ戻される。
+    cross_job=False の場合は submit_many() 1回分（1ジョブ）ずつ処理し、別のジョブとはまとめない。
+    """
+
+    def __init__(self, run_batch, key_fn, window=0.05, max_batch_size=4, max_batch_pixels=0, cross_job=True):
+        self.run_batch = run_batch
+        self.key_fn = key_fn
+        self.window = window
+        self.cross_job = cross_job
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_batch_pixels = max_batch_pixels
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._loop, name="generation-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, request):
+        return self.submit_many([request])[0]
+
+    def submit_many(self, requests):
+        """1ジョブ分の複数リクエストをまとめて投入する（同じ収集タイミングに必ず入る）"""
+        items = [(request, concurrent.futures.Future()) for request in requests]
+        self._queue.put(items)
+        return [future for _, future in items]
+
+    def _collect(self):
+        pending = list(self._queue.get())
+        if not self.cross_job:
+            return pending
+        deadline = time.monotonic() + self.window
+        while len(pending) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout <= 0:
+                    pending.extend(self._queue.get_nowait())
+                else:
+                    pending.extend(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return pending
+
+    def _plan(self, pending):
+        # 到着順を保ったまま互換性キーでグループ化し、枚数・ピクセル上限で分割する
+        groups = OrderedDict()
+        for item in pending:
+            # 不正なリクエストでワーカースレッドが止まらないよう、そのジョブだけを失敗させる
+            try:
+                key = self.key_fn(item[0])
+                hash(key)
+            except Exception as e:
+                if item[1].set_running_or_notify_cancel():
+                    item[1].set_exception(e)
+                continue
+            groups.setdefault(key, []).append(item)
+
+        for items in groups.values():
+            chunk = []
+            chunk_pixels = 0
+            for item in items:
+                pixels = item[0]["width"] * item[0]["height"]
+                over_pixels = self.max_batch_pixels and chunk_pixels + pixels > self.max_batch_pixels
+                if chunk and (len(chunk) >= self.max_batch_size or over_pixels):
+                    yield chunk
+                    chunk = []
+                    chunk_pixels = 0
+                chunk.append(item)
+                chunk_pixels += pixels
+            if chunk:
+                yield chunk
+
+    def _run(self, chunk):
+        # キャンセル済みのジョブはGPUに載せない
+        chunk = [(request, future) for request, future in chunk if future.set_running_or_notify_cancel()]
+        if chunk:
+            self._execute(chunk)
+
+    def _execute(self, chunk):
+        try:
+            results = self.run_batch([request for request, _ in chunk])
+        except GenerationCancelled as e:
+            # キャンセルは失敗ではないので、1件ずつのやり直しもトレースバックの出力もしない
+            print(f"✓ Batch of {len(chunk)} cancelled ({e})")
+            for _, future in chunk:
+                future.set_exception(e)
+            return
+        except Exception as e:
+            if len(chunk) > 1:
+                # 1件のリクエストが原因でも同じバッチの全ジョブが失敗するため、1件ずつやり直して原因のジョブだけを失敗させる
+                print(f"⚠️  Batch of {len(chunk)} failed ({type(e).__name__}: {e}), retrying one by one")
+                for item in chunk:
+                    self._execute([item])
+                return
+            traceback.print_exc()
+            chunk[0][1].set_exception(e)
+            return
+        for (_, future), result in zip(chunk, results):
+            future.set_result(result)
+
+    def _loop(self):
+        while True:
+            try:
+                for chunk in self._plan(self._collect()):
+                    self._run(chunk)
+            except Exception:
+                # 想定外の例外でもスレッドは止めない（後続のジョブが永遠に待たされるため）
+                traceback.print_exc()
+
+
+# ==========================================
+# モデルの初期化（並列ロード + ウォームアップ）
+# ==========================================
+BASE_MODEL_ID = "SG161222/RealVisXL_V5.0"
+VAE_MODEL_ID = "madebyollin/sdxl-vae-fp16-fix"
+NEGATIVE_EMBEDDING_REPO = "gsdf/Counterfeit-XL"
+NEGATIVE_EMBEDDING_FILE = "negativeXL_D.safetensors"
+NEGATIVE_EMBEDDING_TOKEN = "negativeXL_D"
+
+# モデルストア（models.json の全エントリーをビルド時に取得したもの）
+MODEL_STORE = os.getenv("MODEL_STORE")  # 指定時はストアからのみロードし、欠けていれば起動を中止
+MODEL_MANIFEST = os.getenv("MODEL_MANIFEST", os.path.join(os.path.dirname(os.path.abspath(__file__)), "models.json"))
+model_store = None
+
+INIT_WORKERS = int(os.getenv("INIT_WORKERS", "4"))  # 並列ロードのスレッド数
+LOAD_DIRECT_TO_DEVICE = os.getenv("LOAD_DIRECT_TO_DEVICE", "1") == "1"  # safetensorsを直接GPUへロード
+WARMUP = os.getenv("WARMUP", "0") == "1"  # 起動時に小さな生成を1回実行
+WARMUP_STEPS = int(os.getenv("WARMUP_STEPS", "2"))
+
+# デバイスの自動検出
+device = "cuda" if torch.cuda.is_available() else "cpu"
+
+# 起動フェーズごとの所要時間（ms）。最初のジョブの結果にも含める
+INIT_TIMINGS = {}
+_init_timings_reported = False
+
+
+def model_path(name, repo_id):
+    """
+    マニフェストのエントリー名からロード元を返す
+
+    モデルストア使用時はローカルのスナップショットディレクトリ、未使用時は Hub のリポジトリID。
+    ベイク済みのコンポーネントはローカルパスからロードするため Hub へはアクセスしない
+    （HF_HUB_OFFLINE はプロセス全体に効き、ジョブで指定された Hub の LoRA まで読めなくなるので設定しない）。
+    """
+    if model_store is None:
+        return repo_id
+    return model_store.resolve(name)
+
+
+def local_model_path(name_or_repo_id):
+    """LoRAなどジョブで指定されたパスが、ストアにあればローカルパスに置き換える"""
+    if model_store is None:
+        return name_or_repo_id
+    return model_store.find(name_or_repo_id) or name_or_repo_id
+
+
+# from_pretrained はプロセス全体の状態を一時的に書き換えて戻す（transformers の torch.set_default_dtype、
+# accelerate の init_empty_weights による nn.Module.register_parameter の差し替え）。並列に呼ぶと戻し方が
+# 競合し、既定dtypeがfp16のまま・register_parameter が差し替わったままになり得るため、構築は1つずつ行う
+_model_construction_lock = threading.Lock()
+_lock_wait = threading.local()  # スレッドごとの、直近の _timed_load 中にロック待ちした秒数
+
+READ_AHEAD_CHUNK_BYTES = 16 * 1024 * 1024
+
+
+def _construct_model(model_class, *args, **kwargs):
+    wait_start = time.perf_counter()
+    with _model_construction_lock:
+        _lock_wait.seconds = getattr(_lock_wait, "seconds", 0.0) + time.perf_counter() - wait_start
+        return model_class.from_pretrained(*args, **kwargs)
+
+
+def read_ahead_weights(path, subfolder=None, variant=None):
+    """
+    重みファイルを読み捨ててページキャッシュに載せ、path をそのまま返す
+
+    ディスクからの読み込みはロックの外で並列に行い、ロック内の from_pretrained はメモリからの展開だけにする。
+    path がローカルディレクトリでない（Hub のリポジトリIDの）場合は何もしない。
+    """
+    directory = os.path.join(path, subfolder) if subfolder else path
+    if not os.path.isdir(directory):
+        return path
+    suffix = f".{variant}.safetensors" if variant else ".safetensors"
+    buffer = bytearray(READ_AHEAD_CHUNK_BYTES)
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith(suffix):
+            continue
+        with open(os.path.join(directory, filename), "rb", buffering=0) as f:
+            while f.readinto(buffer):
+                pass
+    return path
+
+
+def prefetch_model_files(name, repo_id, prefix=None):
+    """
+    マニフェストのエントリーのファイルを取得し、from_pretrained に渡すローカルパスを返す
+
+    ストア使用時はスナップショットをそのまま返す。未使用時は Hub からキャッシュへダウンロードする
+    （prefix を指定するとそのサブフォルダーとトップレベルのファイルだけ）。ダウンロードは並列に実行してよい。
+    """
+    if model_store is not None:
+        return model_path(name, repo_id)
+    try:
+        entry = load_manifest(MODEL_MANIFEST)["models"][name]
+    except (OSError, KeyError, ValueError, ModelStoreError):
+        return repo_id
+    patterns = entry["files"]
+    if prefix is not None:
+        patterns = [pattern for pattern in patterns if pattern.startswith(prefix) or "/" not in pattern]
+    return snapshot_download(repo_id, revision=entry.get("revision", "main"), allow_patterns=patterns)
+
+
+def _timed_load(name, load_fn):
+    """load_fn を実行して所要時間を記録する（構築ロックの待ち時間は含めず、<name>_lock_wait に分けて記録）"""
+    _lock_wait.seconds = 0.0
+    start = time.perf_counter()
+    component = load_fn()
+    wait = _lock_wait.seconds
+    INIT_TIMINGS[name] = round((time.perf_counter() - start - wait) * 1000, 1)
+    if wait:
+        INIT_TIMINGS[f"{name}_lock_wait"] = round(wait * 1000, 1)
+    waited = f", waited {wait:.1f}s for construction lock" if wait else ""
+    print(f"✓ {name} loaded ({INIT_TIMINGS[name] / 1000:.1f}s{waited})")
+    return component
+
+
+def load_pipeline():
+    """
+    SDXLパイプラインの各コンポーネントをスレッドで並列にロードして組み立てる
+
+    VAE / UNet / テキストエンコーダー / トークナイザー / NegativeXL埋め込みのファイル取得と重みの読み込み
+    （read_ahead_weights）は並列に行い、モデルの構築（from_pretrained）は _model_construction_lock で1つずつ行う。
+    トークナイザーとスケジューラーはプロセス全体の状態に触れないため、ロックの外で構築する。
+    CUDAでは LOAD_DIRECT_TO_DEVICE により safetensorsをCPUを経由せず直接GPUへ展開する。
+    """
+    def base_files(prefix):
+        return prefetch_model_files("base", BASE_MODEL_ID, prefix)
+
+    dtype = torch.float16
+    device_kwargs = {"device_map": {"": device}} if LOAD_DIRECT_TO_DEVICE and device == "cuda" else {}
+    weight_kwargs = {"torch_dtype": dtype, "variant": "fp16", "use_safetensors": True, **device_kwargs}
+
+    def load_scheduler():
+        config = StableDiffusionXLPipeline.load_config(base_files("scheduler/"), subfolder="scheduler")
+        return getattr(diffusers, config["_class_name"]).from_config(config)
+
+    def load_negative_embedding():
+        if model_store is not None:
+            return os.path.join(model_path("negative_embedding", NEGATIVE_EMBEDDING_REPO), NEGATIVE_EMBEDDING_FILE)
+        return hf_hub_download(NEGATIVE_EMBEDDING_REPO, NEGATIVE_EMBEDDING_FILE)
+
+    def weight_files(subfolder):
+        return read_ahead_weights(base_files(f"{subfolder}/"), subfolder, variant="fp16")
+
+    loaders = {
+        "vae": lambda: _construct_model(
+            AutoencoderKL, read_ahead_weights(prefetch_model_files("vae", VAE_MODEL_ID)), torch_dtype=dtype,
+            **device_kwargs,
+        ),
+        "unet": lambda: _construct_model(
+            UNet2DConditionModel, weight_files("unet"), subfolder="unet", **weight_kwargs
+        ),
+        "text_encoder": lambda: _construct_model(
+            CLIPTextModel, weight_files("text_encoder"), subfolder="text_encoder", **weight_kwargs
+        ),
+        "text_encoder_2": lambda: _construct_model(
+            CLIPTextModelWithProjection, weight_files("text_encoder_2"), subfolder="text_encoder_2", **weight_kwargs
+        ),
+        "tokenizer": lambda: CLIPTokenizer.from_pretrained(base_files("tokenizer/"), subfolder="tokenizer"),
+        "tokenizer_2": lambda: CLIPTokenizer.from_pretrained(base_files("tokenizer_2/"), subfolder="tokenizer_2"),
+        "scheduler": load_scheduler,
+        "negative_embedding": load_negative_embedding,
+    }
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=INIT_WORKERS) as executor:
+        futures = {name: executor.submit(_timed_load, name, fn) for name, fn in loaders.items()}
+        # 埋め込みの取得失敗は致命的ではないので、他のコンポーネントとは分けて扱う
+        components = {name: future.result() for name, future in futures.items() if name != "negative_embedding"}
+        try:
+            negative_embedding_path = futures["negative_embedding"].result()
+        except Exception as e:
+            print(f"⚠️  NegativeXL Embedding could not be downloaded: {e}")
+            negative_embedding_path = None
+
+    start = time.perf_counter()
+    base_pipe = StableDiffusionXLPipeline(**components)
+    INIT_TIMINGS["assemble"] = round((time.perf_counter() - start) * 1000, 1)
+    print("✓ Pipeline assembled (RealVisXL V5.0)")
+
+    # NegativeXL Embeddingのロード
+    if negative_embedding_path is not None:
+        start = time.perf_counter()
+        try:
+            base_pipe.load_textual_inversion(negative_embedding_path, token=NEGATIVE_EMBEDDING_TOKEN)
+            print(f"✓ NegativeXL Embedding loaded (trigger: {NEGATIVE_EMBEDDING_TOKEN})")
+        except Exception as e:
+            print(f"⚠️  NegativeXL Embedding could not be loaded: {e}")
+            print("   Continuing without NegativeXL...")
+        INIT_TIMINGS["textual_inversion"] = round((time.perf_counter() - start) * 1000, 1)
+
+    # GPUへ転送（直接ロード済みのコンポーネントでは何もしない）
+    start = time.perf_counter()
+    base_pipe.to(device)
+    INIT_TIMINGS["to_device"] = round((time.perf_counter() - start) * 1000, 1)
     print(f"✓ Model moved to {device}")
+    return base_pipe
+
+
+def setup_pipelines(base_pipe):
+    """
+    ロード済みのベースパイプラインから Img2Img パイプラインと各種キャッシュを組み立て、
+    ハンドラーが参照するグローバル変数に設定する
+
+    ベンチマークなどでは小さなパイプラインを渡して同じ経路を使える。
+    """
+    global pipe, img2img_pipe, scheduler_registry, lora_registry, memory_manager, prompt_cache, ip_adapter
+
+    pipe = base_pipe
     
-    # Img2Imgパイプラインも初期化
-    print("\n[3.5/4] Loading Img2Img pipeline...")
+    # Img2Imgパイプライン（コンポーネントはすべてベースと共有）
     img2img_pipe = StableDiffusionXLImg2ImgPipeline(
         vae=pipe.vae,
         text_encoder=pipe.text_encoder,
@@ -70,231 +901,1230 @@ try:
         scheduler=pipe.scheduler,
     )
     img2img_pipe.to(device)
-    print("✓ Img2Img pipeline loaded")
+    print("✓ Img2Img pipeline ready")
+    
+    # スケジューラーレジストリ（モデル本来の設定から一度だけ生成）
+    scheduler_registry = SchedulerRegistry(pipe.scheduler)
+    print(f"✓ Schedulers: {', '.join(scheduler_registry.names)}")
+    
+    # LoRAレジストリ（img2img_pipeとUNet / テキストエンコーダーを共有）
+    lora_registry = LoraRegistry(
+        pipe,
+        max_adapters=LORA_CACHE_MAX_ADAPTERS,
+        max_bytes=int(LORA_CACHE_MAX_MB * 1024**2),
+    )
     
-    # 商用利用向け：見えない透かし（invisible-watermark）を無効化
-    if hasattr(pipe, "watermark"):
-        pipe.watermark = None
-        print("✓ Watermark disabled")
+    # 商用利用向け：見えない透かし（invisible-watermark）を無効化（最終出力はどちらのステージにもなり得る）
+    for pipeline in (pipe, img2img_pipe):
+        if hasattr(pipeline, "watermark"):
+            pipeline.watermark = None
+    print("✓ Watermark disabled")
     
-    # IP-Adapterは必要な時のみロード（初期化時はロードしない）
-    print("\n✓ IP-Adapter: Will load on-demand when reference image is provided")
+    # メモリポリシー（ジョブごとにVAEタイリング / アテンション方式を切り替える）
+    memory_manager = MemoryPolicyManager(pipe)
     
-    print("\n" + "=" * 60)
-    print("✓ Model initialization completed successfully!")
-    print("=" * 60 + "\n")
+    # プロンプト埋め込みキャッシュ（ベース / Img2Imgの両ステージで共有）
+    prompt_cache = PromptEmbeddingCache(pipe, max_entries=PROMPT_CACHE_SIZE)
     
-except Exception as e:
-    print("\n" + "=" * 60)
-    print("❌ ERROR during initialization:")
+    # IP-Adapter（ロード後は常駐させ、ジョブごとに有効/無効を切り替える）
+    ip_adapter = IPAdapterManager(
+        pipe,
+        repo_id=model_path("ip_adapter", "h94/IP-Adapter"),
+        embed_cache_size=IP_ADAPTER_EMBED_CACHE_SIZE,
+    )
+    if IP_ADAPTER_PRELOAD:
+        print("Preloading IP-Adapter...")
+        ip_adapter.load()
+    else:
+        print("✓ IP-Adapter: Will load on first use and stay resident")
+
+
+def warmup():
+    """小さな生成を1回実行し、CUDAカーネルやアロケーターの初回コストを起動時に払っておく"""
+    request = parse_request({
+        "prompt": "warmup",
+        "steps": WARMUP_STEPS,
+        "seed": 0,
+        "plan": {"refine": False},
+    })
+    generate_batch([request])
+
+
+def initialize():
+    """モデルの初期化（プロセス起動時に1回だけ実行）。失敗した場合はプロセスを終了する"""
+    global model_store
+
     print("=" * 60)
-    print(f"Error type: {type(e).__name__}")
-    print(f"Error message: {str(e)}")
-    print("\nFull traceback:")
-    traceback.print_exc()
+    print("RunPod Serverless Worker - Initialization Started")
     print("=" * 60)
-    sys.exit(1)
-
 
-def handler(job):
-    """
-    RunPod Serverless ハンドラー関数
-    
-    入力形式:
-    {
-        "input": {
-            "prompt": "a beautiful landscape",
-            "negative_prompt": "low quality",
-            "steps": 30,
-            "guidance_scale": 7.5,
-            "seed": 42
-        }
-    }
-    """
+    init_start = time.perf_counter()
     try:
-        # ジョブ入力の取得
-        job_input = job["input"]
-        job_id = job.get("id", "unknown")
+        print(f"✓ Device: {device}")
         
-        print(f"\n{'='*60}")
-        print(f"Processing Job: {job_id}")
-        print(f"{'='*60}")
+        if device == "cuda":
+            print(f"  GPU: {torch.cuda.get_device_name(0)}")
+            print(f"  CUDA Version: {torch.version.cuda}")
+            print(f"  Memory: {torch.cuda.get_device_properties(0).total_memory / 1024**3:.1f} GB")
         
-        # パラメータの取得（デフォルト値あり）
-        prompt = job_input.get("prompt", "a simple landscape")
-        negative_prompt = job_input.get("negative_prompt", "negativeXL_D, low quality, blurry")
-        steps = job_input.get("steps", 30)
-        cfg_scale = job_input.get("guidance_scale", 7.5)
-        seed = job_input.get("seed", None)
-        width = job_input.get("width", 1024)
-        height = job_input.get("height", 1024)
-        reference_image_b64 = job_input.get("reference_image", None)
-        ip_adapter_scale = job_input.get("ip_adapter_scale", 0.6)
-        scheduler_type = job_input.get("scheduler", "default")
-        loras = job_input.get("loras", [])  # [{"path": "...", "name": "...", "weight": 0.8}, ...]
-        lora_scale = job_input.get("lora_scale", 1.0)  # 全体の効き具合
+        # ベイク済みストアを使う場合は、ロードを始める前に欠けているファイルがないか確認する
+        if MODEL_STORE:
+            start = time.perf_counter()
+            model_store = ModelStore(MODEL_STORE)
+            model_store.verify(load_manifest(MODEL_MANIFEST))
+            INIT_TIMINGS["verify_store"] = round((time.perf_counter() - start) * 1000, 1)
+            print(f"✓ Model store verified: {MODEL_STORE}")
         
-        print(f"Prompt: {prompt[:100]}...")
-        print(f"Size: {width}x{height}, Steps: {steps}, CFG: {cfg_scale}")
-        print(f"Scheduler: {scheduler_type}")
-        if loras:
-            print(f"LoRAs: {len(loras)} loaded, global scale: {lora_scale}")
+        print(f"\n[1/3] Loading model components in parallel ({INIT_WORKERS} workers)...")
+        base_pipe = load_pipeline()
         
-        # スケジューラーの設定
-        if scheduler_type == "DPM++ 2M Karras":
-            pipe.scheduler = DPMSolverMultistepScheduler.from_config(
-                pipe.scheduler.config,
-                use_karras_sigmas=True,
-                algorithm_type="dpmsolver++"
-            )
-            img2img_pipe.scheduler = pipe.scheduler
-            print("✓ Scheduler set to DPM++ 2M Karras")
+        print("\n[2/3] Setting up pipelines...")
+        start = time.perf_counter()
+        setup_pipelines(base_pipe)
+        INIT_TIMINGS["setup"] = round((time.perf_counter() - start) * 1000, 1)
         
-        # バリデーション
-        if not prompt:
-            return {"error": "Input is missing the 'prompt' key. Please include a prompt."}
+        if WARMUP:
+            print(f"\n[3/3] Running warmup generation ({WARMUP_STEPS} steps)...")
+            start = time.perf_counter()
+            warmup()
+            INIT_TIMINGS["warmup"] = round((time.perf_counter() - start) * 1000, 1)
+        else:
+            print("\n[3/3] Warmup skipped (set WARMUP=1 to enable)")
         
-        # 参照画像の処理（IP-Adapter用）
-        reference_image = None
-        if reference_image_b64:
-            try:
-                print("Decoding reference image...")
-                img_data = base64.b64decode(reference_image_b64)
-                reference_image = Image.open(io.BytesIO(img_data)).convert("RGB")
-                
-                # IP-Adapterをロード
-                print("Loading IP-Adapter for reference image...")
-                pipe.load_ip_adapter(
-                    "h94/IP-Adapter",
-                    subfolder="sdxl_models",
-                    weight_name="ip-adapter_sdxl.bin"
-                )
-                pipe.set_ip_adapter_scale(ip_adapter_scale)
-                print(f"✓ Reference image loaded (IP-Adapter scale: {ip_adapter_scale})")
-            except Exception as e:
-                print(f"⚠️  Failed to load reference image or IP-Adapter: {e}")
-                reference_image = None
+        INIT_TIMINGS["total"] = round((time.perf_counter() - init_start) * 1000, 1)
+        print(json.dumps({"event": "init_timings", "timings_ms": INIT_TIMINGS}))
         
-        # LoRAのロードと設定
-        adapter_names = []
-        adapter_weights = []
-        if loras:
-            print(f"\nLoading {len(loras)} LoRA(s)...")
-            for i, lora in enumerate(loras):
-                try:
-                    lora_path = lora.get("path", "")
-                    lora_name = lora.get("name", f"lora_{i}")
-                    lora_weight = lora.get("weight", 1.0)
-                    
-                    print(f"  [{i+1}/{len(loras)}] Loading {lora_name} (weight: {lora_weight})...")
-                    pipe.load_lora_weights(lora_path, adapter_name=lora_name)
-                    adapter_names.append(lora_name)
-                    adapter_weights.append(lora_weight)
-                    print(f"  ✓ {lora_name} loaded")
-                except Exception as e:
-                    print(f"  ⚠️  Failed to load LoRA {lora.get('name', 'unknown')}: {e}")
-            
-            if adapter_names:
-                pipe.set_adapters(adapter_names, adapter_weights=adapter_weights)
-                print(f"✓ {len(adapter_names)} LoRA(s) activated")
+        print("\n" + "=" * 60)
+        print(f"✓ Model initialization completed successfully! ({INIT_TIMINGS['total'] / 1000:.1f}s)")
+        print("=" * 60 + "\n")
         
-        # シード値の設定（再現性のため）
-        generator = None
-        if seed is not None:
-            generator = torch.Generator(device=device).manual_seed(seed)
-            print(f"Seed: {seed}")
-        
-        # 進捗更新
-        mode = "IP-Adapter generation" if reference_image else "Text-to-image generation"
-        runpod.serverless.progress_update(job, f"{mode}...")
-        print(f"Starting {mode}...")
-        
-        # 画像生成実行: Step 1 - 1024pxで生成
-        print("Step 1/3: Generating 1024px base image...")
-        with torch.inference_mode():
-            generation_kwargs = {
-                "prompt": prompt,
-                "negative_prompt": negative_prompt,
-                "num_inference_steps": steps,
-                "guidance_scale": cfg_scale,
-                "width": 1024,
-                "height": 1024,
-                "generator": generator,
+    except Exception as e:
+        print("\n" + "=" * 60)
+        print("❌ ERROR during initialization:")
+        print("=" * 60)
+        print(f"Error type: {type(e).__name__}")
+        print(f"Error message: {str(e)}")
+        print("\nFull traceback:")
+        traceback.print_exc()
+        print("=" * 60)
+        sys.exit(1)
+
+
+# ==========================================
+# 出力画像のエンコード（GPUスレッドとは別のスレッドプールで実行）
+# ==========================================
+# エンコード中もGPUスレッドは次のバッチへ進める。ただし次のジョブが届いているのは
+# MAX_CONCURRENCY >= 2 の場合だけなので、1にするとエンコードと生成は重ならない
+OUTPUT_FORMATS = {"png": "PNG", "jpeg": "JPEG", "webp": "WEBP"}
+ENCODE_WORKERS = int(os.getenv("ENCODE_WORKERS", "2"))
+WEBP_METHOD = int(os.getenv("WEBP_METHOD", "4"))  # 0（高速）〜 6（高圧縮）
+
+encode_pool = concurrent.futures.ThreadPoolExecutor(max_workers=ENCODE_WORKERS, thread_name_prefix="encode")
+
+
+def parse_output_options(job_input):
+    """出力形式の指定を検証して正規化する。不正な場合は ValueError"""
+    output_format = str(job_input.get("output_format", "png")).lower()
+    if output_format == "jpg":
+        output_format = "jpeg"
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output_format '{output_format}'. Available: {', '.join(OUTPUT_FORMATS)}")
+    quality = job_input.get("output_quality", 90)  # jpeg / webp
+    compress_level = job_input.get("compress_level", 6)  # png（0 = 無圧縮・最速）
+    if not isinstance(quality, int) or not 1 <= quality <= 100:
+        raise ValueError(f"output_quality must be an integer in [1, 100] (got {quality})")
+    if not isinstance(compress_level, int) or not 0 <= compress_level <= 9:
+        raise ValueError(f"compress_level must be an integer in [0, 9] (got {compress_level})")
+    return {"format": output_format, "quality": quality, "compress_level": compress_level}
+
+
+def encode_image(image, options):
+    """
+    画像を指定形式でエンコードし、(バイト列, 所要時間ms) を返す
+
+    スレッドプールから呼ばれるため、次のジョブのUNet処理と並行して実行される。
+    """
+    start = time.perf_counter()
+    save_kwargs = {}
+    if options["format"] == "png":
+        save_kwargs["compress_level"] = options["compress_level"]
+    else:
+        save_kwargs["quality"] = options["quality"]
+        if options["format"] == "webp":
+            save_kwargs["method"] = WEBP_METHOD
+    buffered = io.BytesIO()
+    image.save(buffered, format=OUTPUT_FORMATS[options["format"]], **save_kwargs)
+    return buffered.getvalue(), round((time.perf_counter() - start) * 1000, 1)
+
+
+# ==========================================
+# 結果の返却先（S3互換ストレージへアップロードしてURLを返す）
+# ==========================================
+RESULT_BUCKET = os.getenv("RESULT_BUCKET")  # 未指定ならアップロード不可（base64のみ）
+RESULT_S3_ENDPOINT_URL = os.getenv("RESULT_S3_ENDPOINT_URL")  # MinIOなどS3互換サーバーのURL
+RESULT_PREFIX = os.getenv("RESULT_PREFIX", "results/")
+RESULT_URL_EXPIRES = int(os.getenv("RESULT_URL_EXPIRES", "3600"))  # 署名付きURLの有効期限（秒）
+RESULT_DELIVERY = os.getenv("RESULT_DELIVERY", "base64")  # 既定の返却方法: base64 | url
+DELIVERY_MODES = ("base64", "url")
+
+
+class S3ResultSink:
+    """
+    エンコード済みの画像をS3互換バケットへアップロードし、署名付きURLを発行する
+
+    client を渡せば任意のS3互換クライアント（ローカルのスタブサーバー向けなど）を使える。
+    """
+
+    def __init__(self, bucket, endpoint_url=None, prefix="results/", expires=3600, client=None):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.expires = expires
+        self.client = client or boto3.client("s3", endpoint_url=endpoint_url)
+
+    def key_for(self, job_id, index, output_format):
+        extension = "jpg" if output_format == "jpeg" else output_format
+        return f"{self.prefix}{job_id}/{index}.{extension}"
+
+    def upload(self, data, key, output_format):
+        """バイト列をストリーミングでアップロードし、{"image_key", "image_url"} を返す"""
+        self.client.upload_fileobj(
+            io.BytesIO(data),
+            self.bucket,
+            key,
+            ExtraArgs={"ContentType": f"image/{output_format}"},
+        )
+        url = self.client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": self.bucket, "Key": key},
+            ExpiresIn=self.expires,
+        )
+        return {"image_key": key, "image_url": url}
+
+
+result_sink = None
+if RESULT_BUCKET:
+    if BOTO3_AVAILABLE:
+        result_sink = S3ResultSink(
+            RESULT_BUCKET,
+            endpoint_url=RESULT_S3_ENDPOINT_URL,
+            prefix=RESULT_PREFIX,
+            expires=RESULT_URL_EXPIRES,
+        )
+    else:
+        print("⚠️  RESULT_BUCKET is set but boto3 is not installed. Results will be returned as base64.")
+
+
+def parse_delivery(job_input):
+    """結果の返却方法（"base64" | "url"）を検証する。不正な場合は ValueError"""
+    delivery = job_input.get("delivery", RESULT_DELIVERY)
+    if delivery not in DELIVERY_MODES:
+        raise ValueError(f"Unknown delivery '{delivery}'. Available: {', '.join(DELIVERY_MODES)}")
+    if delivery == "url" and result_sink is None:
+        raise ValueError("delivery 'url' requires RESULT_BUCKET (and boto3) to be configured on the worker")
+    return delivery
+
+
+def encode_output(image, options, delivery, job_id, index=0):
+    """
+    画像をエンコードし、返却方法に応じてbase64化またはアップロードする（スレッドプールで実行）
+
+    Returns:
+        出力に含めるフィールド（"image" または "image_url" / "image_key"）と
+        "format" / "encoded_bytes"、および所要時間(ms)
+    """
+    encoded, encode_ms = encode_image(image, options)
+    fields = {"format": options["format"], "encoded_bytes": len(encoded)}
+    start = time.perf_counter()
+    if delivery == "url":
+        key = result_sink.key_for(job_id, index, options["format"])
+        fields.update(result_sink.upload(encoded, key, options["format"]))
+        timings = {"encode": encode_ms, "upload": round((time.perf_counter() - start) * 1000, 1)}
+    else:
+        fields["image"] = base64.b64encode(encoded).decode("utf-8")
+        timings = {"encode": encode_ms, "base64": round((time.perf_counter() - start) * 1000, 1)}
+    return fields, timings
+
+
+DEFAULT_NEGATIVE_PROMPT = "negativeXL_D, low quality, blurry"
+QUALITY_MODES = ("standard", "fast")
+# quality: "fast" — 少ステップ蒸留LoRA（LCM-LoRA）+ 対応スケジューラーでプレビュー向けに高速生成する
+FAST_LORA_PATH = os.getenv("FAST_LORA_PATH", "latent-consistency/lcm-lora-sdxl")  # ストアにあればローカルを使う
+FAST_LORA_WEIGHT_NAME = os.getenv("FAST_LORA_WEIGHT_NAME", "pytorch_lora_weights.safetensors")
+FAST_LORA_WEIGHT = float(os.getenv("FAST_LORA_WEIGHT", "1.0"))
+FAST_SCHEDULER = os.getenv("FAST_SCHEDULER", "LCM")
+FAST_STEPS = int(os.getenv("FAST_STEPS", "6"))
+FAST_GUIDANCE_SCALE = float(os.getenv("FAST_GUIDANCE_SCALE", "1.5"))
+FAST_REFINE = os.getenv("FAST_REFINE", "0") == "1"  # 既定ではImg2Imgの仕上げを省略する
+UPSCALE_MODES = ("pixel", "latent")
+MAX_NUM_IMAGES = int(os.getenv("MAX_NUM_IMAGES", "8"))  # 1ジョブで生成できる最大枚数
+LATENT_UPSCALE_METHOD = os.getenv("LATENT_UPSCALE_METHOD", "bicubic")
+# 参照画像はIP-Adapterの画像エンコーダーで224pxに縮小されるため、大きな画像を受け取る意味はない
+REFERENCE_IMAGE_MAX_BYTES = int(float(os.getenv("REFERENCE_IMAGE_MAX_MB", "8")) * 1024**2)
+REFERENCE_IMAGE_MAX_PIXELS = int(os.getenv("REFERENCE_IMAGE_MAX_PIXELS", str(4096 * 4096)))
+REFERENCE_IMAGE_FORMATS = ("PNG", "JPEG", "WEBP")
+
+
+STEP_TIMINGS = os.getenv("STEP_TIMINGS", "0") == "1"  # UNetの1ステップごとの時間を記録（毎ステップGPU同期する）
+LOG_JSON = os.getenv("LOG_JSON", "0") == "1"  # ジョブごとの計測値を1行のJSONログとしても出力
+
+
+def log_event(event, **fields):
+    """LOG_JSON=1 のとき、集計しやすい1行のJSONログを出力する"""
+    if LOG_JSON:
+        print(json.dumps({"event": event, "time": round(time.time(), 3), **fields}, ensure_ascii=False, default=str))
+
+
+def peak_rss_mb():
+    """プロセスの最大常駐メモリ（MB）。取得できない環境では None"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / 1024**2 if sys.platform == "darwin" else peak / 1024, 1)
+
+
+class StageTimer:
+    """
+    生成処理のステージごとの時間（ms）を記録する
+
+    stage() はGPUの非同期実行を待ってから時間を確定する。同じ名前のステージは加算される。
+    step_callback() をパイプラインの callback_on_step_end に渡すと、最後のステップの終了時刻から
+    ステージをデノイズ（"<name>_denoise"）とVAEデコードなどの後処理（"<name>_decode"）に分け、
+    per_step=True なら各ステップの時間も "steps" に記録する（最初のステップには前処理を含む）。
+    """
+
+    def __init__(self, sync=False):
+        self.sync = sync
+        self.timings = {}
+        self.steps = {}
+        self._stage_start = {}
+        self._last_step = {}
+
+    def _now(self):
+        if self.sync:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        self._stage_start[name] = start
+        try:
+            yield
+        finally:
+            end = self._now()
+            self.record(name, (end - start) * 1000)
+            last_step = self._last_step.pop(name, None)
+            if last_step is not None:
+                self.record(f"{name}_denoise", (last_step - start) * 1000)
+                self.record(f"{name}_decode", (end - last_step) * 1000)
+
+    def record(self, name, ms):
+        self.timings[name] = round(self.timings.get(name, 0.0) + ms, 1)
+
+    def step_callback(self, name, per_step=False):
+        """ステップの終了時刻を記録する callback_on_step_end 用の関数を返す"""
+        step_times = self.steps.setdefault(name, []) if per_step else None
+
+        def callback(pipeline, step_index, timestep, callback_kwargs):
+            # 毎ステップ同期するのは per_step のときだけ（通常は最後のステップだけ待つ）
+            if per_step or step_index == pipeline.num_timesteps - 1:
+                now = self._now()
+                if per_step:
+                    previous = self._last_step.get(name, self._stage_start[name])
+                    step_times.append(round((now - previous) * 1000, 1))
+                self._last_step[name] = now
+            return callback_kwargs
+
+        return callback
+
+    def result(self):
+        timings = dict(self.timings)
+        if self.steps:
+            timings["steps"] = {name: list(times) for name, times in self.steps.items()}
+        return timings
+
+
+# ==========================================
+# 進捗通知・プレビュー・キャンセル（パイプラインのステップコールバック経由）
+# ==========================================
+STREAMING = os.getenv("STREAMING", "0") == "1"  # ジェネレーター型ハンドラーで進捗とプレビューを /stream に流す
+PREVIEW_EVERY = int(os.getenv("PREVIEW_EVERY", "0"))  # プレビューを送るステップ間隔（0 = 送らない。ジョブの preview_every が優先）
+PREVIEW_MAX_SIDE = int(os.getenv("PREVIEW_MAX_SIDE", "256"))
+PREVIEW_QUALITY = int(os.getenv("PREVIEW_QUALITY", "70"))
+PROGRESS_UPDATE_INTERVAL = float(os.getenv("PROGRESS_UPDATE_INTERVAL", "1.0"))  # 非ストリーミング時の progress_update の最小間隔（秒）
+
+# SDXLのlatent（4ch）からRGBへの線形近似。VAEデコードなしで数msのプレビューを作る
+SDXL_LATENT_RGB_FACTORS = [
+    [0.3651, 0.4232, 0.4341],
+    [-0.2533, -0.0042, 0.1068],
+    [0.1076, 0.1111, -0.0362],
+    [-0.3165, -0.2492, -0.2188],
+]
+SDXL_LATENT_RGB_BIAS = [0.1084, -0.0175, -0.0011]
+
+
+class GenerationCancelled(Exception):
+    """バッチ内のすべてのジョブがキャンセルされ、生成を途中で打ち切った"""
+
+
+class JobProgress:
+    """
+    1ジョブ分の進捗の送り先とキャンセルフラグ
+
+    GPUスレッドのステップコールバックから publish() され、イベントループ側へ渡す。
+    ストリーミング時はイベント（状態 / 進捗 / プレビュー）をキューに積み、ハンドラーが yield する。
+    非ストリーミング時はプレビューを除き、進捗は間引いて runpod.serverless.progress_update で送る。
+    """
+
+    def __init__(self, job, loop, stream=False, preview_every=0):
+        self.job = job
+        self.loop = loop
+        self.stream = stream
+        self.preview_every = preview_every if stream else 0
+        self.events = asyncio.Queue() if stream else None
+        self._cancelled = threading.Event()
+        self._last_update = 0.0
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def publish(self, event):
+        if self.stream:
+            self.loop.call_soon_threadsafe(self.events.put_nowait, event)
+            return
+        if event["type"] == "preview":
+            return
+        if event["type"] == "progress":
+            now = time.monotonic()
+            if now - self._last_update < PROGRESS_UPDATE_INTERVAL and event["step"] != event["total_steps"]:
+                return
+            self._last_update = now
+        self.loop.call_soon_threadsafe(runpod.serverless.progress_update, self.job, event)
+
+
+def latents_to_preview(latents):
+    """latent 1枚分（4, h, w）をRGBに近似し、小さなJPEGのbase64にする"""
+    factors = torch.tensor(SDXL_LATENT_RGB_FACTORS, dtype=torch.float32, device=latents.device)
+    bias = torch.tensor(SDXL_LATENT_RGB_BIAS, dtype=torch.float32, device=latents.device)
+    rgb = latents.float().permute(1, 2, 0) @ factors + bias
+    rgb = ((rgb + 1.0) / 2.0).clamp(0, 1).mul(255).to(torch.uint8).cpu().numpy()
+    image = Image.fromarray(rgb)
+    if max(image.size) > PREVIEW_MAX_SIDE:
+        image.thumbnail((PREVIEW_MAX_SIDE, PREVIEW_MAX_SIDE))
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=PREVIEW_QUALITY)
+    return base64.b64encode(buffer.getvalue()).decode("utf-8")
+
+
+class BatchProgress:
+    """
+    バッチ内の各ジョブへステップごとの進捗（ステージ、ステップ / 総数、ETA）とプレビューを配る
+
+    ETAはここまでの平均ステップ時間 x 残りステップ数（後続ステージの予定ステップを含む）。
+    バッチ内の全ジョブがキャンセルされた場合はパイプラインに中断を指示する。
+    """
+
+    def __init__(self, requests, planned_steps):
+        self.planned_steps = max(planned_steps, 1)
+        self.done_steps = 0
+        self.start = time.perf_counter()
+        # 同じジョブ（複数枚）のリクエストは1つの JobProgress を共有する
+        self.jobs = OrderedDict()
+        self.cancellable = True
+        for index, request in enumerate(requests):
+            progress = request.get("progress")
+            if progress is None:
+                self.cancellable = False
+                continue
+            self.jobs.setdefault(id(progress), (progress, []))[1].append(index)
+
+    @property
+    def cancelled(self):
+        return self.cancellable and bool(self.jobs) and all(progress.cancelled for progress, _ in self.jobs.values())
+
+    def check_cancelled(self):
+        if self.cancelled:
+            raise GenerationCancelled("all jobs in the batch were cancelled")
+
+    def step_callback(self, stage, stage_index, num_stages, inner=None):
+        """callback_on_step_end 用の関数を返す（inner は StageTimer などのコールバック）"""
+
+        def callback(pipeline, step_index, timestep, callback_kwargs):
+            if inner is not None:
+                callback_kwargs = inner(pipeline, step_index, timestep, callback_kwargs)
+            if not self.jobs:
+                return callback_kwargs
+
+            now = time.perf_counter()
+            self.done_steps += 1
+            average = (now - self.start) / self.done_steps
+            step = step_index + 1
+            total_steps = pipeline.num_timesteps
+            event = {
+                "type": "progress",
+                "stage": stage,
+                "stage_index": stage_index,
+                "num_stages": num_stages,
+                "step": step,
+                "total_steps": total_steps,
+                "eta_s": round(average * max(self.planned_steps - self.done_steps, 0), 1),
             }
-            
-            # LoRAのスケールを設定
-            if adapter_names:
-                generation_kwargs["cross_attention_kwargs"] = {"scale": lora_scale}
-            
-            # 参照画像がある場合はIP-Adapterを使用
-            if reference_image:
-                generation_kwargs["ip_adapter_image"] = reference_image
-            
-            base_image = pipe(**generation_kwargs).images[0]
+            latents = callback_kwargs.get("latents")
+            for progress, indices in self.jobs.values():
+                progress.publish(event)
+                preview_due = progress.preview_every and (step % progress.preview_every == 0 or step == total_steps)
+                if preview_due and latents is not None and not progress.cancelled:
+                    for image_index, batch_index in enumerate(indices):
+                        progress.publish({
+                            "type": "preview",
+                            "stage": stage,
+                            "step": step,
+                            "index": image_index,
+                            "format": "jpeg",
+                            "image": latents_to_preview(latents[batch_index]),
+                        })
+
+            if self.cancelled:
+                # 残りのステップはパイプライン側で読み飛ばされる
+                pipeline._interrupt = True
+            return callback_kwargs
+
+        return callback
+
+
+def upscale_latents(latents, width, height, vae_scale_factor):
+    """ベース出力のlatentを目標サイズ相当へ補間する（VAEデコード / 再エンコードを省略）"""
+    size = (height // vae_scale_factor, width // vae_scale_factor)
+    if tuple(latents.shape[-2:]) == size:
+        return latents
+    # CPUのfp16では bicubic が使えないため、float32で補間してから戻す
+    upscaled = torch.nn.functional.interpolate(latents.float(), size=size, mode=LATENT_UPSCALE_METHOD)
+    return upscaled.to(latents.dtype)
+
+
+# SDXLの学習時アスペクト比バケット (width, height)
+SDXL_BUCKETS = [
+    (1024, 1024),
+    (1152, 896), (896, 1152),
+    (1216, 832), (832, 1216),
+    (1344, 768), (768, 1344),
+    (1536, 640), (640, 1536),
+]
+BUCKET_ASPECT_TOLERANCE = 0.02  # バケットのアスペクト比との許容誤差（相対）
+DEFAULT_REFINE_STRENGTH = 0.3
+
+
+def nearest_bucket(width, height):
+    """目標サイズのアスペクト比に最も近いSDXLバケットを返す"""
+    aspect = width / height
+    return min(SDXL_BUCKETS, key=lambda bucket: abs(math.log((bucket[0] / bucket[1]) / aspect)))
+
+
+def resolve_stage_plan(plan, width, height, steps):
+    """
+    ジョブ入力の "plan" を検証し、実行するステージ構成を決める
+
+    plan:
+        base_width / base_height: ベース生成の解像度（既定: 目標のアスペクト比に最も近いバケット）
+        refine: true / false / "auto"（既定。ベースと目標サイズが異なる場合のみImg2Imgを実行）
+        refine_strength: Img2Imgのstrength（既定: 0.3）
+        refine_steps: Img2Imgの num_inference_steps（既定: steps）。実際のステップ数は約 strength 倍
+
+    不正な指定の場合は ValueError を送出する。
+    """
+    plan = plan or {}
+    for name, value in (("width", width), ("height", height)):
+        if not isinstance(value, int) or value <= 0 or value % 8:
+            raise ValueError(f"'{name}' must be a positive multiple of 8 (got {value})")
+
+    bucket = nearest_bucket(width, height)
+    base_width = plan.get("base_width", bucket[0])
+    base_height = plan.get("base_height", bucket[1])
+    for name, value in (("base_width", base_width), ("base_height", base_height)):
+        if not isinstance(value, int) or value <= 0 or value % 8:
+            raise ValueError(f"plan.{name} must be a positive multiple of 8 (got {value})")
+    aspect = base_width / base_height
+    if not any(abs((w / h) / aspect - 1) <= BUCKET_ASPECT_TOLERANCE for w, h in SDXL_BUCKETS):
+        ratios = ", ".join(f"{w}x{h}" for w, h in SDXL_BUCKETS)
+        raise ValueError(
+            f"plan base resolution {base_width}x{base_height} does not match an SDXL aspect-ratio bucket ({ratios})"
+        )
+
+    refine = plan.get("refine", "auto")
+    if refine == "auto":
+        refine = (base_width, base_height) != (width, height)
+    elif not isinstance(refine, bool):
+        raise ValueError(f"plan.refine must be true, false or \"auto\" (got {refine!r})")
+
+    refine_strength = plan.get("refine_strength", DEFAULT_REFINE_STRENGTH)
+    refine_steps = plan.get("refine_steps", steps)
+    if refine:
+        if not 0 < refine_strength <= 1:
+            raise ValueError(f"plan.refine_strength must be in (0, 1] (got {refine_strength})")
+        if not isinstance(refine_steps, int) or int(refine_steps * refine_strength) < 1:
+            raise ValueError(
+                f"plan.refine_steps x refine_strength must give at least one step "
+                f"(got {refine_steps} x {refine_strength})"
+            )
+
+    return {
+        "base_width": base_width,
+        "base_height": base_height,
+        "refine": refine,
+        "refine_strength": refine_strength if refine else None,
+        "refine_steps": refine_steps if refine else None,
+    }
+
+
+def decode_reference_image(reference_image_b64):
+    """
+    base64の参照画像をデコードし、検証済みのバイト列を返す（なければ None）
+
+    サイズはデコード前にbase64の長さで判定し、大きすぎるものはデコードせずに拒否する。
+    形式（PNG / JPEG / WebP）と画素数はヘッダーだけを読んで確認する。不正な場合は ValueError。
+    """
+    if not reference_image_b64:
+        return None
+    if not isinstance(reference_image_b64, str):
+        raise ValueError("reference_image must be a base64 string")
+    if reference_image_b64.startswith("data:"):
+        reference_image_b64 = reference_image_b64.partition(",")[2]
+
+    max_mb = REFERENCE_IMAGE_MAX_BYTES / 1024**2
+    if len(reference_image_b64) * 3 // 4 > REFERENCE_IMAGE_MAX_BYTES:
+        raise ValueError(f"reference_image is too large (limit {max_mb:.1f} MB; resize it to ~224px before sending)")
+    print("Decoding reference image...")
+    try:
+        reference_image = base64.b64decode(reference_image_b64, validate=True)
+    except ValueError as e:
+        raise ValueError(f"reference_image is not valid base64: {e}")
+    if len(reference_image) > REFERENCE_IMAGE_MAX_BYTES:
+        raise ValueError(f"reference_image is too large (limit {max_mb:.1f} MB; resize it to ~224px before sending)")
+
+    try:
+        with Image.open(io.BytesIO(reference_image)) as image:
+            image_format, (width, height) = image.format, image.size
+            if image_format in REFERENCE_IMAGE_FORMATS and width * height <= REFERENCE_IMAGE_MAX_PIXELS:
+                image.verify()
+    except Exception as e:
+        raise ValueError(f"reference_image could not be decoded: {e}")
+    if image_format not in REFERENCE_IMAGE_FORMATS:
+        raise ValueError(f"reference_image format {image_format} is not supported. Available: {', '.join(REFERENCE_IMAGE_FORMATS)}")
+    if width * height > REFERENCE_IMAGE_MAX_PIXELS:
+        raise ValueError(f"reference_image is {width}x{height}; at most {REFERENCE_IMAGE_MAX_PIXELS} pixels are allowed")
+    print(f"✓ Reference image: {image_format} {width}x{height} ({len(reference_image) / 1024:.1f} KB)")
+    return reference_image
+
+
+def _number_input(job_input, name, default):
+    """数値パラメータを取り出す（bool・文字列・リストなどは ValueError）"""
+    value = job_input.get(name, default)
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError(f"'{name}' must be a number (got {value!r})")
+    return value
+
+
+SEED_LIMIT = 2**64  # torch.Generator.manual_seed が受け付けるシードは [0, 2**64)
+
+
+def _is_seed(value):
+    return isinstance(value, int) and not isinstance(value, bool) and 0 <= value < SEED_LIMIT
+
+
+def parse_loras(loras):
+    """
+    "loras" を検証する。各要素は {"path": 文字列, "weight": 数値, "weight_name": 文字列(任意), "name": 文字列(任意)}
+
+    不正な場合は ValueError（バッチャーの互換性キーや LoraRegistry がそのまま扱える形だけを通す）。
+    """
+    if not isinstance(loras, list):
+        raise ValueError(f"'loras' must be a list (got {type(loras).__name__})")
+    for i, lora in enumerate(loras):
+        if not isinstance(lora, dict):
+            raise ValueError(f"loras[{i}] must be an object with 'path' (got {lora!r})")
+        if not isinstance(lora.get("path"), str) or not lora["path"]:
+            raise ValueError(f"loras[{i}].path must be a non-empty string")
+        weight = lora.get("weight", 1.0)
+        if isinstance(weight, bool) or not isinstance(weight, (int, float)):
+            raise ValueError(f"loras[{i}].weight must be a number (got {weight!r})")
+        for key in ("weight_name", "name"):
+            if lora.get(key) is not None and not isinstance(lora[key], str):
+                raise ValueError(f"loras[{i}].{key} must be a string")
+    return list(loras)
+
+
+def parse_request(job_input):
+    """
+    ジョブ入力を検証し、生成リクエスト（dict）に正規化する
+
+    不正な入力の場合は ValueError を送出する。
+    """
+    # パラメータの取得（デフォルト値あり）
+    prompt = job_input.get("prompt", "a simple landscape")
+    
+    # バリデーション
+    if not prompt:
+        raise ValueError("Input is missing the 'prompt' key. Please include a prompt.")
+    if not isinstance(prompt, str):
+        raise ValueError(f"'prompt' must be a string (got {type(prompt).__name__})")
+    negative_prompt = job_input.get("negative_prompt", DEFAULT_NEGATIVE_PROMPT)
+    if negative_prompt is not None and not isinstance(negative_prompt, str):
+        raise ValueError(f"'negative_prompt' must be a string (got {type(negative_prompt).__name__})")
+    
+    upscale_mode = job_input.get("upscale_mode", "pixel")
+    if upscale_mode not in UPSCALE_MODES:
+        raise ValueError(f"Unknown upscale_mode '{upscale_mode}'. Available: {', '.join(UPSCALE_MODES)}")
+    
+    # fast モードでは既定値（スケジューラー・ステップ数・CFG・仕上げ）が変わる。明示した値はそのまま使う
+    quality = job_input.get("quality", "standard")
+    if quality not in QUALITY_MODES:
+        raise ValueError(f"Unknown quality '{quality}'. Available: {', '.join(QUALITY_MODES)}")
+    fast = quality == "fast"
+    
+    scheduler_type = job_input.get("scheduler", FAST_SCHEDULER if fast else "default")
+    if scheduler_type not in scheduler_registry.names:
+        raise ValueError(
+            f"Unknown scheduler '{scheduler_type}'. Available: {', '.join(scheduler_registry.names)}"
+        )
+    
+    steps = job_input.get("steps", FAST_STEPS if fast else 30)
+    if isinstance(steps, bool) or not isinstance(steps, int) or steps < 1:
+        raise ValueError(f"'steps' must be a positive integer (got {steps!r})")
+    width = job_input.get("width", 1024)
+    height = job_input.get("height", 1024)
+    plan = job_input.get("plan")
+    if plan is not None and not isinstance(plan, dict):
+        raise ValueError(f"'plan' must be an object (got {plan!r})")
+    if fast and not FAST_REFINE:
+        plan = {"refine": False, **(plan or {})}
+    plan = resolve_stage_plan(plan, width, height, steps)
+    
+    # 蒸留LoRAはユーザーのLoRAと併用する（LoraRegistryに常駐し、ジョブ間で再利用される）
+    loras = parse_loras(job_input.get("loras", []))  # [{"path": "...", "name": "...", "weight": 0.8, "weight_name": "(任意)"}, ...]
+    if fast:
+        loras.append({
+            "path": FAST_LORA_PATH,
+            "name": "fast",
+            "weight": FAST_LORA_WEIGHT,
+            "weight_name": FAST_LORA_WEIGHT_NAME or None,
+            "required": True,  # 蒸留LoRA無しで fast の設定（少ステップ・低CFG）を使うと破綻するため
+        })
+    
+    # シード未指定でもバッチ内で個別のGeneratorを使うため、ここで決めておく
+    # 複数枚の場合は seeds で明示するか、seed から seed, seed+1, ... を導出する
+    seed = job_input.get("seed", None)
+    seeds = job_input.get("seeds", None)
+    num_images = job_input.get("num_images", len(seeds) if seeds else 1)
+    if not isinstance(num_images, int) or not 1 <= num_images <= MAX_NUM_IMAGES:
+        raise ValueError(f"num_images must be an integer in [1, {MAX_NUM_IMAGES}] (got {num_images})")
+    if seeds is not None:
+        if not isinstance(seeds, list) or len(seeds) != num_images or not all(_is_seed(x) for x in seeds):
+            raise ValueError(f"seeds must be a list of {num_images} integer(s) in [0, 2**64)")
+    else:
+        if seed is None:
+            seed = random.randrange(2**32)
+        if not _is_seed(seed) or seed + num_images > SEED_LIMIT:
+            raise ValueError(f"seed must be an integer in [0, 2**64 - num_images] (got {seed!r})")
+        seeds = [seed + i for i in range(num_images)]
+    
+    preview_every = job_input.get("preview_every", PREVIEW_EVERY)
+    if not isinstance(preview_every, int) or preview_every < 0:
+        raise ValueError(f"preview_every must be a non-negative integer (got {preview_every})")
+    
+    # 参照画像（IP-Adapter用）はここでデコードと検証だけ行い、埋め込みはGPUスレッドで計算する
+    reference_image = decode_reference_image(job_input.get("reference_image", None))
+    
+    return {
+        "prompt": prompt,
+        "negative_prompt": negative_prompt,
+        "steps": steps,
+        "guidance_scale": _number_input(job_input, "guidance_scale", FAST_GUIDANCE_SCALE if fast else 7.5),
+        "seed": seeds[0],
+        "seeds": seeds,
+        "width": width,
+        "height": height,
+        "plan": plan,
+        "reference_image": reference_image,
+        "ip_adapter_scale": _number_input(job_input, "ip_adapter_scale", 0.6),
+        "scheduler": scheduler_type,
+        "upscale_mode": upscale_mode,  # "pixel"（既定）| "latent"
+        "loras": loras,
+        "quality": quality,  # "standard"（既定）| "fast"
+        "lora_scale": _number_input(job_input, "lora_scale", 1.0),  # 全体の効き具合
+        "step_timings": bool(job_input.get("step_timings", False)),  # UNetのステップごとの時間も返す
+        "preview_every": preview_every,  # ストリーミング時、このステップ間隔でプレビューを送る（0 = 送らない）
+    }
+
+
+def expand_request(request):
+    """複数枚のリクエストを、1枚ずつのリクエスト（シードのみ異なる）に展開する"""
+    return [{**request, "seed": seed} for seed in request["seeds"]]
+
+
+def batch_key(request):
+    """プロンプトとシード以外が同じリクエストは1回のパイプライン呼び出しにまとめられる"""
+    has_reference = request["reference_image"] is not None
+    return (
+        request["width"],
+        request["height"],
+        request["quality"],
+        request["steps"],
+        request["guidance_scale"],
+        request["scheduler"],
+        request["upscale_mode"],
+        tuple(sorted(request["plan"].items())),
+        tuple(
+            (lora.get("path", ""), lora.get("weight_name"), lora.get("weight", 1.0))
+            for lora in request["loras"]
+        ),
+        request["lora_scale"],
+        has_reference,
+        request["ip_adapter_scale"] if has_reference else None,
+    )
+
+
+def _batch_ip_adapter_embeds(per_item_embeds, do_classifier_free_guidance):
+    """
+    リクエストごとの ip_adapter_image_embeds を1つのバッチにまとめる
+
+    CFG有効時の各テンソルは [negative, positive] の順に連結されているため、
+    バッチでも negative をまとめた後に positive を並べる。
+    """
+    combined = []
+    for adapter_index in range(len(per_item_embeds[0])):
+        tensors = [embeds[adapter_index] for embeds in per_item_embeds]
+        if do_classifier_free_guidance:
+            negatives, positives = zip(*(tensor.chunk(2) for tensor in tensors))
+            combined.append(torch.cat([*negatives, *positives]))
+        else:
+            combined.append(torch.cat(tensors))
+    return combined
+
+
+def generate_batch(requests):
+    """
+    互換性のあるリクエスト（batch_key が同一）をまとめて生成する
+
+    プロンプトとシードはリクエストごとに指定し、Generatorもリクエストごとに作るため、
+    シード指定時の出力は1件ずつ生成した場合と同じになる。
+
+    upscale_mode が "latent" の場合、ベース出力をlatentのまま補間してImg2Imgへ渡し、
+    VAEデコード → PILリサイズ → VAEエンコードの往復を省略する。
+
+    Returns:
+        リクエストごとの結果 {"image": PIL画像, "timings": ステージ別時間(ms)} のリスト
+        （requests と同じ順序）
+    """
+    timer = StageTimer(sync=device == "cuda")
+    per_step = STEP_TIMINGS or any(r["step_timings"] for r in requests)
+    batch_start = time.perf_counter()
+    if device == "cuda":
+        torch.cuda.reset_peak_memory_stats()
+    first = requests[0]
+    batch_size = len(requests)
+    steps = first["steps"]
+    cfg_scale = first["guidance_scale"]
+    width = first["width"]
+    height = first["height"]
+    scheduler_type = first["scheduler"]
+    upscale_mode = first["upscale_mode"]
+    loras = first["loras"]
+    lora_scale = first["lora_scale"]
+    
+    print(f"\n{'='*60}")
+    print(f"Processing batch: {batch_size} image(s)")
+    print(f"{'='*60}")
+    print(f"Size: {width}x{height}, Steps: {steps}, CFG: {cfg_scale}")
+    print(f"Quality: {first['quality']}, Scheduler: {scheduler_type}, Upscale: {upscale_mode}")
+    if loras:
+        print(f"LoRAs: {len(loras)} loaded, global scale: {lora_scale}")
+    
+    prepare_start = time.perf_counter()
+    # スケジューラーの設定（ベース / Img2Imgそれぞれに専用インスタンス）
+    with timer.stage("scheduler"):
+        scheduler_registry.apply(scheduler_type, pipe, img2img_pipe)
+    print(f"✓ Scheduler set to {scheduler_type}")
+    
+    # 参照画像の埋め込み（IP-Adapter用）
+    reference_embeds = None
+    if first["reference_image"] is not None:
+        try:
+            with timer.stage("ip_adapter"):
+                # 常駐しているIP-Adapterを有効化（初回のみロード）
+                ip_adapter.enable(first["ip_adapter_scale"])
+                do_cfg = cfg_scale > 1.0
+                reference_embeds = _batch_ip_adapter_embeds(
+                    [ip_adapter.image_embeds(r["reference_image"], do_classifier_free_guidance=do_cfg) for r in requests],
+                    do_classifier_free_guidance=do_cfg,
+                )
+            print(f"✓ Reference image loaded (IP-Adapter scale: {first['ip_adapter_scale']})")
+            print(f"  Embedding cache: {ip_adapter.stats()}")
+        except Exception as e:
+            print(f"⚠️  Failed to load reference image or IP-Adapter: {e}")
+            reference_embeds = None
+    
+    # 参照画像なしのジョブではIP-Adapterをバイパス
+    if reference_embeds is None:
+        ip_adapter.disable()
+    
+    # メモリポリシー（ベース / 目標の大きい方の解像度とバッチサイズから選ぶ）
+    plan = first["plan"]
+    policy = select_memory_policy(
+        max(width, plan["base_width"]),
+        max(height, plan["base_height"]),
+        batch_size=batch_size,
+        free_bytes=free_device_memory(),
+        mode=MEMORY_POLICY,
+    )
+    with timer.stage("memory_policy"):
+        memory_manager.apply(policy, ip_adapter_active=ip_adapter.active)
+    print(f"✓ Memory policy: {policy}")
+    
+    # LoRAの有効化（ロード済みのアダプターはレジストリから再利用）
+    if loras:
+        print(f"\nActivating {len(loras)} LoRA(s)...")
+    with timer.stage("lora"):
+        adapter_names, adapter_weights = lora_registry.activate(loras)
+    if adapter_names:
+        print(f"✓ {len(adapter_names)} LoRA(s) activated")
+    if loras:
+        print(f"  LoRA cache: {lora_registry.stats()}")
+    
+    # シード値の設定（再現性のため、リクエストごとに個別のGenerator）
+    generators = [torch.Generator(device=device).manual_seed(r["seed"]) for r in requests]
+    print(f"Seeds: {[r['seed'] for r in requests]}")
+    
+    # プロンプトはジョブごとに1回だけエンコードし、両ステージで使い回す
+    with timer.stage("text_encode"):
+        prompt_embeds = prompt_cache.encode(
+            [r["prompt"] for r in requests],
+            [r["negative_prompt"] for r in requests],
+            do_classifier_free_guidance=cfg_scale > 1.0,
+            lora_state=lora_registry.text_encoder_state(),
+            lora_scale=lora_scale,
+        )
+    print(f"✓ Prompts encoded (cache: {prompt_cache.stats()})")
+    
+    timer.record("prepare", (time.perf_counter() - prepare_start) * 1000)
+    
+    mode = "IP-Adapter generation" if reference_embeds is not None else "Text-to-image generation"
+    print(f"Starting {mode}...")
+    
+    # ステージ構成（ベースのみ / ベース + リサイズ / ベース + リサイズ + Img2Img）
+    base_width, base_height = plan["base_width"], plan["base_height"]
+    refine = plan["refine"]
+    needs_resize = (base_width, base_height) != (width, height)
+    latent_handoff = refine and upscale_mode == "latent"
+    total_steps = 1 + int(needs_resize or refine) + int(refine)
+    
+    # ステップごとの進捗・プレビュー（Img2Imgの実ステップ数は約 refine_steps x strength）
+    num_stages = 1 + int(refine)
+    refine_planned_steps = int(plan["refine_steps"] * plan["refine_strength"]) if refine else 0
+    progress = BatchProgress(requests, planned_steps=steps + refine_planned_steps)
+    progress.check_cancelled()
+    
+    # 画像生成実行: Step 1 - ベース解像度で生成（latent受け渡し時はVAEデコードしない）
+    print(f"Step 1/{total_steps}: Generating {base_width}x{base_height} base image...")
+    with torch.inference_mode(), timer.stage("base"):
+        generation_kwargs = {
+            **prompt_embeds,
+            "num_inference_steps": steps,
+            "guidance_scale": cfg_scale,
+            "width": base_width,
+            "height": base_height,
+            "generator": generators,
+            "output_type": "latent" if latent_handoff else "pil",
+            "callback_on_step_end": progress.step_callback(
+                "base", 1, num_stages, inner=timer.step_callback("base", per_step=per_step)
+            ),
+        }
         
-        print("✓ Base image generated at 1024x1024")
+        # LoRAのスケールを設定
+        if adapter_names:
+            generation_kwargs["cross_attention_kwargs"] = {"scale": lora_scale}
         
-        # IP-Adapterがロードされている場合はアンロード（Img2Imgと互換性のため）
-        if reference_image:
-            try:
-                pipe.unload_ip_adapter()
-                img2img_pipe.unload_ip_adapter()
-                print("✓ IP-Adapter unloaded before Img2Img")
-            except Exception as e:
-                print(f"⚠️  IP-Adapter unload warning: {e}")
+        # 参照画像がある場合はIP-Adapterを使用（埋め込みはキャッシュ済み）
+        if reference_embeds is not None:
+            generation_kwargs["ip_adapter_image_embeds"] = reference_embeds
         
-        # Step 2 - 目標サイズにリサイズ
-        print(f"Step 2/3: Resizing to {width}x{height}...")
-        resized_image = base_image.resize((width, height), Image.LANCZOS)
+        images = pipe(**generation_kwargs).images
+    
+    progress.check_cancelled()
+    print(f"✓ Base image generated at {base_width}x{base_height}")
+    
+    # Img2ImgステージではIP-Adapterをバイパス（重みは常駐したまま）
+    if reference_embeds is not None:
+        ip_adapter.disable()
+        memory_manager.apply(policy)
+        print("✓ IP-Adapter bypassed for Img2Img")
+    
+    # Step 2 - 目標サイズにリサイズ
+    if needs_resize or latent_handoff:
+        print(f"Step 2/{total_steps}: Resizing to {width}x{height} ({'latent' if latent_handoff else 'pixel'})...")
+        with torch.inference_mode(), timer.stage("upscale"):
+            if latent_handoff:
+                images = upscale_latents(images, width, height, pipe.vae_scale_factor)
+            else:
+                images = [image.resize((width, height), Image.LANCZOS) for image in images]
         print("✓ Image resized")
-        
-        # Step 3 - Img2Img (Strength 0.3)で品質向上
-        print("Step 3/3: Applying Img2Img refinement (strength=0.3)...")
-        with torch.inference_mode():
+    
+    # Step 3 - Img2Imgで品質向上
+    if refine:
+        refine_strength = plan["refine_strength"]
+        print(f"Step {total_steps}/{total_steps}: Applying Img2Img refinement (strength={refine_strength})...")
+        with torch.inference_mode(), timer.stage("refine"):
             img2img_kwargs = {
-                "prompt": prompt,
-                "negative_prompt": negative_prompt,
-                "image": resized_image,
-                "strength": 0.3,
-                "num_inference_steps": steps,
+                **prompt_embeds,
+                "image": images,
+                "strength": refine_strength,
+                "num_inference_steps": plan["refine_steps"],
                 "guidance_scale": cfg_scale,
-                "generator": generator,
+                "generator": generators,
+                "callback_on_step_end": progress.step_callback(
+                    "refine", 2, num_stages, inner=timer.step_callback("refine", per_step=per_step)
+                ),
             }
             
             # LoRAのスケールを設定
             if adapter_names:
                 img2img_kwargs["cross_attention_kwargs"] = {"scale": lora_scale}
             
-            image = img2img_pipe(**img2img_kwargs).images[0]
+            images = img2img_pipe(**img2img_kwargs).images
         
+        progress.check_cancelled()
         print("✓ Image refined with Img2Img")
+    else:
+        print("✓ Refinement skipped by stage plan")
+    
+    timer.record("total", (time.perf_counter() - batch_start) * 1000)
+    timings = timer.result()
+    memory = {
+        "policy": policy,
+        "peak_allocated_mb": (
+            round(torch.cuda.max_memory_allocated() / 1024**2, 1) if device == "cuda" else None
+        ),
+        "peak_reserved_mb": (
+            round(torch.cuda.max_memory_reserved() / 1024**2, 1) if device == "cuda" else None
+        ),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    print(f"  Timings (ms): {timings}")
+    print(f"  Memory: {memory}")
+    return [{"image": image, "timings": dict(timings), "memory": memory} for image in images]
+
+
+async def process_job(job, progress):
+    """
+    1ジョブを処理して出力（dict）を返す。handler() / stream_handler() の本体
+    
+    生成中の進捗とプレビューは progress（JobProgress）へ送られる。
+    待機中にタスクがキャンセルされた場合は、GPU側にもキャンセルを伝えてから CancelledError を送出する。
+    """
+    global _init_timings_reported
+    try:
+        # ジョブ入力の取得
+        job_input = job["input"]
+        job_id = job.get("id", "unknown")
+        job_start = time.perf_counter()
+        
+        print(f"\n{'='*60}")
+        print(f"Processing Job: {job_id}")
+        print(f"{'='*60}")
         
-        # 画像をBase64に変換
-        buffered = io.BytesIO()
-        image.save(buffered, format="PNG")
-        img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
-        img_size_mb = len(img_str) / 1024 / 1024
+        try:
+            request = parse_request(job_input)
+            output_options = parse_output_options(job_input)
+            delivery = parse_delivery(job_input)
+        except ValueError as e:
+            return {"error": str(e)}
         
-        print(f"✓ Image encoded (size: {img_size_mb:.2f} MB)")
+        print(f"Prompt: {request['prompt'][:100]}...")
+        
+        # 進捗更新
+        mode = "IP-Adapter generation" if request["reference_image"] is not None else "Text-to-image generation"
+        progress.preview_every = request["preview_every"] if progress.stream else 0
+        progress.publish({"type": "status", "message": f"{mode}..."})
+        
+        # バッチャー経由で生成（GPU処理はワーカースレッドで実行）
+        # 複数枚のジョブは1枚ずつに展開し、MAX_BATCH_SIZE / MAX_BATCH_PIXELS の範囲でまとめて生成される
+        futures = batcher.submit_many([{**r, "progress": progress} for r in expand_request(request)])
+        try:
+            results = await asyncio.gather(*(asyncio.wrap_future(future) for future in futures))
+        except asyncio.CancelledError:
+            # 未着手ならバッチャーが読み飛ばし、生成中ならステップコールバックで打ち切られる
+            progress.cancel()
+            for future in futures:
+                future.cancel()
+            print(f"✓ Job {job_id} cancelled")
+            raise
+        generated_ms = (time.perf_counter() - job_start) * 1000
+        
+        # 画像をエンコードしてBase64に変換 / アップロード（スレッドプールで実行し、GPUスレッドは次のバッチへ進む）
+        loop = asyncio.get_running_loop()
+        encoded = await asyncio.gather(*(
+            loop.run_in_executor(encode_pool, encode_output, result["image"], output_options, delivery, job_id, index)
+            for index, result in enumerate(results)
+        ))
+        
+        images = []
+        job_ms = round((time.perf_counter() - job_start) * 1000, 1)
+        for seed, result, (image_fields, output_timings) in zip(request["seeds"], results, encoded):
+            # queue: バッチャーでGPUを待っていた時間、job: ハンドラーに入ってからエンコード完了までの時間
+            timings = {
+                **result["timings"],
+                **output_timings,
+                "queue": round(max(generated_ms - result["timings"]["total"], 0.0), 1),
+                "job": job_ms,
+            }
+            images.append({**image_fields, "seed": seed, "timings": timings})
+        total_mb = sum(image["encoded_bytes"] for image in images) / 1024 / 1024
+        
+        print(f"✓ {len(images)} image(s) encoded (job: {job_id}, {output_options['format']}, size: {total_mb:.2f} MB, delivery: {delivery})")
         print(f"{'='*60}\n")
         
-        # 結果を返す
-        return {
-            "image": img_str,
-            "prompt": prompt,
-            "seed": seed,
-            "steps": steps,
-            "width": width,
-            "height": height
+        # 結果を返す（1枚の場合は従来どおりトップレベルに image / seed を置く）
+        output = {
+            "prompt": request["prompt"],
+            "steps": request["steps"],
+            "width": request["width"],
+            "height": request["height"],
+            "upscale_mode": request["upscale_mode"],
+            "quality": request["quality"],
+            "scheduler": request["scheduler"],
+            "guidance_scale": request["guidance_scale"],
+            "plan": request["plan"],
+            "memory": {
+                "policy": results[0]["memory"]["policy"],
+                **{
+                    key: max(
+                        (result["memory"][key] for result in results if result["memory"][key] is not None),
+                        default=None,
+                    )
+                    for key in ("peak_allocated_mb", "peak_reserved_mb", "peak_rss_mb")
+                },
+            },
+            "cache_stats": {
+                "prompt": prompt_cache.stats(),
+                "lora": lora_registry.stats(),
+                "ip_adapter": ip_adapter.stats(),
+            },
         }
+        if len(images) == 1:
+            output.update(images[0])
+        else:
+            output["num_images"] = len(images)
+            output["seeds"] = request["seeds"]
+            output["images"] = images
+            output["timings"] = images[0]["timings"]
         
+        log_event(
+            "job_completed",
+            job_id=job_id,
+            num_images=len(images),
+            width=request["width"],
+            height=request["height"],
+            steps=request["steps"],
+            timings=output["timings"],
+            memory=output["memory"],
+        )
+        
+        # コールドスタートの計測値は、このワーカーの最初のジョブにだけ付ける
+        if INIT_TIMINGS and not _init_timings_reported:
+            output["init_timings"] = INIT_TIMINGS
+            _init_timings_reported = True
+        
+        return output
+        
+    except GenerationCancelled:
+        print(f"✓ Job {job.get('id', 'unknown')} cancelled during generation")
+        return {"error": "Job cancelled", "cancelled": True}
     except Exception as e:
         error_msg = f"{type(e).__name__}: {str(e)}"
         print(f"\n❌ ERROR in handler:")
         print(error_msg)
         traceback.print_exc()
+        log_event("job_failed", job_id=job.get("id", "unknown"), error=error_msg)
         return {"error": error_msg}
 
 
-# RunPod Serverlessを起動
-runpod.serverless.start({"handler": handler})
+async def handler(job):
+    """
+    RunPod Serverless ハンドラー関数
+    
+    入力形式:
+    {
+        "input": {
+            "prompt": "a beautiful landscape",
+            "negative_prompt": "low quality",
+            "steps": 30,
+            "guidance_scale": 7.5,
+            "seed": 42
+        }
+    }
+    
+    MAX_CONCURRENCY > 1 の場合は複数ジョブを同時に受け付ける。MAX_BATCH_SIZE を明示した場合は、
+    互換性のあるジョブが GenerationBatcher によって1回のパイプライン呼び出しにまとめて生成される。
+    生成中の進捗（ステージ、ステップ / 総数、ETA）は progress_update で間引いて送る。
+    """
+    progress = JobProgress(job, asyncio.get_running_loop())
+    return await process_job(job, progress)
+
+
+async def stream_handler(job):
+    """
+    ストリーミング用ハンドラー（STREAMING=1 で使用。クライアントは /stream で受け取る）
+    
+    生成中は進捗イベント {"type": "progress", ...} と、preview_every ステップごとの
+    プレビュー {"type": "preview", "image": 小さなJPEGのbase64, ...} を yield し、
+    最後に handler() と同じ出力を yield する。ジョブがキャンセルされジェネレーターが閉じられると、
+    生成も次のステップで打ち切る。
+    """
+    progress = JobProgress(job, asyncio.get_running_loop(), stream=True)
+    task = asyncio.ensure_future(process_job(job, progress))
+    try:
+        while True:
+            next_event = asyncio.ensure_future(progress.events.get())
+            done, _ = await asyncio.wait({next_event, task}, return_when=asyncio.FIRST_COMPLETED)
+            if next_event in done:
+                yield next_event.result()
+                continue
+            next_event.cancel()
+            break
+        # 完了までに積まれた残りのイベントを流してから結果を返す
+        while not progress.events.empty():
+            yield progress.events.get_nowait()
+        yield task.result()
+    finally:
+        if not task.done():
+            progress.cancel()
+            task.cancel()
+
+
+# GPU処理を直列化するバッチャー（ジョブをまとめない場合や同時実行数が1なら待ち合わせは行わない）
+batcher = GenerationBatcher(
+    generate_batch,
+    batch_key,
+    window=BATCH_WINDOW_MS / 1000 if CROSS_JOB_BATCHING and MAX_CONCURRENCY > 1 else 0,
+    max_batch_size=MAX_BATCH_SIZE,
+    max_batch_pixels=MAX_BATCH_PIXELS,
+    cross_job=CROSS_JOB_BATCHING,
+)
+
+
+if __name__ == "__main__":
+    initialize()
+    
+    # RunPod Serverlessを起動（STREAMING=1 なら進捗とプレビューを /stream で返す）
+    # yield した項目を /status に集約すると途中経過とプレビューがすべて最終出力に残るため、集約しない
+    # （結果は /stream の最後の項目として返る。client.fetch_stream_output を参照）
+    runpod.serverless.start({
+        "handler": stream_handler if STREAMING else handler,
+        "concurrency_modifier": lambda current_concurrency: MAX_CONCURRENCY,
+        "return_aggregate_stream": False,
+    })
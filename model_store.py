@@ -0,0 +1,258 @@
+"""
+モデルマニフェスト（models.json）とローカルのコンテンツアドレス型モデルストア
+
+ビルド時:
+    python model_store.py fetch --manifest models.json --store /models
+実行時（handler.py）:
+    store = ModelStore("/models")
+    store.verify(load_manifest("models.json"))  # 欠けていれば ModelStoreError
+    store.resolve("base")                       # from_pretrained に渡せるローカルパス
+
+ストアの構成:
+    <store>/blobs/sha256/<hex>        ファイル本体（内容のSHA-256で一意。同じ内容は1つだけ保存）
+    <store>/snapshots/<name>/<path>   blob へのシンボリックリンク（リポジトリと同じディレクトリ構成）
+    <store>/lock.json                 エントリーごとのリポジトリ・解決済みコミット・ファイルハッシュ
+
+マニフェストのエントリーは Hugging Face Hub のリポジトリ（"repo_id" + "revision"）か、
+ローカルディレクトリ（"path"）のどちらかを指す。"files" には fnmatch 形式のパターンを書ける。
+"""
+import argparse
+import fnmatch
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+LOCK_FILE = "lock.json"
+
+
+class ModelStoreError(Exception):
+    """マニフェストが不正、またはストアにエントリー / ファイルが欠けている"""
+
+
+def load_manifest(path):
+    """マニフェストを読み込み、最低限の形式チェックを行う"""
+    with open(path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+
+    models = manifest.get("models")
+    if not isinstance(models, dict) or not models:
+        raise ModelStoreError(f"{path}: 'models' must be a non-empty object")
+    for name, entry in models.items():
+        if ("repo_id" in entry) == ("path" in entry):
+            raise ModelStoreError(f"{path}: model '{name}' must have exactly one of 'repo_id' or 'path'")
+        if not entry.get("files"):
+            raise ModelStoreError(f"{path}: model '{name}' has no 'files'")
+    return manifest
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(8 * 1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _match_files(name, patterns, available):
+    selected = []
+    for pattern in patterns:
+        matches = [filename for filename in available if fnmatch.fnmatchcase(filename, pattern)]
+        if not matches:
+            raise ModelStoreError(f"model '{name}': no file matches '{pattern}'")
+        selected.extend(filename for filename in matches if filename not in selected)
+    return selected
+
+
+class HubSource:
+    """Hugging Face Hub からマニフェストのファイルを取得する"""
+
+    def resolve(self, entry):
+        """(解決済みコミット, リポジトリ内のファイル一覧) を返す"""
+        from huggingface_hub import HfApi
+
+        info = HfApi().model_info(entry["repo_id"], revision=entry.get("revision", "main"))
+        return info.sha, [sibling.rfilename for sibling in info.siblings]
+
+    def download(self, entry, commit, filename, tmp_dir):
+        """ファイルを tmp_dir 以下へダウンロードし、(パス, 一時ファイルか) を返す"""
+        from huggingface_hub import hf_hub_download
+
+        path = hf_hub_download(
+            entry["repo_id"],
+            filename,
+            revision=commit,
+            cache_dir=os.path.join(tmp_dir, ".cache"),
+            local_dir=tmp_dir,
+            local_dir_use_symlinks=False,
+        )
+        return path, True
+
+
+class LocalSource:
+    """ローカルディレクトリからファイルを取得する（手元のアダプターやテスト用の小さな偽リポジトリ）"""
+
+    def resolve(self, entry):
+        root = entry["path"]
+        if not os.path.isdir(root):
+            raise ModelStoreError(f"local model directory not found: {root}")
+        available = []
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                relpath = os.path.relpath(os.path.join(dirpath, filename), root)
+                available.append(relpath.replace(os.sep, "/"))
+        return "local", sorted(available)
+
+    def download(self, entry, commit, filename, tmp_dir):
+        return os.path.join(entry["path"], filename), False
+
+
+class ModelStore:
+    """ベイク済みのローカルストア。実行時はネットワークに一切アクセスしない"""
+
+    def __init__(self, root):
+        self.root = root
+        self._lock = self._read_lock()
+
+    def _read_lock(self):
+        path = os.path.join(self.root, LOCK_FILE)
+        if not os.path.exists(path):
+            return {}
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _write_lock(self):
+        path = os.path.join(self.root, LOCK_FILE)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._lock, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, path)
+
+    def blob_path(self, sha256):
+        return os.path.join(self.root, "blobs", "sha256", sha256)
+
+    def snapshot_dir(self, name):
+        return os.path.join(self.root, "snapshots", name)
+
+    def _add_blob(self, path, move):
+        sha256 = file_sha256(path)
+        blob = self.blob_path(sha256)
+        if os.path.exists(blob):
+            if move:
+                os.remove(path)
+        else:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            if move:
+                shutil.move(path, blob)
+            else:
+                shutil.copyfile(path, blob)
+        return sha256
+
+    def _link(self, name, filename, sha256):
+        link = os.path.join(self.snapshot_dir(name), *filename.split("/"))
+        os.makedirs(os.path.dirname(link), exist_ok=True)
+        os.symlink(os.path.relpath(self.blob_path(sha256), os.path.dirname(link)), link)
+
+    def fetch(self, manifest, hub_source=None, local_source=None):
+        """マニフェストのすべてのエントリーを取得してストアに格納し、lock.json を更新する"""
+        hub_source = hub_source or HubSource()
+        local_source = local_source or LocalSource()
+        os.makedirs(self.root, exist_ok=True)
+
+        for name, entry in manifest["models"].items():
+            source = local_source if "path" in entry else hub_source
+            commit, available = source.resolve(entry)
+            filenames = _match_files(name, entry["files"], available)
+            print(f"Fetching {name} ({entry.get('repo_id', entry.get('path'))}@{commit}, {len(filenames)} files)...")
+
+            files = {}
+            with tempfile.TemporaryDirectory(dir=self.root) as tmp_dir:
+                for filename in filenames:
+                    path, is_temp = source.download(entry, commit, filename, tmp_dir)
+                    files[filename] = self._add_blob(path, move=is_temp)
+                    print(f"  ✓ {filename} ({files[filename][:12]})")
+
+            # 古いファイルが残らないようにスナップショットは作り直す
+            shutil.rmtree(self.snapshot_dir(name), ignore_errors=True)
+            for filename, sha256 in files.items():
+                self._link(name, filename, sha256)
+
+            self._lock[name] = {
+                "repo_id": entry.get("repo_id"),
+                "path": entry.get("path"),
+                "revision": entry.get("revision", "main"),
+                "commit": commit,
+                "files": files,
+            }
+            self._write_lock()
+        print(f"✓ Model store ready: {self.root}")
+
+    def verify(self, manifest, check_hashes=False):
+        """
+        マニフェストの全エントリーがストアに揃っているか確認する
+
+        欠けているものがあれば、すべてまとめて ModelStoreError として送出する。
+        """
+        problems = []
+        for name, entry in manifest["models"].items():
+            locked = self._lock.get(name)
+            if locked is None:
+                problems.append(f"{name}: not in store")
+                continue
+            wanted = (entry.get("repo_id"), entry.get("revision", "main"))
+            stored = (locked.get("repo_id"), locked.get("revision"))
+            if stored != wanted:
+                problems.append(f"{name}: store has {stored[0]}@{stored[1]}, manifest wants {wanted[0]}@{wanted[1]}")
+            try:
+                _match_files(name, entry["files"], list(locked["files"]))
+            except ModelStoreError as e:
+                problems.append(str(e))
+            for filename, sha256 in locked["files"].items():
+                path = os.path.join(self.snapshot_dir(name), *filename.split("/"))
+                if not os.path.exists(path):
+                    problems.append(f"{name}: missing {filename}")
+                elif check_hashes and file_sha256(path) != sha256:
+                    problems.append(f"{name}: hash mismatch for {filename}")
+        if problems:
+            raise ModelStoreError(f"model store {self.root} is incomplete:\n  " + "\n  ".join(problems))
+
+    def resolve(self, name):
+        """エントリー名からローカルのスナップショットディレクトリを返す"""
+        if name not in self._lock:
+            raise ModelStoreError(f"model '{name}' is not in store {self.root}")
+        return self.snapshot_dir(name)
+
+    def find(self, name_or_repo_id):
+        """エントリー名またはリポジトリIDに一致するスナップショットディレクトリ（なければ None）"""
+        if name_or_repo_id in self._lock:
+            return self.snapshot_dir(name_or_repo_id)
+        for name, locked in self._lock.items():
+            if locked.get("repo_id") == name_or_repo_id:
+                return self.snapshot_dir(name)
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="モデルマニフェストのファイルをローカルストアへ取得 / 検証する")
+    parser.add_argument("command", choices=["fetch", "verify"])
+    parser.add_argument("--manifest", default="models.json")
+    parser.add_argument("--store", default=os.getenv("MODEL_STORE", "/models"))
+    parser.add_argument("--check-hashes", action="store_true", help="verify時にファイル内容のハッシュも確認する")
+    args = parser.parse_args()
+
+    try:
+        manifest = load_manifest(args.manifest)
+        store = ModelStore(args.store)
+        if args.command == "fetch":
+            store.fetch(manifest)
+        store.verify(manifest, check_hashes=args.check_hashes)
+        print(f"✓ {len(manifest['models'])} model(s) verified in {args.store}")
+    except ModelStoreError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,10 @@
+import os
+import sys
+
+# リポジトリ直下のモジュール（handler / client / model_store）をインポートできるようにする
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# client.py はインポート時にエンドポイントの設定を要求する（テストではネットワークにアクセスしない）
+os.environ.setdefault("RUNPOD_ENDPOINT_ID", "test-endpoint")
+os.environ.setdefault("RUNPOD_API_KEY", "test-key")
+os.environ.setdefault("TRANSLATION_BACKEND", "none")
@@ -0,0 +1,390 @@
+import base64
+import json
+import os
+import threading
+
+import pytest
+
+for module in ("requests", "PIL"):
+    pytest.importorskip(module)
+
+import client  # noqa: E402
+from client import REQUEST_DEFAULTS, ResultCache, TranslationCache, request_cache_key, translate_many  # noqa: E402
+
+
+# ------------------------------------------
+# request_cache_key
+# ------------------------------------------
+
+def base_request(**overrides):
+    return {"prompt": "a cat", "seed": 42, **overrides}
+
+
+def test_cache_key_requires_seed():
+    assert request_cache_key({"prompt": "a cat"}) is None
+    assert request_cache_key({"prompt": "a cat", "seeds": [1, 2], "num_images": 2}) is not None
+
+
+def test_cache_key_omitted_equals_explicit_defaults():
+    assert request_cache_key(base_request()) == request_cache_key(base_request(**REQUEST_DEFAULTS))
+    assert request_cache_key(base_request()) == request_cache_key(
+        base_request(negative_prompt="negativeXL_D, low quality, blurry", steps=30, scheduler="default")
+    )
+    assert request_cache_key(base_request()) != request_cache_key(base_request(steps=31))
+
+
+def test_cache_key_fast_quality_defaults():
+    fast = request_cache_key(base_request(quality="fast"))
+    assert fast != request_cache_key(base_request())
+    assert fast == request_cache_key(
+        base_request(quality="fast", steps=6, guidance_scale=1.5, scheduler="LCM", plan={"refine": False})
+    )
+    # fast でも明示した値はそのまま使われる
+    assert fast != request_cache_key(base_request(quality="fast", steps=8))
+    assert fast != request_cache_key(base_request(quality="fast", plan={"refine": True}))
+
+
+def test_cache_key_normalizes_text_and_format():
+    key = request_cache_key(base_request(prompt="a cat", negative_prompt="blurry", output_format="png"))
+    assert key == request_cache_key(base_request(prompt="  a cat\n", negative_prompt=" blurry ", output_format="PNG"))
+
+
+def test_cache_key_seed_expansion():
+    assert request_cache_key(base_request(num_images=3)) == request_cache_key(
+        {"prompt": "a cat", "seeds": [42, 43, 44], "num_images": 3}
+    )
+    assert request_cache_key(base_request(num_images=2)) != request_cache_key(base_request(num_images=3))
+
+
+def test_cache_key_ignores_non_result_keys():
+    key = request_cache_key(base_request())
+    assert key == request_cache_key(base_request(delivery="url", step_timings=True, preview_every=2))
+
+
+def test_cache_key_lora_default_weight():
+    lora = {"path": "org/style-lora", "name": "style"}
+    assert request_cache_key(base_request(loras=[lora])) == request_cache_key(
+        base_request(loras=[{**lora, "weight": 1.0}])
+    )
+    assert request_cache_key(base_request(loras=[lora])) != request_cache_key(
+        base_request(loras=[{**lora, "weight": 0.5}])
+    )
+
+
+def test_cache_key_ignores_lora_name():
+    lora = {"path": "org/style-lora", "weight": 0.5}
+    assert request_cache_key(base_request(loras=[{**lora, "name": "style"}])) == request_cache_key(
+        base_request(loras=[{**lora, "name": "renamed"}])
+    ) == request_cache_key(base_request(loras=[lora]))
+
+
+def test_cache_key_empty_plan_equals_omitted():
+    assert request_cache_key(base_request(plan={})) == request_cache_key(base_request())
+    assert request_cache_key(base_request(plan=None)) == request_cache_key(base_request())
+    assert request_cache_key(base_request(quality="fast", plan={})) == request_cache_key(base_request(quality="fast"))
+    assert request_cache_key(base_request(plan={"refine": False})) != request_cache_key(base_request())
+
+
+def test_cache_key_normalizes_integral_numbers():
+    assert request_cache_key(base_request(guidance_scale=6)) == request_cache_key(base_request(guidance_scale=6.0))
+    assert request_cache_key(base_request(steps=30.0, lora_scale=1)) == request_cache_key(base_request())
+    assert request_cache_key(base_request(loras=[{"path": "a", "weight": 1}])) == request_cache_key(
+        base_request(loras=[{"path": "a"}])
+    )
+    assert request_cache_key(base_request(guidance_scale=6.5)) != request_cache_key(base_request(guidance_scale=6))
+
+
+def test_cache_key_reference_image_by_content():
+    image = b"\x89PNG\r\n\x1a\nfake"
+    encoded = base64.b64encode(image).decode("ascii")
+    key = request_cache_key(base_request(reference_image=encoded))
+    assert key == request_cache_key(base_request(reference_image=base64.b64encode(image).decode("ascii")))
+    assert key != request_cache_key(base_request(reference_image=base64.b64encode(image + b"!").decode("ascii")))
+    assert key != request_cache_key(base_request())
+
+
+# ------------------------------------------
+# 翻訳キャッシュ
+# ------------------------------------------
+
+class StubTranslator:
+    def __init__(self, fail=False):
+        self.calls = []
+        self.fail = fail
+
+    def __call__(self, texts):
+        self.calls.append(list(texts))
+        if self.fail:
+            raise RuntimeError("backend unavailable")
+        return [f"en:{text}" for text in texts]
+
+
+@pytest.fixture
+def stub_translator(tmp_path, monkeypatch):
+    backend = StubTranslator()
+    monkeypatch.setattr(client, "translation_backend", backend)
+    monkeypatch.setattr(client, "translation_backend_name", "stub")
+    monkeypatch.setattr(client, "translation_cache", TranslationCache(str(tmp_path / "translations.json")))
+    return backend
+
+
+def test_translate_many_sends_unique_uncached_texts_once(stub_translator):
+    texts = ["猫", "a dog", "猫", "犬"]
+    assert translate_many(texts) == ["en:猫", "a dog", "en:猫", "en:犬"]
+    assert stub_translator.calls == [["猫", "犬"]]
+
+    assert translate_many(["犬", "鳥"]) == ["en:犬", "en:鳥"]
+    assert stub_translator.calls[1:] == [["鳥"]]
+
+
+def test_translate_many_without_japanese_skips_backend(stub_translator):
+    assert translate_many(["a cat", "a dog"]) == ["a cat", "a dog"]
+    assert stub_translator.calls == []
+
+
+def test_translation_cache_persists_per_backend(tmp_path, stub_translator):
+    translate_many(["猫"])
+
+    reloaded = TranslationCache(str(tmp_path / "translations.json"))
+    assert reloaded.get("stub", "猫") == "en:猫"
+    assert reloaded.get("google", "猫") is None
+
+
+def test_translate_many_returns_originals_on_failure(tmp_path, monkeypatch):
+    backend = StubTranslator(fail=True)
+    monkeypatch.setattr(client, "translation_backend", backend)
+    monkeypatch.setattr(client, "translation_backend_name", "stub")
+    monkeypatch.setattr(client, "translation_cache", TranslationCache(str(tmp_path / "translations.json")))
+
+    assert translate_many(["猫", "a dog"]) == ["猫", "a dog"]
+    # 失敗した原文はキャッシュされず、次回は再び送られる
+    translate_many(["猫"])
+    assert backend.calls == [["猫"], ["猫"]]
+
+
+def test_translate_many_without_backend(monkeypatch):
+    monkeypatch.setattr(client, "translation_backend", None)
+    assert translate_many(["猫"]) == ["猫"]
+
+
+class FakeGoogleTranslator:
+    """
+    改行ごとに訳す偽の GoogleTranslator（keep_newlines=False なら改行を落とす）
+
+    本物と同じく5000文字以上の入力は例外にし、入力の前後の空白を取り除いてから訳す。
+    """
+
+    requests = []
+    keep_newlines = True
+
+    def __init__(self, source, target):
+        pass
+
+    def translate(self, text):
+        if not 0 <= len(text) < 5000:
+            raise ValueError("Text length need to be between 0 and 5000 characters")
+        text = text.strip()
+        FakeGoogleTranslator.requests.append(text)
+        separator = "\n" if FakeGoogleTranslator.keep_newlines else " "
+        return separator.join(f"en:{line}" for line in text.split("\n"))
+
+
+@pytest.fixture
+def fake_google(monkeypatch):
+    FakeGoogleTranslator.requests = []
+    FakeGoogleTranslator.keep_newlines = True
+    monkeypatch.setattr(client, "GoogleTranslator", FakeGoogleTranslator, raising=False)
+    return FakeGoogleTranslator
+
+
+def test_google_backend_joins_texts_into_one_request(fake_google):
+    texts = ["猫", "犬\n鳥", "魚"]
+    assert client._google_translate_batch(texts) == ["en:猫", "en:犬\nen:鳥", "en:魚"]
+    assert fake_google.requests == ["猫\n犬\n鳥\n魚"]
+
+
+def test_google_backend_splits_by_request_size(fake_google, monkeypatch):
+    monkeypatch.setattr(client, "GOOGLE_TRANSLATE_MAX_CHARS", 6)
+    assert client._google_translate_batch(["猫猫", "犬犬", "鳥鳥"]) == ["en:猫猫", "en:犬犬", "en:鳥鳥"]
+    assert fake_google.requests == ["猫猫\n犬犬", "鳥鳥"]
+
+
+def test_google_backend_falls_back_when_newlines_are_lost(fake_google):
+    fake_google.keep_newlines = False
+    assert client._google_translate_batch(["猫", "犬"]) == ["en:猫", "en:犬"]
+    assert fake_google.requests == ["猫\n犬", "猫", "犬"]
+
+
+# ------------------------------------------
+# バッチモード（/run と /status の疑似エンドポイント）
+# ------------------------------------------
+
+class FakeResponse:
+    def __init__(self, data):
+        self.data = data
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.data
+
+
+class FakeRunPod:
+    """/run で受け付けたジョブを、/status の2回目のポーリングで完了させる疑似エンドポイント"""
+
+    def __init__(self):
+        self.inputs = {}
+        self.polls = {}
+        self._lock = threading.Lock()
+
+    def post(self, url, json=None, timeout=None):
+        assert url.endswith("/run")
+        with self._lock:
+            job_id = f"job-{len(self.inputs)}"
+            self.inputs[job_id] = json["input"]
+            self.polls[job_id] = 0
+        return FakeResponse({"id": job_id})
+
+    def get(self, url, timeout=None):
+        job_id = url.rsplit("/", 1)[1]
+        with self._lock:
+            self.polls[job_id] += 1
+            polls = self.polls[job_id]
+        job_input = self.inputs[job_id]
+        if polls < 2:
+            return FakeResponse({"status": "IN_QUEUE"})
+        if job_input["prompt"] == "fail":
+            return FakeResponse({"status": "FAILED", "error": "boom"})
+        image = base64.b64encode(f"image:{job_input['prompt']}".encode()).decode("ascii")
+        return FakeResponse({"status": "COMPLETED", "output": {"image": image, "format": "png", "seed": job_input.get("seed")}})
+
+
+class FakeStreamingRunPod(FakeRunPod):
+    """STREAMING=1 のワーカー：/status の出力は空で、結果は /stream の最後の項目として返る"""
+
+    def get(self, url, timeout=None):
+        if "/stream/" in url:
+            job_id = url.rsplit("/", 1)[1]
+            result = super().get(url.replace("/stream/", "/status/"), timeout).json()["output"]
+            events = [{"type": "progress", "step": 1}, {"type": "preview", "image": "cHJldmlldw=="}, result]
+            return FakeResponse({"status": "COMPLETED", "stream": [{"output": event} for event in events]})
+        response = super().get(url, timeout)
+        if response.data["status"] == "COMPLETED":
+            response.data["output"] = []
+        return response
+
+
+@pytest.fixture
+def fake_runpod(tmp_path, monkeypatch):
+    endpoint = FakeRunPod()
+    monkeypatch.setattr(client, "create_session", lambda pool_size, api=True: endpoint)
+    monkeypatch.setattr(client, "ResultCache", lambda: ResultCache(str(tmp_path / "cache")))
+    monkeypatch.setattr(client.time, "sleep", lambda seconds: None)
+    monkeypatch.setattr(client, "translation_backend", None)
+    return endpoint
+
+
+def write_jobs(path, jobs):
+    path.write_text("\n".join(json.dumps(job) for job in jobs) + "\n", encoding="utf-8")
+    return str(path)
+
+
+def test_run_batch_saves_results_and_reports_failures(tmp_path, fake_runpod):
+    jobs_path = write_jobs(tmp_path / "jobs.jsonl", [
+        {"name": "cat", "input": {"prompt": "a cat", "seed": 1}},
+        {"name": "fail", "input": {"prompt": "fail", "seed": 2}},
+        {"prompt": " a dog ", "seed": 3},
+    ])
+    output_dir = str(tmp_path / "out")
+
+    results = client.run_batch(jobs_path, output_dir=output_dir, concurrency=2)
+
+    assert sorted(result["name"] for result in results) == ["cat", "job0003"]
+    with open(os.path.join(output_dir, "cat.png"), "rb") as f:
+        assert f.read() == b"image:a cat"
+    with open(os.path.join(output_dir, "job0003.png"), "rb") as f:
+        assert f.read() == b"image:a dog"
+    assert all(polls == 2 for polls in fake_runpod.polls.values())
+    assert sorted(job_input["prompt"] for job_input in fake_runpod.inputs.values()) == ["a cat", "a dog", "fail"]
+
+
+# ------------------------------------------
+# 結果キャッシュ（run_job）
+# ------------------------------------------
+
+def test_run_job_serves_repeated_request_from_cache(tmp_path, fake_runpod):
+    cache = ResultCache(str(tmp_path / "cache"))
+    output_dir = str(tmp_path / "out")
+    os.makedirs(output_dir)
+
+    first = client.run_job(fake_runpod, fake_runpod, "first", {"prompt": "a cat", "seed": 1}, output_dir, 60, cache)
+    assert not first["cached"] and len(fake_runpod.inputs) == 1
+
+    # 正規化後に同じリクエストはネットワークを使わずに返し、画像は新しい名前で保存する
+    second = client.run_job(
+        fake_runpod, fake_runpod, "second", {"prompt": " a cat ", "seed": 1, "steps": 30.0, "plan": {}}, output_dir, 60, cache
+    )
+    assert second["cached"] and second["job_id"] is None and len(fake_runpod.inputs) == 1
+    assert second["files"] == [os.path.join(output_dir, "second.png")]
+    with open(second["files"][0], "rb") as f:
+        assert f.read() == b"image:a cat"
+    assert second["output"] == {"format": "png", "seed": 1}
+
+    # use_cache=False なら再生成する。シード未指定はキャッシュしない
+    client.run_job(fake_runpod, fake_runpod, "third", {"prompt": "a cat", "seed": 1}, output_dir, 60, cache, use_cache=False)
+    client.run_job(fake_runpod, fake_runpod, "random", {"prompt": "a cat"}, output_dir, 60, cache)
+    client.run_job(fake_runpod, fake_runpod, "random", {"prompt": "a cat"}, output_dir, 60, cache)
+    assert len(fake_runpod.inputs) == 4
+
+
+def test_result_cache_evicts_least_recently_used(tmp_path):
+    source = tmp_path / "image.png"
+    source.write_bytes(b"x" * 100)
+    cache = ResultCache(str(tmp_path / "cache"), max_bytes=350)
+
+    cache.put("aa01", [str(source)], {"seed": 1})
+    cache.put("bb02", [str(source)], {"seed": 2})
+    os.utime(os.path.join(cache._entry_dir("aa01"), "meta.json"), (0, 0))
+    os.utime(os.path.join(cache._entry_dir("bb02"), "meta.json"), (1, 1))
+    cache.put("cc03", [str(source)], {"seed": 3})
+
+    assert cache.get("aa01", str(tmp_path / "a")) is None
+    assert cache.get("bb02", str(tmp_path / "b")) == ([str(tmp_path / "b.png")], {"seed": 2})
+    assert cache.get("cc03", str(tmp_path / "c")) is not None
+
+
+def test_google_backend_strips_texts_before_joining(fake_google):
+    texts = ["\n猫\n", "犬 \n 鳥\n", "  魚"]
+    assert client._google_translate_batch(texts) == ["en:猫", "en:犬\nen:鳥", "en:魚"]
+    assert fake_google.requests == ["猫\n犬\n鳥\n魚"]
+
+
+def test_google_backend_truncates_oversized_text(fake_google):
+    long_text = "猫" * 6000
+    assert client._google_translate_batch(["犬", long_text, "鳥"]) == [
+        "en:犬", "en:" + "猫" * (client.GOOGLE_TRANSLATE_MAX_CHARS - 1), "en:鳥",
+    ]
+    assert [len(request) for request in fake_google.requests] == [1, client.GOOGLE_TRANSLATE_MAX_CHARS - 1, 1]
+
+
+def test_translate_many_uses_stripped_text_as_cache_key(stub_translator):
+    assert translate_many(["猫\n", " 猫 "]) == ["en:猫", "en:猫"]
+    assert stub_translator.calls == [["猫"]]
+    assert translate_many(["猫"]) == ["en:猫"]
+    assert len(stub_translator.calls) == 1
+
+
+def test_run_job_reads_streaming_worker_result_from_stream(tmp_path):
+    endpoint = FakeStreamingRunPod()
+    result = client.run_job(endpoint, endpoint, "cat", {"prompt": "a cat", "seed": 1}, str(tmp_path), 60)
+    assert result["output"]["seed"] == 1
+    with open(result["files"][0], "rb") as f:
+        assert f.read() == b"image:a cat"
+
+
+def test_final_output_skips_stream_events():
+    result = {"image": "eA==", "seed": 1}
+    assert client.final_output([{"type": "progress"}, {"type": "preview", "image": "x"}, result]) == result
+    assert client.final_output([]) is None
+    assert client.final_output(result) == result
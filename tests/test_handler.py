@@ -0,0 +1,358 @@
+import concurrent.futures
+import os
+import threading
+import time
+import types
+
+import pytest
+
+for module in ("torch", "diffusers", "transformers", "huggingface_hub", "runpod", "PIL"):
+    pytest.importorskip(module)
+
+import torch  # noqa: E402
+
+import handler  # noqa: E402
+from handler import (  # noqa: E402
+    GenerationBatcher, S3ResultSink, SchedulerRegistry, resolve_stage_plan, select_memory_policy,
+)
+
+
+# ------------------------------------------
+# select_memory_policy
+# ------------------------------------------
+
+def test_memory_policy_unknown_mode():
+    with pytest.raises(ValueError, match="Unknown memory policy 'fastest'"):
+        select_memory_policy(1024, 1024, mode="fastest")
+
+
+def test_memory_policy_fixed_modes_ignore_size():
+    performance = select_memory_policy(4096, 4096, batch_size=4, free_bytes=0, mode="performance")
+    assert not performance["vae_tiling"] and not performance["vae_slicing"] and not performance["attention_slicing"]
+    assert performance["attention_backend"] in ("sdpa", "default")
+
+    # 省メモリでもSDPAがあればSDPAのまま（スライスはSDPAが使えない場合のみ）
+    low_memory = select_memory_policy(512, 512, mode="low_memory")
+    assert low_memory == {
+        "vae_tiling": True, "vae_slicing": True, "attention_slicing": False, "attention_backend": "sdpa",
+    }
+
+
+def test_memory_policy_slices_attention_only_without_sdpa(monkeypatch):
+    monkeypatch.delattr(torch.nn.functional, "scaled_dot_product_attention")
+    assert select_memory_policy(512, 512, mode="low_memory") == {
+        "vae_tiling": True, "vae_slicing": True, "attention_slicing": True, "attention_backend": "sliced",
+    }
+    assert select_memory_policy(1024, 1024, mode="performance")["attention_backend"] == "default"
+
+    tight = select_memory_policy(1024, 1024, free_bytes=handler.ATTENTION_SLICING_MAX_FREE_MB * 1024**2 - 1)
+    assert tight["attention_slicing"] and tight["attention_backend"] == "sliced"
+    assert select_memory_policy(1024, 1024)["attention_backend"] == "default"
+
+
+def test_memory_policy_auto_without_device_memory():
+    policy = select_memory_policy(1024, 1024)
+    assert not policy["vae_tiling"] and not policy["vae_slicing"] and not policy["attention_slicing"]
+
+    # バッチ時はVAEを1枚ずつ、しきい値以上の解像度は常にタイリング
+    assert select_memory_policy(1024, 1024, batch_size=2)["vae_slicing"]
+    side = int(handler.VAE_TILING_MIN_PIXELS ** 0.5)
+    assert select_memory_policy(side, side)["vae_tiling"]
+    assert not select_memory_policy(side - 8, side - 8)["vae_tiling"]
+
+
+def test_memory_policy_auto_with_low_free_memory():
+    vae_bytes = 1024 * 1024 * handler.VAE_DECODE_BYTES_PER_PIXEL
+    roomy = handler.ATTENTION_SLICING_MAX_FREE_MB * 1024**2 + vae_bytes * 2
+    assert select_memory_policy(1024, 1024, free_bytes=roomy) == select_memory_policy(1024, 1024)
+
+    tight = select_memory_policy(1024, 1024, free_bytes=handler.ATTENTION_SLICING_MAX_FREE_MB * 1024**2 - 1)
+    assert not tight["attention_slicing"] and tight["attention_backend"] == "sdpa"
+
+    # VAEデコードが空きの8割に収まらなければタイリング。バッチ時は1枚ずつなので1枚分で判定する
+    enough = vae_bytes / 0.8 + 1
+    assert not select_memory_policy(1024, 1024, free_bytes=enough)["vae_tiling"]
+    assert not select_memory_policy(1024, 1024, batch_size=4, free_bytes=enough)["vae_tiling"]
+    assert select_memory_policy(1024, 1024, free_bytes=vae_bytes)["vae_tiling"]
+
+
+# ------------------------------------------
+# SchedulerRegistry
+# ------------------------------------------
+
+def test_scheduler_registry_reuses_per_stage_instances():
+    from diffusers import DPMSolverMultistepScheduler, EulerDiscreteScheduler
+
+    default = EulerDiscreteScheduler(beta_schedule="scaled_linear", steps_offset=1)
+    registry = SchedulerRegistry(default)
+    assert registry.names[0] == "default" and set(handler.SCHEDULER_PRESETS) <= set(registry.names)
+
+    base, img2img = types.SimpleNamespace(), types.SimpleNamespace()
+    registry.apply("DPM++ 2M Karras", base, img2img)
+    assert isinstance(base.scheduler, DPMSolverMultistepScheduler)
+    assert base.scheduler.config.use_karras_sigmas and base.scheduler.config.beta_schedule == "scaled_linear"
+    # ステージごとに別インスタンスで、ジョブ間では同じインスタンスを使い回す
+    assert base.scheduler is not img2img.scheduler
+    first = (base.scheduler, img2img.scheduler)
+    registry.apply("DPM++ 2M Karras", base, img2img)
+    assert (base.scheduler, img2img.scheduler) == first
+
+    registry.apply("default", base)
+    assert type(base.scheduler) is EulerDiscreteScheduler and base.scheduler is not default
+
+
+def test_scheduler_registry_unknown_name():
+    from diffusers import EulerDiscreteScheduler
+
+    with pytest.raises(ValueError, match="Unknown scheduler 'Heun'"):
+        SchedulerRegistry(EulerDiscreteScheduler()).apply("Heun", types.SimpleNamespace())
+
+
+# ------------------------------------------
+# resolve_stage_plan
+# ------------------------------------------
+
+def test_stage_plan_bucket_size_skips_refine():
+    assert resolve_stage_plan(None, 1024, 1024, 30) == {
+        "base_width": 1024, "base_height": 1024, "refine": False, "refine_strength": None, "refine_steps": None,
+    }
+
+
+def test_stage_plan_off_bucket_size_refines_from_nearest_bucket():
+    plan = resolve_stage_plan({}, 1920, 1080, 25)
+    assert (plan["base_width"], plan["base_height"]) == (1344, 768)
+    assert plan["refine"] is True
+    assert plan["refine_strength"] == handler.DEFAULT_REFINE_STRENGTH
+    assert plan["refine_steps"] == 25
+
+
+def test_stage_plan_explicit_values():
+    plan = resolve_stage_plan(
+        {"base_width": 832, "base_height": 1216, "refine": True, "refine_strength": 0.5, "refine_steps": 10},
+        832, 1216, 30,
+    )
+    assert plan == {
+        "base_width": 832, "base_height": 1216, "refine": True, "refine_strength": 0.5, "refine_steps": 10,
+    }
+    # refine: false なら仕上げの設定は検証も使用もしない
+    plan = resolve_stage_plan({"refine": False, "refine_strength": 5}, 1920, 1080, 30)
+    assert plan["refine"] is False and plan["refine_strength"] is None
+
+
+@pytest.mark.parametrize("plan, width, height, message", [
+    (None, 1020, 1024, "'width' must be a positive multiple of 8"),
+    (None, 1024, 0, "'height' must be a positive multiple of 8"),
+    (None, 1024.0, 1024, "'width' must be a positive multiple of 8"),
+    ({"base_width": 1020}, 1024, 1024, "plan.base_width must be a positive multiple of 8"),
+    ({"base_width": 1024, "base_height": 512}, 1024, 1024, "does not match an SDXL aspect-ratio bucket"),
+    ({"refine": "yes"}, 1024, 1024, "plan.refine must be true, false or \"auto\""),
+    ({"refine": True, "refine_strength": 0}, 1024, 1024, "plan.refine_strength must be in"),
+    ({"refine": True, "refine_strength": 1.5}, 1024, 1024, "plan.refine_strength must be in"),
+    ({"refine": True, "refine_strength": 0.1, "refine_steps": 5}, 1024, 1024, "must give at least one step"),
+    ({"refine": True, "refine_steps": "10"}, 1024, 1024, "must give at least one step"),
+])
+def test_stage_plan_rejects_invalid_input(plan, width, height, message):
+    with pytest.raises(ValueError, match=message):
+        resolve_stage_plan(plan, width, height, 30)
+
+
+def test_stage_plan_accepts_scaled_bucket():
+    # バケットと同じアスペクト比なら、小さい解像度でもベースに使える
+    plan = resolve_stage_plan({"base_width": 512, "base_height": 512}, 1024, 1024, 30)
+    assert plan["refine"] is True and (plan["base_width"], plan["base_height"]) == (512, 512)
+
+
+# ------------------------------------------
+# GenerationBatcher._plan
+# ------------------------------------------
+
+def make_item(key, width=1024, height=1024):
+    return ({"key": key, "width": width, "height": height}, concurrent.futures.Future())
+
+
+def planned_keys(batcher, pending):
+    return [[request["key"] for request, _ in chunk] for chunk in batcher._plan(pending)]
+
+
+@pytest.fixture
+def make_batcher():
+    def make(**kwargs):
+        return GenerationBatcher(lambda requests: requests, lambda request: request["key"][0], **kwargs)
+    return make
+
+
+def test_plan_groups_by_key_in_arrival_order(make_batcher):
+    batcher = make_batcher(max_batch_size=4)
+    pending = [make_item("a1"), make_item("b1"), make_item("a2"), make_item("c1"), make_item("b2")]
+    assert planned_keys(batcher, pending) == [["a1", "a2"], ["b1", "b2"], ["c1"]]
+
+
+def test_plan_splits_by_batch_size(make_batcher):
+    batcher = make_batcher(max_batch_size=2)
+    pending = [make_item(f"a{i}") for i in range(5)]
+    assert planned_keys(batcher, pending) == [["a0", "a1"], ["a2", "a3"], ["a4"]]
+
+
+def test_plan_splits_by_pixels(make_batcher):
+    batcher = make_batcher(max_batch_size=8, max_batch_pixels=2 * 1024 * 1024)
+    pending = [make_item("a0"), make_item("a1"), make_item("a2", 2048, 1024), make_item("a3", 512, 512)]
+    # 上限を超える1件はそれだけで1バッチにする
+    assert planned_keys(batcher, pending) == [["a0", "a1"], ["a2"], ["a3"]]
+
+
+def test_plan_fails_only_malformed_requests():
+    batcher = GenerationBatcher(lambda requests: requests, lambda request: request["key"])
+    good = make_item("a")
+    missing_key = ({"width": 1024, "height": 1024}, concurrent.futures.Future())
+    unhashable = make_item(["a"])
+
+    assert planned_keys(batcher, [missing_key, good, unhashable]) == [["a"]]
+    assert isinstance(missing_key[1].exception(timeout=0), KeyError)
+    assert isinstance(unhashable[1].exception(timeout=0), TypeError)
+    assert not good[1].done()
+
+
+def test_batcher_survives_malformed_request():
+    batcher = GenerationBatcher(lambda requests: [request["key"] for request in requests], lambda request: request["key"])
+    bad = batcher.submit({"width": 1024, "height": 1024})
+    with pytest.raises(KeyError):
+        bad.result(timeout=5)
+    assert batcher.submit({"key": "a", "width": 1024, "height": 1024}).result(timeout=5) == "a"
+
+
+def test_batcher_without_cross_job_batching_keeps_jobs_apart():
+    calls = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def run_batch(requests):
+        calls.append([request["key"] for request in requests])
+        started.set()
+        release.wait(timeout=5)
+        return [request["key"] for request in requests]
+
+    batcher = GenerationBatcher(run_batch, lambda request: request["width"], window=0.05, cross_job=False)
+    first = batcher.submit({"key": "first", "width": 1024, "height": 1024})
+    assert started.wait(timeout=5)
+    # 生成中に届いた2ジョブは、互換でも別々に処理される。1ジョブ内の複数枚はまとめる
+    second = batcher.submit({"key": "second", "width": 1024, "height": 1024})
+    third = batcher.submit_many([{"key": f"third{i}", "width": 1024, "height": 1024} for i in range(2)])
+    release.set()
+
+    assert [future.result(timeout=5) for future in (first, second, *third)] == ["first", "second", "third0", "third1"]
+    assert calls == [["first"], ["second"], ["third0", "third1"]]
+
+
+def test_failed_batch_is_retried_one_by_one():
+    calls = []
+
+    def run_batch(requests):
+        calls.append([request["key"] for request in requests])
+        if any(request["key"] == "bad" for request in requests):
+            raise ValueError("bad request")
+        return [request["key"] for request in requests]
+
+    batcher = GenerationBatcher(run_batch, lambda request: request["width"], window=0)
+    items = [make_item("a"), make_item("bad"), make_item("b")]
+    batcher._run(items)
+
+    assert calls == [["a", "bad", "b"], ["a"], ["bad"], ["b"]]
+    assert items[0][1].result(timeout=0) == "a"
+    assert isinstance(items[1][1].exception(timeout=0), ValueError)
+    assert items[2][1].result(timeout=0) == "b"
+
+
+def test_cancelled_batch_is_not_retried(capsys):
+    calls = []
+
+    def run_batch(requests):
+        calls.append([request["key"] for request in requests])
+        raise handler.GenerationCancelled("all jobs in the batch were cancelled")
+
+    batcher = GenerationBatcher(run_batch, lambda request: request["width"], window=0)
+    items = [make_item("a"), make_item("b")]
+    batcher._run(items)
+
+    assert calls == [["a", "b"]]
+    assert all(isinstance(future.exception(timeout=0), handler.GenerationCancelled) for _, future in items)
+    captured = capsys.readouterr()
+    assert "Traceback" not in captured.err + captured.out
+    assert "Batch of 2 cancelled" in captured.out
+
+
+# ------------------------------------------
+# S3ResultSink
+# ------------------------------------------
+
+class FakeS3Client:
+    def __init__(self):
+        self.objects = {}
+        self.presigned = []
+
+    def upload_fileobj(self, fileobj, bucket, key, ExtraArgs=None):
+        self.objects[(bucket, key)] = (fileobj.read(), ExtraArgs)
+
+    def generate_presigned_url(self, operation, Params, ExpiresIn):
+        self.presigned.append((operation, Params, ExpiresIn))
+        return f"https://s3.test/{Params['Bucket']}/{Params['Key']}?expires={ExpiresIn}"
+
+
+def test_s3_sink_key_for():
+    sink = S3ResultSink("bucket", prefix="out/", client=FakeS3Client())
+    assert sink.key_for("job-1", 0, "png") == "out/job-1/0.png"
+    assert sink.key_for("job-1", 2, "jpeg") == "out/job-1/2.jpg"
+    assert sink.key_for("job-1", 1, "webp") == "out/job-1/1.webp"
+
+
+def test_s3_sink_upload_uses_injected_client():
+    client = FakeS3Client()
+    sink = S3ResultSink("bucket", prefix="out/", expires=600, client=client)
+
+    result = sink.upload(b"jpeg-bytes", "out/job-1/0.jpg", "jpeg")
+
+    assert client.objects[("bucket", "out/job-1/0.jpg")] == (b"jpeg-bytes", {"ContentType": "image/jpeg"})
+    assert client.presigned == [("get_object", {"Bucket": "bucket", "Key": "out/job-1/0.jpg"}, 600)]
+    assert result == {"image_key": "out/job-1/0.jpg", "image_url": "https://s3.test/bucket/out/job-1/0.jpg?expires=600"}
+
+
+# ------------------------------------------
+# 起動時の並列ロード
+# ------------------------------------------
+
+class SlowModel:
+    @classmethod
+    def from_pretrained(cls, path):
+        time.sleep(0.2)
+        return path
+
+
+def test_timed_load_excludes_construction_lock_wait(monkeypatch):
+    monkeypatch.setattr(handler, "INIT_TIMINGS", {})
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [
+            executor.submit(handler._timed_load, name, lambda name=name: handler._construct_model(SlowModel, name))
+            for name in ("a", "b")
+        ]
+        assert [future.result() for future in futures] == ["a", "b"]
+
+    timings = handler.INIT_TIMINGS
+    # 構築は1つずつだが、どちらの所要時間も自分の構築分だけで、待ち時間は別に記録される
+    assert all(150 <= timings[name] < 350 for name in ("a", "b"))
+    waits = [timings.get(f"{name}_lock_wait", 0) for name in ("a", "b")]
+    assert max(waits) >= 150 and min(waits) < 100
+
+
+def test_read_ahead_weights_reads_matching_variant(tmp_path, monkeypatch):
+    unet = tmp_path / "unet"
+    unet.mkdir()
+    (unet / "diffusion_pytorch_model.fp16.safetensors").write_bytes(b"\x00" * 100)
+    (unet / "diffusion_pytorch_model.safetensors").write_bytes(b"\x00" * 100)
+    (unet / "config.json").write_text("{}")
+    opened = []
+    real_open = open
+    monkeypatch.setattr("builtins.open", lambda path, *args, **kwargs: opened.append(path) or real_open(path, *args, **kwargs))
+
+    assert handler.read_ahead_weights(str(tmp_path), "unet", variant="fp16") == str(tmp_path)
+    assert [os.path.basename(path) for path in opened] == ["diffusion_pytorch_model.fp16.safetensors"]
+    # Hub のリポジトリIDならそのまま返す
+    assert handler.read_ahead_weights("org/model", "unet") == "org/model"
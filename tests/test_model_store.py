@@ -0,0 +1,156 @@
+import json
+import os
+
+import pytest
+
+from model_store import LOCK_FILE, ModelStore, ModelStoreError, file_sha256
+
+
+def write_file(root, relpath, data):
+    path = os.path.join(root, *relpath.split("/"))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+
+@pytest.fixture
+def fake_repo(tmp_path):
+    """LocalSource で取得する小さな偽リポジトリ"""
+    root = str(tmp_path / "repo")
+    write_file(root, "model_index.json", b'{"_class_name": "Fake"}')
+    write_file(root, "unet/config.json", b'{"in_channels": 4}')
+    write_file(root, "unet/weights.safetensors", b"\x00" * 64)
+    write_file(root, "vae/weights.safetensors", b"\x00" * 64)  # unet と同じ内容（ブロブは1つになる）
+    write_file(root, "README.md", b"not in manifest")
+    return root
+
+
+def make_manifest(**models):
+    return {"version": 1, "models": models}
+
+
+class FakeHubSource:
+    """Hub の代わりにメモリ上のファイルを返す"""
+
+    def __init__(self, files, commit="0123abcd"):
+        self.files = files
+        self.commit = commit
+        self.downloads = []
+
+    def resolve(self, entry):
+        return self.commit, sorted(self.files)
+
+    def download(self, entry, commit, filename, tmp_dir):
+        self.downloads.append((entry["repo_id"], commit, filename))
+        return write_file(tmp_dir, filename, self.files[filename]), True
+
+
+def test_fetch_local_source_links_only_manifest_files(tmp_path, fake_repo):
+    store = ModelStore(str(tmp_path / "store"))
+    manifest = make_manifest(fake={"path": fake_repo, "files": ["model_index.json", "unet/*", "vae/*"]})
+
+    store.fetch(manifest)
+
+    snapshot = store.resolve("fake")
+    assert sorted(
+        os.path.relpath(os.path.join(dirpath, name), snapshot).replace(os.sep, "/")
+        for dirpath, _, names in os.walk(snapshot)
+        for name in names
+    ) == ["model_index.json", "unet/config.json", "unet/weights.safetensors", "vae/weights.safetensors"]
+    with open(os.path.join(snapshot, "unet", "config.json"), "rb") as f:
+        assert f.read() == b'{"in_channels": 4}'
+
+    # 同じ内容のファイルは1つのブロブを共有し、元のファイルは移動されない
+    blobs = os.listdir(os.path.join(store.root, "blobs", "sha256"))
+    assert len(blobs) == 3
+    assert os.path.exists(os.path.join(fake_repo, "unet", "weights.safetensors"))
+
+    with open(os.path.join(store.root, LOCK_FILE), encoding="utf-8") as f:
+        locked = json.load(f)["fake"]
+    assert locked["commit"] == "local"
+    assert locked["files"]["model_index.json"] == file_sha256(os.path.join(fake_repo, "model_index.json"))
+
+    store.verify(manifest, check_hashes=True)
+    assert ModelStore(store.root).resolve("fake") == snapshot
+
+
+def test_fetch_hub_source_and_find_by_repo_id(tmp_path):
+    hub = FakeHubSource({"config.json": b"{}", "model.safetensors": b"\x01" * 16, "model.bin": b"\x02"})
+    store = ModelStore(str(tmp_path / "store"))
+    manifest = make_manifest(vae={"repo_id": "org/vae", "revision": "v1", "files": ["config.json", "*.safetensors"]})
+
+    store.fetch(manifest, hub_source=hub)
+
+    assert [filename for _, _, filename in hub.downloads] == ["config.json", "model.safetensors"]
+    assert all(commit == "0123abcd" for _, commit, _ in hub.downloads)
+    assert store.find("org/vae") == store.find("vae") == store.snapshot_dir("vae")
+    assert store.find("org/other") is None
+    store.verify(manifest)
+
+
+def test_fetch_fails_when_pattern_matches_nothing(tmp_path, fake_repo):
+    store = ModelStore(str(tmp_path / "store"))
+    manifest = make_manifest(fake={"path": fake_repo, "files": ["text_encoder/*"]})
+
+    with pytest.raises(ModelStoreError, match="no file matches 'text_encoder/\\*'"):
+        store.fetch(manifest)
+
+
+def test_fetch_missing_local_directory(tmp_path):
+    store = ModelStore(str(tmp_path / "store"))
+    manifest = make_manifest(fake={"path": str(tmp_path / "missing"), "files": ["*"]})
+
+    with pytest.raises(ModelStoreError, match="local model directory not found"):
+        store.fetch(manifest)
+
+
+def test_refetch_drops_files_removed_from_manifest(tmp_path, fake_repo):
+    store = ModelStore(str(tmp_path / "store"))
+    store.fetch(make_manifest(fake={"path": fake_repo, "files": ["model_index.json", "unet/*"]}))
+    store.fetch(make_manifest(fake={"path": fake_repo, "files": ["model_index.json"]}))
+
+    assert not os.path.exists(os.path.join(store.resolve("fake"), "unet"))
+
+
+def test_verify_reports_every_problem(tmp_path, fake_repo):
+    store = ModelStore(str(tmp_path / "store"))
+    store.fetch(make_manifest(fake={"path": fake_repo, "files": ["model_index.json", "unet/*"]}))
+    os.remove(os.path.join(store.resolve("fake"), "unet", "config.json"))
+
+    manifest = make_manifest(
+        fake={"path": fake_repo, "files": ["model_index.json", "unet/*", "vae/*"]},
+        base={"repo_id": "org/base", "files": ["*"]},
+    )
+    with pytest.raises(ModelStoreError) as excinfo:
+        store.verify(manifest)
+
+    message = str(excinfo.value)
+    assert "fake: missing unet/config.json" in message
+    assert "no file matches 'vae/*'" in message
+    assert "base: not in store" in message
+
+
+def test_verify_revision_mismatch(tmp_path):
+    store = ModelStore(str(tmp_path / "store"))
+    store.fetch(make_manifest(vae={"repo_id": "org/vae", "files": ["*"]}), hub_source=FakeHubSource({"a": b"a"}))
+
+    with pytest.raises(ModelStoreError, match="store has org/vae@main, manifest wants org/vae@v2"):
+        store.verify(make_manifest(vae={"repo_id": "org/vae", "revision": "v2", "files": ["*"]}))
+
+
+def test_verify_check_hashes_detects_modified_blob(tmp_path, fake_repo):
+    store = ModelStore(str(tmp_path / "store"))
+    manifest = make_manifest(fake={"path": fake_repo, "files": ["model_index.json"]})
+    store.fetch(manifest)
+    with open(os.path.join(store.resolve("fake"), "model_index.json"), "wb") as f:
+        f.write(b"corrupted")
+
+    store.verify(manifest)
+    with pytest.raises(ModelStoreError, match="hash mismatch for model_index.json"):
+        store.verify(manifest, check_hashes=True)
+
+
+def test_resolve_unknown_model(tmp_path):
+    with pytest.raises(ModelStoreError, match="not in store"):
+        ModelStore(str(tmp_path / "store")).resolve("base")
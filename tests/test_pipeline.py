@@ -0,0 +1,341 @@
+"""
+小さなランダムSDXLパイプライン（benchmark.build_tiny_pipeline）で handler の生成経路をCPUで確かめる
+"""
+import asyncio
+import base64
+
+import pytest
+
+for module in ("torch", "diffusers", "transformers", "huggingface_hub", "runpod", "PIL"):
+    pytest.importorskip(module)
+
+import torch  # noqa: E402
+from diffusers.models.attention_processor import AttnProcessor, AttnProcessor2_0, SlicedAttnProcessor  # noqa: E402
+
+import benchmark  # noqa: E402
+import handler  # noqa: E402
+
+
+@pytest.fixture
+def tiny_pipeline(tmp_path):
+    pipeline = benchmark.build_tiny_pipeline(str(tmp_path), "cpu")
+    handler.setup_pipelines(pipeline)
+    return pipeline
+
+
+def make_request(**overrides):
+    job_input = {
+        "prompt": "a cat",
+        "seed": 0,
+        "steps": 2,
+        "width": 64,
+        "height": 64,
+        "plan": {"base_width": 64, "base_height": 64},
+        **overrides,
+    }
+    return handler.parse_request(job_input)
+
+
+# ------------------------------------------
+# parse_request
+# ------------------------------------------
+
+@pytest.mark.parametrize("overrides, message", [
+    ({"prompt": ["a", "b"]}, "'prompt' must be a string"),
+    ({"negative_prompt": 5}, "'negative_prompt' must be a string"),
+    ({"seed": 1.5}, "seed must be an integer"),
+    ({"seed": True}, "seed must be an integer"),
+    ({"seed": -1}, "seed must be an integer"),
+    ({"seed": 2**70}, "seed must be an integer"),
+    ({"seed": 2**64 - 1, "num_images": 2}, "seed must be an integer"),
+    ({"seeds": [1, 2**64], "num_images": 2}, "seeds must be a list of 2 integer"),
+    ({"seeds": [1.0]}, "seeds must be a list of 1 integer"),
+])
+def test_parse_request_rejects_invalid_prompt_and_seed(tiny_pipeline, overrides, message):
+    with pytest.raises(ValueError, match=message):
+        make_request(**overrides)
+
+
+def test_parse_request_accepts_seed_bounds(tiny_pipeline):
+    assert make_request(seed=2**64 - 1)["seeds"] == [2**64 - 1]
+    assert make_request(seed=0, num_images=2)["seeds"] == [0, 1]
+    assert make_request(negative_prompt=None)["negative_prompt"] is None
+
+
+def generate_image(**overrides):
+    return handler.generate_batch([make_request(**overrides)])[0]["image"].tobytes()
+
+
+# ------------------------------------------
+# generate_batch
+# ------------------------------------------
+
+def test_batched_generation_matches_single_generation(tiny_pipeline):
+    requests = [make_request(prompt="a cat", seed=1), make_request(prompt="a dog", seed=2)]
+    assert handler.batch_key(requests[0]) == handler.batch_key(requests[1])
+
+    batched = [result["image"] for result in handler.generate_batch(requests)]
+    single = [handler.generate_batch([request])[0]["image"] for request in requests]
+
+    for batched_image, single_image in zip(batched, single):
+        # バッチ内の行列演算の違いによる丸め誤差のみ許す
+        difference = torch.tensor(list(batched_image.tobytes())) - torch.tensor(list(single_image.tobytes()))
+        assert difference.abs().max() <= 2
+    assert batched[0].tobytes() != batched[1].tobytes()
+
+
+# ------------------------------------------
+# MemoryPolicyManager
+# ------------------------------------------
+
+def attention_processor_types(pipeline):
+    return {type(processor) for processor in pipeline.unet.attn_processors.values()}
+
+
+def test_memory_policy_manager_applies_vae_and_attention_settings(tiny_pipeline):
+    manager = handler.MemoryPolicyManager(tiny_pipeline)
+    vae = tiny_pipeline.vae
+
+    manager.apply(handler.select_memory_policy(64, 64, mode="low_memory"))
+    assert vae.use_tiling and vae.use_slicing
+    assert attention_processor_types(tiny_pipeline) == {AttnProcessor2_0}
+
+    # SDPAがない環境の省メモリ設定ではスライスする
+    manager.apply({"vae_tiling": True, "vae_slicing": True, "attention_slicing": True, "attention_backend": "sliced"})
+    assert attention_processor_types(tiny_pipeline) == {SlicedAttnProcessor}
+
+    # IP-Adapter有効中はアテンションプロセッサーに触れない
+    manager.apply(handler.select_memory_policy(64, 64, mode="performance"), ip_adapter_active=True)
+    assert not vae.use_tiling and not vae.use_slicing
+    assert attention_processor_types(tiny_pipeline) == {SlicedAttnProcessor}
+
+    manager.apply(handler.select_memory_policy(64, 64, mode="performance"))
+    assert attention_processor_types(tiny_pipeline) == {AttnProcessor2_0}
+    manager.apply({"vae_tiling": False, "vae_slicing": False, "attention_slicing": False, "attention_backend": "default"})
+    assert attention_processor_types(tiny_pipeline) == {AttnProcessor}
+
+
+def test_low_memory_policy_generates(tiny_pipeline, monkeypatch):
+    monkeypatch.setattr(handler, "MEMORY_POLICY", "low_memory")
+    (result,) = handler.generate_batch([make_request()])
+    assert result["image"].size == (64, 64)
+    assert result["memory"]["policy"]["attention_backend"] == "sdpa"
+
+
+# ------------------------------------------
+# PromptEmbeddingCache
+# ------------------------------------------
+
+def test_prompt_cache_matches_pipeline_encoding(tiny_pipeline):
+    cache = handler.PromptEmbeddingCache(tiny_pipeline)
+    embeds = cache.encode(["a cat", "a dog"], ["blurry", "blurry"], do_classifier_free_guidance=True)
+    # 共通のネガティブプロンプトは1回だけエンコードされる
+    assert cache.stats() == {"hits": 1, "misses": 3, "cached": 3}
+
+    expected = tiny_pipeline.encode_prompt(
+        prompt=["a cat", "a dog"],
+        negative_prompt=["blurry", "blurry"],
+        device=tiny_pipeline.device,
+        num_images_per_prompt=1,
+        do_classifier_free_guidance=True,
+    )
+    names = ("prompt_embeds", "negative_prompt_embeds", "pooled_prompt_embeds", "negative_pooled_prompt_embeds")
+    for name, tensor in zip(names, expected):
+        torch.testing.assert_close(embeds[name], tensor)
+
+    assert set(cache.encode(["a cat"], ["blurry"], do_classifier_free_guidance=False)) == {
+        "prompt_embeds", "pooled_prompt_embeds",
+    }
+    assert cache.stats()["hits"] == 2
+
+
+def test_prompt_cache_zero_negative_and_state_keys(tiny_pipeline):
+    cache = handler.PromptEmbeddingCache(tiny_pipeline, max_entries=2)
+    embeds = cache.encode(["a cat"], [None], do_classifier_free_guidance=True)
+    assert tiny_pipeline.config.force_zeros_for_empty_prompt
+    assert not embeds["negative_prompt_embeds"].any() and not embeds["negative_pooled_prompt_embeds"].any()
+
+    # テキストエンコーダー側のLoRAが変わると別のエントリーになる
+    cache.encode(["a cat"], [None], do_classifier_free_guidance=True, lora_state=(("lora_x", 1.0),), lora_scale=1.0)
+    assert cache.stats()["misses"] == 2
+    # 上限を超えると古いものから捨てられる
+    cache.encode(["a dog"], [None], do_classifier_free_guidance=True)
+    assert cache.stats()["cached"] == 2
+    cache.encode(["a cat"], [None], do_classifier_free_guidance=True)
+    assert cache.stats()["misses"] == 4
+
+
+# ------------------------------------------
+# LoraRegistry
+# ------------------------------------------
+
+@pytest.fixture
+def synthetic_loras(tmp_path):
+    pytest.importorskip("peft")
+    paths = benchmark.build_synthetic_loras(str(tmp_path / "loras"), 2)
+    return [{"path": path, "weight_name": benchmark.LORA_WEIGHT_NAME} for path in paths]
+
+
+def test_lora_registry_reuses_and_switches_adapters(tiny_pipeline, synthetic_loras):
+    first, second = synthetic_loras
+    plain = generate_image()
+
+    with_first = generate_image(loras=[first])
+    assert with_first != plain
+    assert generate_image(loras=[{**first, "name": "other-name"}]) == with_first
+    assert handler.lora_registry.stats()["misses"] == 1 and handler.lora_registry.stats()["hits"] == 1
+
+    assert generate_image(loras=[second]) not in (plain, with_first)
+    assert generate_image(loras=[first, second]) not in (plain, with_first)
+    assert handler.lora_registry.stats()["misses"] == 2
+
+    # LoRA指定のないジョブでは前のジョブのLoRAが効かない
+    assert generate_image() == plain
+    assert generate_image(loras=[first]) == with_first
+
+
+def test_lora_registry_evicts_least_recently_used(tiny_pipeline, synthetic_loras):
+    registry = handler.LoraRegistry(tiny_pipeline, max_adapters=1)
+    first, second = synthetic_loras
+
+    registry.activate([first])
+    registry.activate([second])
+
+    assert registry.stats()["resident"] == 1
+    adapter_names = set(tiny_pipeline.unet.peft_config)
+    assert adapter_names == {registry._adapter_name(registry.make_key(second))}
+
+
+def test_lora_registry_skips_unloadable_lora(tiny_pipeline, synthetic_loras, tmp_path):
+    missing = {"path": str(tmp_path / "missing"), "weight_name": benchmark.LORA_WEIGHT_NAME}
+    adapter_names, adapter_weights = handler.lora_registry.activate([missing, {**synthetic_loras[0], "weight": 0.5}])
+    assert len(adapter_names) == 1 and adapter_weights == [0.5]
+    assert handler.lora_registry.stats()["resident"] == 1
+
+
+# ------------------------------------------
+# IPAdapterManager
+# ------------------------------------------
+
+class FakeIPAdapterProcessor(AttnProcessor2_0):
+    """IP-Adapter用プロセッサーの代わり（通常のものと区別できればよい）"""
+
+
+@pytest.fixture
+def fake_ip_adapter(tiny_pipeline, monkeypatch):
+    """load_ip_adapter を、プロセッサーと encoder_hid_proj を差し替えるだけのものにする（Hubにアクセスしない）"""
+    def load_ip_adapter(*args, **kwargs):
+        unet = tiny_pipeline.unet
+        unet.set_attn_processor({name: FakeIPAdapterProcessor() for name in unet.attn_processors})
+        unet.encoder_hid_proj = torch.nn.Identity()
+        unet.config.encoder_hid_dim_type = "ip_image_proj"
+
+    monkeypatch.setattr(tiny_pipeline, "load_ip_adapter", load_ip_adapter)
+    return handler.ip_adapter
+
+
+def ip_processor_count(pipeline):
+    return sum(isinstance(processor, FakeIPAdapterProcessor) for processor in pipeline.unet.attn_processors.values())
+
+
+def test_ip_adapter_toggles_repeatedly(tiny_pipeline, fake_ip_adapter):
+    num_layers = len(tiny_pipeline.unet.attn_processors)
+    fake_ip_adapter.load()
+    assert not fake_ip_adapter.active and ip_processor_count(tiny_pipeline) == 0
+
+    for _ in range(2):
+        fake_ip_adapter.enable(0.5)
+        assert fake_ip_adapter.active
+        assert ip_processor_count(tiny_pipeline) == num_layers
+        assert tiny_pipeline.unet.encoder_hid_proj is not None
+
+        fake_ip_adapter.disable()
+        assert not fake_ip_adapter.active
+        assert ip_processor_count(tiny_pipeline) == 0
+        assert tiny_pipeline.unet.encoder_hid_proj is None
+        assert tiny_pipeline.unet.config.encoder_hid_dim_type is None
+
+    # IP-Adapterを使った後でも、参照画像なしのジョブが生成できる
+    results = handler.generate_batch([make_request()])
+    assert results[0]["image"].size == (64, 64)
+
+
+def test_reference_job_does_not_break_later_jobs(tiny_pipeline, fake_ip_adapter):
+    reference_image = base64.b64encode(benchmark._noise_png()).decode("utf-8")
+    # 画像エンコーダーがないため参照画像なしの生成にフォールバックするが、IP-Adapterの有効化と無効化は通る
+    handler.generate_batch([make_request(reference_image=reference_image)])
+    assert fake_ip_adapter.loaded and not fake_ip_adapter.active
+
+    for _ in range(2):
+        assert handler.generate_batch([make_request()])[0]["image"].size == (64, 64)
+    assert ip_processor_count(tiny_pipeline) == 0
+
+
+# ------------------------------------------
+# benchmark のランダムLoRA
+# ------------------------------------------
+
+def test_synthetic_loras_have_nonzero_lora_b(tmp_path):
+    pytest.importorskip("peft")
+    from safetensors.torch import load_file
+
+    (path,) = benchmark.build_synthetic_loras(str(tmp_path), 1)
+    state_dict = load_file(f"{path}/{benchmark.LORA_WEIGHT_NAME}")
+    lora_b = [tensor for name, tensor in state_dict.items() if "lora_B" in name or "lora.up" in name]
+    assert lora_b and all(tensor.abs().sum() > 0 for tensor in lora_b)
+
+
+# ------------------------------------------
+# fast モード（蒸留LoRA + 少ステップ）
+# ------------------------------------------
+
+def test_fast_mode_defaults(tiny_pipeline):
+    request = handler.parse_request({"prompt": "a cat", "quality": "fast", "loras": [{"path": "org/style", "weight": 0.5}]})
+    assert request["steps"] == handler.FAST_STEPS
+    assert request["guidance_scale"] == handler.FAST_GUIDANCE_SCALE
+    assert request["scheduler"] == handler.FAST_SCHEDULER
+    assert request["plan"]["refine"] is False
+    # 蒸留LoRAはユーザーのLoRAの後に必須として追加される
+    assert request["loras"] == [
+        {"path": "org/style", "weight": 0.5},
+        {
+            "path": handler.FAST_LORA_PATH,
+            "name": "fast",
+            "weight": handler.FAST_LORA_WEIGHT,
+            "weight_name": handler.FAST_LORA_WEIGHT_NAME,
+            "required": True,
+        },
+    ]
+
+    # 明示した値はそのまま使う
+    request = make_request(quality="fast", steps=8, guidance_scale=2.0, scheduler="Euler", plan={"refine": True})
+    assert (request["steps"], request["guidance_scale"], request["scheduler"]) == (8, 2.0, "Euler")
+    assert request["plan"]["refine"] is True
+
+    standard = handler.parse_request({"prompt": "a cat"})
+    assert (standard["steps"], standard["guidance_scale"], standard["scheduler"]) == (30, 7.5, "default")
+    assert standard["loras"] == []
+
+
+def test_fast_mode_fails_when_distilled_lora_is_missing(tiny_pipeline, tmp_path, monkeypatch):
+    monkeypatch.setattr(handler, "FAST_LORA_PATH", str(tmp_path / "missing-lcm-lora"))
+    with pytest.raises(RuntimeError, match="Failed to load required LoRA fast"):
+        handler.generate_batch([make_request(quality="fast")])
+
+    job_input = {"prompt": "a cat", "seed": 0, "quality": "fast", "width": 64, "height": 64,
+                 "plan": {"base_width": 64, "base_height": 64}}
+    output = asyncio.run(handler.handler({"id": "fast-missing", "input": job_input}))
+    assert "Failed to load required LoRA fast" in output["error"]
+    # 失敗したジョブの後も通常のジョブは生成できる
+    assert generate_image() != b""
+
+
+def test_fast_mode_applies_distilled_lora(tiny_pipeline, synthetic_loras, monkeypatch):
+    lora = synthetic_loras[0]
+    monkeypatch.setattr(handler, "FAST_LORA_PATH", lora["path"])
+    monkeypatch.setattr(handler, "FAST_LORA_WEIGHT_NAME", lora["weight_name"])
+
+    fast = generate_image(quality="fast", steps=2)
+    settings = {"steps": 2, "guidance_scale": handler.FAST_GUIDANCE_SCALE, "scheduler": handler.FAST_SCHEDULER}
+    assert fast != generate_image(**settings)
+    assert fast == generate_image(**settings, loras=[{**lora, "weight": handler.FAST_LORA_WEIGHT}])